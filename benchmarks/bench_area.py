@@ -0,0 +1,47 @@
+import pytest
+
+
+@pytest.mark.parametrize('clients', [10, 50, 200])
+def test_send_command_fan_out(benchmark, connect, server, clients):
+    area = server.area_manager.areas[1]
+    for _ in range(clients):
+        connect(area)
+    benchmark(area.send_command, 'CT', 'bench', 'Hello, everyone!', '0')
+
+
+def test_get_available_char_list(benchmark, connect, server):
+    area = server.area_manager.areas[1]
+    for char_id in range(0, len(server.char_list), 2):
+        connect(area, char_id=char_id)
+    client = connect(area).client
+    benchmark(client.get_available_char_list)
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_create_evi_list(benchmark, connect, server, cached):
+    area = server.area_manager.areas[1]
+    client = connect(area).client
+    evidence = area.evi_list
+    if len(evidence.evidences) == 0:
+        for i in range(50):
+            evidence.add_evidence(client, f'Evidence {i}', 'Description ' * 20,
+                                  'empty.png', pos='all')
+
+    def render():
+        if not cached:
+            evidence.invalidate()
+        return evidence.create_evi_list(client)
+
+    benchmark(render)
+
+
+def test_get_song_data(benchmark, server):
+    # A large music list: 50 categories of 200 songs each
+    music_list = [{'category': f'=={c}==',
+                   'songs': [{'name': f'Category {c} song {s}.opus',
+                              'length': 120}
+                             for s in range(200)]}
+                  for c in range(50)]
+    assert benchmark(server.get_song_data, music_list,
+                     'Category 49 song 199.opus') == \
+        ('Category 49 song 199.opus', 120)
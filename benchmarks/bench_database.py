@@ -0,0 +1,20 @@
+from server import database
+from server.chatlog import ChatLog
+
+
+def test_log_ic(benchmark, connect, server):
+    area = server.area_manager.default_area()
+    client = connect(area, char_id=0).client
+    benchmark(database.log_ic, client, area, 'Phoenix', 'Objection!')
+
+
+def test_log_ic_chat_log(benchmark, connect, server, tmp_path):
+    area = server.area_manager.default_area()
+    client = connect(area, char_id=0).client
+    chat_log = ChatLog({'directory': str(tmp_path)})
+    database.set_chat_log(chat_log)
+    try:
+        benchmark(database.log_ic, client, area, 'Phoenix', 'Objection!')
+    finally:
+        database.set_chat_log(None)
+        chat_log.close()
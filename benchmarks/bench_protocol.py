@@ -0,0 +1,55 @@
+import pytest
+
+from server.fantacrypt import fanta_decrypt, fanta_encrypt
+from server.network.aoprotocol import AOProtocol
+
+MS_ARGS = ['chat', '-', 'Phoenix', 'normal', 'Objection!', 'def', '1', '0',
+           '0', '0', '0', '0', '0', '0', '0']
+
+
+def test_get_messages(benchmark, connect, server):
+    protocol = connect(server.area_manager.default_area())
+    data = ''.join(f'CT#bench#message {i}#%' for i in range(100))
+
+    def frame():
+        protocol.buffer = data
+        return sum(1 for _ in protocol.get_messages())
+
+    assert benchmark(frame) == 100
+
+
+def test_validate_net_cmd(benchmark, connect, server):
+    protocol = connect(server.area_manager.default_area(), char_id=0)
+    T = AOProtocol.ArgType
+    types = (T.STR, T.STR_OR_EMPTY, T.STR, T.STR, T.STR_OR_EMPTY, T.STR,
+             T.STR, T.INT, T.INT, T.INT, T.INT_OR_STR, T.INT, T.INT, T.INT,
+             T.INT)
+    assert benchmark(lambda: protocol.validate_net_cmd(list(MS_ARGS), *types))
+
+
+def test_fanta_decrypt(benchmark):
+    data = fanta_encrypt('MS#chat#-#Phoenix#normal#Objection!#def#1#0')
+    assert benchmark(fanta_decrypt, data).startswith('MS#')
+
+
+@pytest.mark.parametrize('listeners', [10, 50])
+def test_net_cmd_ms(benchmark, connect, server, listeners):
+    area = server.area_manager.areas[1]
+    speaker = connect(area, char_id=0)
+    for _ in range(listeners):
+        connect(area)
+    count = 0
+
+    def speak():
+        nonlocal count
+        count += 1
+        # Let the next message through right away.
+        area.next_message_time = 0
+        args = list(MS_ARGS)
+        args[2] = speaker.client.char_name
+        args[4] = f'Message number {count}'
+        speaker.net_cmd_ms(args)
+
+    before = speaker.client.transport.written
+    benchmark(speak)
+    assert speaker.client.transport.written > before
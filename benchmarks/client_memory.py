@@ -0,0 +1,89 @@
+"""
+Measures how much memory each connected client costs.
+
+    python -m benchmarks.client_memory [counts...]
+
+Clients are created without a network connection. "Idle" clients are
+spectators that never speak; "active" clients have picked a character,
+spoken in IC with a pairing partner, and changed the music.
+"""
+
+import gc
+import sys
+import tracemalloc
+
+from server.area_manager import AreaManager
+from server.client_manager import ClientManager
+
+
+class FakeServer:
+    char_list = ['Phoenix', 'Edgeworth', 'Maya']
+    config = {
+        'playerlimit': 100,
+        'music_change_floodguard': {
+            'times_per_interval': 3,
+            'interval_length': 20,
+            'mute_length': 180,
+        },
+        'wtce_floodguard': {
+            'times_per_interval': 5,
+            'interval_length': 10,
+            'mute_length': 1000,
+        },
+    }
+
+
+class FakeArea:
+    floodguard = {}
+    floodguard_config = AreaManager.Area.floodguard_config
+
+    def __init__(self, server):
+        self.server = server
+
+
+class FakeAreaManager:
+    def __init__(self, server):
+        self.area = FakeArea(server)
+
+    def default_area(self):
+        return self.area
+
+
+def activate(client):
+    client.char_id = 1
+    client.charid_pair = 2
+    client.offset_pair = '0<and>0'
+    client.last_sprite = 'normal'
+    client.flip = 1
+    client.change_music_cd()
+
+
+def measure(count, active):
+    server = FakeServer()
+    server.area_manager = FakeAreaManager(server)
+    server.client_manager = ClientManager(server)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    clients = [ClientManager.Client(server, None, i, i) for i in range(count)]
+    if active:
+        for client in clients:
+            activate(client)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list holding the clients is not part of the cost.
+    return (after - before - sys.getsizeof(clients)) / count
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    for count in counts:
+        idle = measure(count, active=False)
+        active = measure(count, active=True)
+        print(f'{count:>7} clients: {idle:8.0f} bytes/client idle, '
+              f'{active:8.0f} bytes/client active')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Fixtures for the micro-benchmarks. Run them from the repository root:
+
+    python -m pip install -r benchmarks/requirements.txt
+    python -m pytest benchmarks
+
+Compare against a saved run with --benchmark-save=<name> and
+--benchmark-compare.
+"""
+
+import asyncio
+import os
+import shutil
+
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeTransport:
+    """Counts the bytes written instead of sending them."""
+
+    def __init__(self, peername):
+        self.peername = peername
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def get_extra_info(self, key):
+        if key == 'peername':
+            return (self.peername, 0)
+        return None
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    """A server built from config_sample in a temporary directory, with
+    its own database. It is never started; clients are connected
+    through fake transports."""
+    path = tmp_path_factory.mktemp('server')
+    shutil.copytree(os.path.join(ROOT, 'config_sample'), path / 'config')
+    shutil.copytree(os.path.join(ROOT, 'migrations'), path / 'migrations')
+    for name in ('storage', 'logs', 'characters'):
+        (path / name).mkdir()
+    with open(path / 'config' / 'config.yaml', 'r', encoding='utf-8') as file:
+        config = yaml.safe_load(file)
+    config.update({'playerlimit': 1000, 'multiclient_limit': 1000,
+                   'use_masterserver': False})
+    with open(path / 'config' / 'config.yaml', 'w', encoding='utf-8') as file:
+        yaml.safe_dump(config, file)
+
+    cwd = os.getcwd()
+    os.chdir(path)
+    from server import database
+    from server.tsuserver import TsuServer3
+    try:
+        server = TsuServer3()
+        server.loop = asyncio.new_event_loop()
+        yield server
+        server.loop.close()
+        database.reset()
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def connect(server):
+    """Connect clients to an area, and disconnect them afterwards.
+
+    connect(area, char_id=-1) returns the protocol of the new client.
+    """
+    from server.network.aoprotocol import AOProtocol
+    protocols = []
+
+    def connect(area, char_id=-1):
+        number = len(protocols)
+        protocol = AOProtocol(server)
+        protocol.connection_made(FakeTransport(f'10.0.{number // 250}.'
+                                               f'{number % 250 + 1}'))
+        client = protocol.client
+        client.is_checked = True
+        if area != client.area:
+            client.change_area(area)
+        if char_id != -1:
+            client.change_character(char_id)
+        protocols.append(protocol)
+        return protocol
+
+    yield connect
+    for protocol in protocols:
+        protocol.connection_lost(None)
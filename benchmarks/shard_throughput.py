@@ -0,0 +1,179 @@
+"""
+Measures how many OOC messages a server delivers per second with its
+areas split across different numbers of worker processes, and with
+different event loops.
+
+    python -m benchmarks.shard_throughput [--workers 1 4] [--clients 40]
+                                          [--messages 200]
+                                          [--event-loops asyncio uvloop]
+
+Each run starts a real server from config_sample in a temporary
+directory, spreads the clients evenly over its areas and has every
+client send its messages as fast as the server reads them. Every
+message is delivered to each client in the sender's area.
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 27116
+
+
+def make_tree(path, workers, event_loop):
+    for name in ('server', 'migrations'):
+        shutil.copytree(os.path.join(ROOT, name), os.path.join(path, name))
+    shutil.copy(os.path.join(ROOT, 'start_server.py'), path)
+    for name in ('logs', 'storage'):
+        os.mkdir(os.path.join(path, name))
+    shutil.copytree(os.path.join(ROOT, 'config_sample'),
+                    os.path.join(path, 'config'))
+    config_path = os.path.join(path, 'config', 'config.yaml')
+    with open(config_path, 'r', encoding='utf-8') as file:
+        config = yaml.safe_load(file)
+    config.update({
+        'port': PORT,
+        'local': True,
+        'use_websockets': False,
+        'use_masterserver': False,
+        'playerlimit': 1000,
+        'multiclient_limit': 1000,
+        'area_workers': workers,
+        'event_loop': event_loop,
+        # The benchmark floods on purpose.
+        'packet_floodguard': {
+            'packets_per_second': 1e6,
+            'packet_burst': 1e6,
+            'bytes_per_second': 1e9,
+            'byte_burst': 1e9,
+        },
+    })
+    config.pop('ooc_floodguard', None)
+    with open(config_path, 'w', encoding='utf-8') as file:
+        yaml.safe_dump(config, file)
+    with open(os.path.join(path, 'config', 'areas.yaml'), 'r',
+              encoding='utf-8') as file:
+        return len(yaml.safe_load(file))
+
+
+class Client:
+    def __init__(self, index):
+        self.index = index
+        self.received = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, area):
+        self.reader, self.writer = await asyncio.open_connection(
+            '127.0.0.1', PORT)
+        self.writer.write(f'HI#bench{self.index}#%ID#0#AO2#2.9.0#%'
+                          f'askchaa#%RD#%CT#bench{self.index}#/area {area}#%'
+                          .encode())
+        await self.writer.drain()
+
+    async def read(self, tag):
+        """Count the messages carrying `tag` until the connection ends."""
+        tail = b''
+        needle = tag.encode()
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            data = tail + data
+            self.received += data.count(needle)
+            tail = data[-len(needle):]
+
+    async def flood(self, tag, messages):
+        for i in range(messages):
+            self.writer.write(
+                f'CT#bench{self.index}#{tag} {i}#%'.encode())
+            await self.writer.drain()
+
+
+async def wait_for_port():
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', PORT)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+    raise RuntimeError('The server did not start.')
+
+
+async def run_clients(count, areas, messages):
+    clients = [Client(i) for i in range(count)]
+    for client in clients:
+        await client.connect(client.index % areas)
+    # Let everyone arrive in their areas before flooding.
+    await asyncio.sleep(1 + count / 50)
+    tag = 'benchmark-message'
+    readers = [asyncio.ensure_future(client.read(tag)) for client in clients]
+    per_area = [0] * areas
+    for client in clients:
+        per_area[client.index % areas] += 1
+    expected = sum(n * n * messages for n in per_area)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client.flood(tag, messages)
+                           for client in clients))
+    while sum(client.received for client in clients) < expected and \
+            time.perf_counter() - start < 120:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    received = sum(client.received for client in clients)
+
+    for client in clients:
+        client.writer.close()
+    for reader in readers:
+        reader.cancel()
+    return received, expected, elapsed
+
+
+def measure(workers, event_loop, clients, messages):
+    with tempfile.TemporaryDirectory() as path:
+        areas = make_tree(path, workers, event_loop)
+        server = subprocess.Popen(
+            [sys.executable, 'start_server.py'], cwd=path,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_for_port())
+            return asyncio.run(run_clients(clients, areas, messages))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure message throughput with area workers.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4],
+                        help='worker counts to compare (1 is one process)')
+    parser.add_argument('--clients', type=int, default=40)
+    parser.add_argument('--messages', type=int, default=200,
+                        help='messages sent by each client')
+    parser.add_argument('--event-loops', nargs='+', default=['asyncio'],
+                        choices=['asyncio', 'uvloop'],
+                        help='event loops to compare')
+    args = parser.parse_args()
+
+    for event_loop in args.event_loops:
+        for workers in args.workers:
+            received, expected, elapsed = measure(
+                workers, event_loop, args.clients, args.messages)
+            print(f'{event_loop:>8}, {workers:>3} workers: '
+                  f'{received / elapsed:>10.0f} messages/s delivered '
+                  f'({received}/{expected} in {elapsed:.2f}s)')
+
+
+if __name__ == '__main__':
+    main()
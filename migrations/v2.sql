@@ -14,6 +14,4 @@ ALTER TABLE hdids_new RENAME TO hdids;
 
 PRAGMA foreign_keys = ON;
 
-VACUUM;
-
 PRAGMA user_version = 2;
@@ -14,6 +14,4 @@ ALTER TABLE hdid_bans_new RENAME TO hdid_bans;
 PRAGMA foreign_key_check;
 PRAGMA foreign_keys = ON;
 
-VACUUM;
-
 PRAGMA user_version = 3;
@@ -17,6 +17,4 @@ ALTER TABLE bans ADD unbanned INTEGER DEFAULT 0;
 PRAGMA foreign_key_check;
 PRAGMA foreign_keys = ON;
 
-VACUUM;
-
 PRAGMA user_version = 4;
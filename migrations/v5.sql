@@ -30,6 +30,4 @@ DROP TABLE hdid_bans_old;
 PRAGMA foreign_key_check;
 PRAGMA foreign_keys = ON;
 
-VACUUM;
-
 PRAGMA user_version = 5;
\ No newline at end of file
@@ -0,0 +1,18 @@
+-- Log retention: index event times so that expired rows can be found
+-- without scanning the whole table, and keep hourly message counts
+-- for rows that have been moved out to the archive.
+CREATE INDEX IF NOT EXISTS ic_events_event_time ON ic_events(event_time);
+CREATE INDEX IF NOT EXISTS room_events_event_time ON room_events(event_time);
+CREATE INDEX IF NOT EXISTS connect_events_event_time ON connect_events(event_time);
+CREATE INDEX IF NOT EXISTS misc_events_event_time ON misc_events(event_time);
+
+-- `hour` is formatted as 'YYYY-MM-DD HH:00:00' (UTC); `kind` is 'ic' or 'ooc'
+CREATE TABLE IF NOT EXISTS message_rollups(
+	hour DATETIME NOT NULL,
+	room_name TEXT NOT NULL,
+	kind TEXT NOT NULL,
+	messages INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (hour, room_name, kind)
+);
+
+PRAGMA user_version = 7;
@@ -0,0 +1,54 @@
+-- Full-text search over IC messages and OOC chat.
+-- These are external content tables: the text lives in `ic_events` and
+-- `room_events`, and the triggers below keep the indexes in step with
+-- every insert and delete (including rows removed by log retention).
+-- Only OOC chat is indexed from `room_events`.
+INSERT OR IGNORE INTO room_event_types(type_name) VALUES ('ooc');
+
+CREATE VIRTUAL TABLE IF NOT EXISTS ic_events_fts USING fts5(
+	message, content='ic_events', content_rowid='rowid'
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS room_events_fts USING fts5(
+	message, content='room_events', content_rowid='rowid'
+);
+
+CREATE TRIGGER IF NOT EXISTS ic_events_fts_insert
+AFTER INSERT ON ic_events BEGIN
+	INSERT INTO ic_events_fts(rowid, message)
+	VALUES (new.rowid, new.message);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ic_events_fts_delete
+AFTER DELETE ON ic_events BEGIN
+	INSERT INTO ic_events_fts(ic_events_fts, rowid, message)
+	VALUES ('delete', old.rowid, old.message);
+END;
+
+CREATE TRIGGER IF NOT EXISTS room_events_fts_insert
+AFTER INSERT ON room_events
+WHEN new.message IS NOT NULL AND new.event_subtype =
+	(SELECT type_id FROM room_event_types WHERE type_name = 'ooc')
+BEGIN
+	INSERT INTO room_events_fts(rowid, message)
+	VALUES (new.rowid, new.message);
+END;
+
+CREATE TRIGGER IF NOT EXISTS room_events_fts_delete
+AFTER DELETE ON room_events
+WHEN old.message IS NOT NULL AND old.event_subtype =
+	(SELECT type_id FROM room_event_types WHERE type_name = 'ooc')
+BEGIN
+	INSERT INTO room_events_fts(room_events_fts, rowid, message)
+	VALUES ('delete', old.rowid, old.message);
+END;
+
+-- Index the existing history
+INSERT INTO ic_events_fts(rowid, message)
+	SELECT rowid, message FROM ic_events;
+INSERT INTO room_events_fts(rowid, message)
+	SELECT rowid, message FROM room_events
+	WHERE message IS NOT NULL AND event_subtype =
+		(SELECT type_id FROM room_event_types WHERE type_name = 'ooc');
+
+PRAGMA user_version = 8;
@@ -0,0 +1,6 @@
+-- Unban scheduling: find pending timed bans in order of expiry without
+-- scanning the ban history.
+CREATE INDEX IF NOT EXISTS bans_pending_unban ON bans(unban_date)
+	WHERE unbanned = 0 AND unban_date IS NOT NULL;
+
+PRAGMA user_version = 9;
@@ -0,0 +1,129 @@
+"""
+Reads the chat log written with the `chat_log` option of config.yaml.
+
+    python -m scripts.chatlog [logs/chat] [--ipid 42] [--room BAS]
+                              [--kind ic|room] [--since 2020-05-01]
+                              [--until "2020-05-01 18:00"] [--grep text]
+                              [--last 100] [--json]
+
+Run this from the server's root directory; it can run while the server
+is writing the log. Times are in UTC unless they include an offset.
+Filtering by IPID or time only reads the matching records, using the
+index next to each segment. With --json, records are printed as JSON
+Lines, with the same fields as the ic_events and room_events tables
+and a `kind` of `ic` or `room`.
+"""
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import itertools
+import json
+import os
+import sys
+
+import arrow
+
+from server.chatlog import read_chat_log
+
+
+def format_entry(entry):
+    when = arrow.get(entry['event_time']).format('YYYY-MM-DD HH:mm:ss')
+    if entry['kind'] == 'ic':
+        return (f'{when} [{entry["room_name"]}] {entry["ic_name"]}/'
+                f'{entry["char_name"]} ({entry["ipid"]}): {entry["message"]}')
+    line = (f'{when} [{entry["room_name"]}] {entry["char_name"]}/'
+            f'{entry["ooc_name"]} ({entry["ipid"]}): '
+            f'{entry["event_subtype"]}')
+    if entry['message'] is not None:
+        line += f' {entry["message"]}'
+    if entry['target_ipid'] is not None:
+        line += f' -> {entry["target_ipid"]}'
+    return line
+
+
+def matches(entry, args):
+    if args.kind is not None and entry['kind'] != args.kind:
+        return False
+    if args.room is not None and entry['room_name'] != args.room:
+        return False
+    if args.grep is not None and \
+            args.grep not in str(entry['message']).lower():
+        return False
+    return True
+
+
+def parse_time(parser, value):
+    if value is None:
+        return None
+    try:
+        return arrow.get(value).timestamp()
+    except (arrow.parser.ParserError, ValueError) as exc:
+        parser.error(f'invalid time {value!r}: {exc}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Read the chat log of the server.')
+    parser.add_argument('directory', nargs='?', default='logs/chat',
+                        help='directory of the chat log (default: logs/chat)')
+    parser.add_argument('--ipid', type=int, help='only records of this IPID')
+    parser.add_argument('--room', help='only records of this area, '
+                                       'by abbreviation')
+    parser.add_argument('--kind', choices=('ic', 'room'),
+                        help='only IC messages or only room events')
+    parser.add_argument('--since', help='only records from this time on')
+    parser.add_argument('--until', help='only records up to this time')
+    parser.add_argument('--grep', help='only records whose message contains '
+                                       'this text, ignoring case')
+    parser.add_argument('--last', type=int,
+                        help='only the newest N matching records')
+    parser.add_argument('--json', action='store_true',
+                        help='print records as JSON Lines')
+    args = parser.parse_args()
+    if args.grep is not None:
+        args.grep = args.grep.lower()
+
+    if not os.path.isdir(args.directory):
+        print(f'error: no chat log at {args.directory}', file=sys.stderr)
+        sys.exit(1)
+
+    entries = read_chat_log(args.directory,
+                            since=parse_time(parser, args.since),
+                            until=parse_time(parser, args.until),
+                            ipid=args.ipid, reverse=args.last is not None)
+    entries = (entry for entry in entries if matches(entry, args))
+    try:
+        if args.last is not None:
+            # Read newest first and stop after enough matches.
+            entries = reversed(list(itertools.islice(entries, args.last)))
+        for entry in entries:
+            if args.json:
+                print(json.dumps(entry, ensure_ascii=False))
+            else:
+                print(format_entry(entry))
+    except ValueError as exc:
+        print(f'error: {exc}', file=sys.stderr)
+        sys.exit(1)
+    except BrokenPipeError:
+        # Piped into head or similar
+        sys.stderr.close()
+
+
+if __name__ == '__main__':
+    main()
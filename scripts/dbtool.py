@@ -0,0 +1,133 @@
+"""
+Maintenance tasks for the tsuserver3 database.
+Run this from the server's root directory while the server is stopped:
+
+    python -m scripts.dbtool migrate [--dry-run] [--vacuum]
+    python -m scripts.dbtool export <file> [--only bans ipids hdids logs]
+    python -m scripts.dbtool import <file>
+
+Exports are newline-delimited JSON, one row per line, and are read and
+written incrementally. Use a file name ending in .gz to compress them,
+or - for standard input/output. Imports keep the IDs of the export, so
+they go into a fresh database; a table that already has rows is refused.
+"""
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import gzip
+import json
+import sys
+
+from server.database import Database, EXPORT_GROUPS
+from server.exceptions import ServerError
+
+
+def migrate(db, args):
+    pending = db.pending_migrations()
+    if len(pending) == 0:
+        print('Database is up to date.')
+        return
+    print('Pending migrations: ' + ', '.join(f'v{v}' for v in pending))
+    timings = db.migrate(vacuum=args.vacuum, dry_run=args.dry_run,
+                         progress=print)
+    if args.dry_run:
+        for version, seconds in timings.items():
+            name = version if version == 'vacuum' else f'v{version}'
+            print(f'  {name}: {seconds:.2f}s')
+        print('Dry run complete; the database was not modified.')
+
+
+def open_dump(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def export(db, args):
+    counts = {}
+    with open_dump(args.file, 'w') as file:
+        for table, row in db.export_rows(args.only):
+            file.write(json.dumps({'table': table, 'row': row}) + '\n')
+            counts[table] = counts.get(table, 0) + 1
+    for table, count in counts.items():
+        print(f'Exported {count} rows from {table}', file=sys.stderr)
+
+
+def import_(db, args):
+    def rows(file):
+        for line in file:
+            if line.strip() != '':
+                record = json.loads(line)
+                yield record['table'], record['row']
+
+    with open_dump(args.file, 'r') as file:
+        counts = db.import_rows(rows(file))
+    for table, count in counts.items():
+        print(f'Imported {count} rows into {table}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Maintenance tasks for the tsuserver3 database.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = commands.add_parser(
+        'migrate', help='apply pending schema migrations')
+    migrate_parser.add_argument(
+        '--dry-run', action='store_true',
+        help='time the migrations on a copy of the database')
+    migrate_parser.add_argument(
+        '--vacuum', action='store_true',
+        help='reclaim free space after migrating (slow on large databases)')
+    migrate_parser.set_defaults(func=migrate)
+
+    export_parser = commands.add_parser(
+        'export', help='export tables as newline-delimited JSON')
+    export_parser.add_argument('file', help='output file, or - for stdout')
+    export_parser.add_argument(
+        '--only', nargs='+', choices=EXPORT_GROUPS.keys(),
+        default=list(EXPORT_GROUPS.keys()),
+        help='export only these groups of tables')
+    export_parser.set_defaults(func=export)
+
+    import_parser = commands.add_parser(
+        'import', help='import an export into this database')
+    import_parser.add_argument('file', help='input file, or - for stdin')
+    import_parser.set_defaults(func=import_)
+
+    args = parser.parse_args()
+    try:
+        db = Database(auto_migrate=False)
+        if args.command == 'export' and len(db.pending_migrations()) > 0:
+            # Exports are read-only; they follow the latest schema.
+            raise ServerError('The database has pending migrations. Run '
+                              'migrate before exporting it.')
+        if args.command == 'import':
+            # Keep standard output clean.
+            db.migrate(progress=lambda msg: print(msg, file=sys.stderr))
+        args.func(db, args)
+    except ServerError as exc:
+        print(f'error: {exc}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
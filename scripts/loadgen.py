@@ -0,0 +1,375 @@
+"""
+Load generator for tsuserver3: a swarm of simulated AO2 clients that
+connect, go through the handshake, pick a character and then send a
+mix of IC, OOC, music, area change and keepalive traffic.
+
+    python -m scripts.loadgen [--host 127.0.0.1] [--port 27016]
+                              [--websocket] [--clients 50]
+                              [--duration 30] [--rate 2]
+                              [--mix ms=4,ct=3,mc=1,area=1,check=1]
+
+Round-trip latency is measured from sending a packet to receiving the
+server's answer to it: the echo of an IC, OOC or music message, the
+"Changed area" message, or CHECK. Packets that are not answered within
+--timeout seconds, for example because a flood guard refused them,
+are counted as lost. Areas also drop IC messages while the previous one
+is still being displayed, so expect IC losses with many bots per area.
+
+Every bot connects from the same address, so raise multiclient_limit,
+and the flood guards if needed, in the server's config.yaml before
+running large swarms.
+"""
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import collections
+import random
+import sys
+import time
+
+KINDS = ('ms', 'ct', 'mc', 'area', 'check')
+
+
+class TCPConnection:
+    async def open(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    def send(self, packet):
+        self.writer.write(packet.encode('utf-8'))
+
+    async def receive(self):
+        """Get the next chunk of packets, or '' once the connection ends."""
+        data = await self.reader.read(65536)
+        return data.decode('utf-8', 'replace')
+
+    def close(self):
+        self.writer.close()
+
+
+class WebsocketConnection:
+    async def open(self, host, port):
+        import websockets
+        self.ws = await websockets.connect(f'ws://{host}:{port}')
+
+    def send(self, packet):
+        asyncio.ensure_future(self.ws.send(packet))
+
+    async def receive(self):
+        import websockets
+        try:
+            return await self.ws.recv()
+        except websockets.ConnectionClosed:
+            return ''
+
+    def close(self):
+        asyncio.ensure_future(self.ws.close())
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.sent = collections.Counter()
+        self.lost = collections.Counter()
+        self.handshakes = []
+        self.received = 0
+        self.failed = 0
+        self.refused = 0
+
+
+class Bot:
+    """One simulated client."""
+
+    def __init__(self, index, args, stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.name = f'loadgen{index}'
+        self.hdid = f'loadgen-{index}'
+        self.conn = None
+        self.buffer = ''
+        self.waiting = {}
+        self.pending = {kind: collections.deque() for kind in KINDS}
+        self.sequence = 0
+        self.char_id = -1
+        self.chars = []
+        self.taken = []
+        self.songs = []
+        self.area_id = 0
+        self.area_count = 1
+
+    async def run(self, deadline):
+        if self.args.websocket:
+            self.conn = WebsocketConnection()
+        else:
+            self.conn = TCPConnection()
+        started = time.perf_counter()
+        try:
+            await self.conn.open(self.args.host, self.args.port)
+        except OSError:
+            self.stats.failed += 1
+            return
+        receiver = asyncio.ensure_future(self.receive())
+        try:
+            await asyncio.wait_for(self.handshake(), self.args.timeout * 4)
+        except asyncio.TimeoutError:
+            self.stats.failed += 1
+            receiver.cancel()
+            self.conn.close()
+            return
+        except ConnectionError:
+            self.stats.refused += 1
+            receiver.cancel()
+            self.conn.close()
+            return
+        self.stats.handshakes.append(time.perf_counter() - started)
+
+        weights = [self.args.mix.get(kind, 0) for kind in KINDS]
+        while time.perf_counter() < deadline and not receiver.done():
+            await asyncio.sleep(random.expovariate(self.args.rate))
+            kind = random.choices(KINDS, weights)[0]
+            getattr(self, 'send_' + kind)()
+        # Give the last answers time to arrive.
+        await asyncio.sleep(min(self.args.timeout, 2))
+        receiver.cancel()
+        self.conn.close()
+        for kind, queue in self.pending.items():
+            self.stats.lost[kind] += len(queue)
+
+    async def receive(self):
+        while True:
+            try:
+                data = await self.conn.receive()
+            except ConnectionError:
+                data = ''
+            if data == '':
+                for future in self.waiting.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError())
+                return
+            self.buffer += data
+            *packets, self.buffer = self.buffer.split('%')
+            for packet in packets:
+                self.stats.received += 1
+                header, *args = packet.rstrip('#').split('#')
+                self.handle(header, args)
+
+    async def expect(self, header, packet=None):
+        """Send a packet and wait for the server to answer with `header`."""
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[header] = future
+        if packet is not None:
+            self.conn.send(packet)
+        try:
+            return await future
+        finally:
+            del self.waiting[header]
+
+    async def handshake(self):
+        await self.expect('decryptor')
+        await self.expect('ID', f'HI#{self.hdid}#%')
+        self.conn.send('ID#1#loadgen#2.9.0#%')
+        await self.expect('SI', 'askchaa#%')
+        self.chars = (await self.expect('SC', 'RC#%'))
+        self.songs = [item for item in await self.expect('SM', 'RM#%')
+                      if '.' in item]
+        await self.expect('DONE', 'RD#%')
+        # Take a character nobody in the area has.
+        free = [i for i, taken in enumerate(self.taken) if taken == '0']
+        random.shuffle(free)
+        for char_id in free[:3]:
+            self.conn.send(f'CC#0#{char_id}#{self.hdid}#%')
+            try:
+                await asyncio.wait_for(self.expect('PV'), 1)
+                break
+            except asyncio.TimeoutError:
+                continue
+
+    def handle(self, header, args):
+        future = self.waiting.get(header)
+        if future is not None and not future.done():
+            future.set_result(args)
+
+        if header == 'PV' and len(args) >= 3:
+            self.char_id = int(args[2])
+        elif header == 'CharsCheck':
+            self.taken = ['0' if taken == '0' else '1' for taken in args]
+        elif header == 'ARUP' and len(args) > 1 and args[0] == '0':
+            self.area_count = len(args) - 1
+        elif header == 'MS' and len(args) > 4:
+            self.answer('ms', args[4])
+        elif header == 'CT' and len(args) > 1:
+            if args[0] == self.name:
+                self.answer('ct', args[1])
+            elif args[1].startswith('Changed area to'):
+                area_id = self.answer('area', None)
+                if area_id is not None:
+                    self.area_id = area_id
+        elif header == 'MC' and len(args) > 1 and args[1] == str(self.char_id):
+            self.answer('mc', args[0])
+        elif header == 'CHECK':
+            self.answer('check', None)
+
+    def answer(self, kind, key):
+        """Record the latency of the oldest pending packet of this kind
+        that matches `key`, or of the oldest one if `key` is None."""
+        queue = self.pending[kind]
+        now = time.perf_counter()
+        while queue and now - queue[0][1] > self.args.timeout:
+            queue.popleft()
+            self.stats.lost[kind] += 1
+        for i, (match, sent, value) in enumerate(queue):
+            if key is None or match == key:
+                del queue[i]
+                self.stats.latencies[kind].append(now - sent)
+                return value
+        return None
+
+    def send(self, kind, packet, key=None, value=None):
+        self.pending[kind].append((key, time.perf_counter(), value))
+        self.stats.sent[kind] += 1
+        self.conn.send(packet)
+
+    def token(self):
+        self.sequence += 1
+        return f'loadgen message {self.index}-{self.sequence}'
+
+    def send_ms(self):
+        if self.char_id == -1:
+            return self.send_ct()
+        text = self.token()
+        self.send('ms', f'MS#chat#-#{self.chars[self.char_id]}#normal#{text}'
+                        f'#wit#1#0#{self.char_id}#0#0#0#0#0#0#%', text)
+
+    def send_ct(self):
+        text = self.token()
+        self.send('ct', f'CT#{self.name}#{text}#%', text)
+
+    def send_mc(self):
+        if self.char_id == -1 or len(self.songs) == 0:
+            return self.send_ct()
+        song = random.choice(self.songs)
+        self.send('mc', f'MC#{song}#{self.char_id}#%', song)
+
+    def send_area(self):
+        if self.area_count < 2:
+            return self.send_ct()
+        area_id = random.choice([i for i in range(self.area_count)
+                                 if i != self.area_id])
+        self.send('area', f'CT#{self.name}#/area {area_id}#%',
+                  value=area_id)
+
+    def send_check(self):
+        self.send('check', f'CH#{self.char_id}#%')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(stats, elapsed):
+    print(f'{"kind":<8}{"sent":>8}{"answered":>10}{"lost":>7}'
+          f'{"p50 ms":>9}{"p99 ms":>9}')
+    all_latencies = []
+    for kind in KINDS + ('all',):
+        if kind == 'all':
+            latencies = all_latencies
+            sent = sum(stats.sent.values())
+            lost = sum(stats.lost.values())
+        else:
+            latencies = stats.latencies[kind]
+            all_latencies.extend(latencies)
+            sent = stats.sent[kind]
+            lost = stats.lost[kind]
+        if sent == 0:
+            continue
+        p50 = p99 = '-'
+        if latencies:
+            p50 = f'{percentile(latencies, 0.5) * 1000:.1f}'
+            p99 = f'{percentile(latencies, 0.99) * 1000:.1f}'
+        print(f'{kind:<8}{sent:>8}{len(latencies):>10}{lost:>7}'
+              f'{p50:>9}{p99:>9}')
+    print()
+    if stats.handshakes:
+        print(f'Handshakes: {len(stats.handshakes)}, '
+              f'p50 {percentile(stats.handshakes, 0.5) * 1000:.1f} ms, '
+              f'p99 {percentile(stats.handshakes, 0.99) * 1000:.1f} ms')
+    if stats.failed or stats.refused:
+        print(f'Failed to connect: {stats.failed}, refused: {stats.refused} '
+              '(check multiclient_limit and playerlimit)')
+    print(f'Throughput: {sum(stats.sent.values()) / elapsed:.0f} packets/s '
+          f'sent, {stats.received / elapsed:.0f} packets/s received')
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(
+                f'unknown traffic kind {kind!r}; use {", ".join(KINDS)}')
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+async def swarm(args):
+    stats = Stats()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    bots = []
+    for index in range(args.clients):
+        bots.append(asyncio.ensure_future(
+            Bot(index, args, stats).run(deadline)))
+        # Spread the connections over the first second.
+        await asyncio.sleep(1 / args.clients)
+    await asyncio.gather(*bots)
+    report(stats, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate a swarm of AO2 clients against a server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int,
+                        help='server port (default: 27016, or 50001 '
+                             'with --websocket)')
+    parser.add_argument('--websocket', action='store_true',
+                        help='connect over websockets like webAO')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds of traffic')
+    parser.add_argument('--rate', type=float, default=2,
+                        help='packets per second sent by each client')
+    parser.add_argument('--mix', type=parse_mix,
+                        default='ms=4,ct=3,mc=1,area=1,check=1',
+                        help='relative weights of the kinds of traffic')
+    parser.add_argument('--timeout', type=float, default=5,
+                        help='seconds to wait for an answer')
+    args = parser.parse_args()
+    if args.port is None:
+        args.port = 50001 if args.websocket else 27016
+    try:
+        asyncio.run(swarm(args))
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+Replays a traffic capture, recorded with the `capture` option of
+config.yaml, against a fresh server to reproduce a problem or to
+measure how fast the server handles that traffic.
+
+    python -m scripts.replay logs/capture.bin [--config config]
+                             [--speed 1] [--limit 100000]
+
+Run this from the server's root directory. The server is built from
+the given config folder in a scratch directory, with an in-memory
+database, so neither the real database nor the real logs are touched.
+It runs on a fake clock that follows the timestamps of the capture, so
+floodguards, IC message delays and timers behave as they did when the
+traffic was recorded, however fast it is replayed. By default the
+capture is replayed as fast as possible; pass --speed 1 to replay it
+at the pace it was recorded.
+
+Replies can still differ from the captured ones, e.g. because bans and
+other records are not in the in-memory database, or because of dice
+rolls; the report compares the number of packets sent with the capture.
+"""
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from server import capture
+from server.logger import quiet_console, stop_logger
+
+
+class FakeClock:
+    """Stands in for the wall and monotonic clocks of the server."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def install(self):
+        # The event loop reads time.monotonic too, so its timers follow
+        # this clock as well.
+        import server.network.aoprotocol
+        time.time = self.time
+        time.monotonic = self.monotonic
+        server.network.aoprotocol.time = self.time
+
+
+class ReplayTransport(asyncio.Transport):
+    """Takes the place of a client's socket."""
+
+    def __init__(self, loop, protocol, address, stats):
+        super().__init__()
+        self.loop = loop
+        self.protocol = protocol
+        self.address = address
+        self.stats = stats
+        self.closing = False
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return (self.address, 0)
+        return default
+
+    def write(self, data):
+        self.stats.sent += 1
+        self.stats.sent_bytes += len(data)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.loop.call_soon(self.protocol.connection_lost, None)
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+class Stats:
+    def __init__(self):
+        self.connections = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.captured_sent = 0
+
+
+def make_scratch_dir(path, config_dir):
+    shutil.copytree(config_dir, os.path.join(path, 'config'))
+    shutil.copytree('migrations', os.path.join(path, 'migrations'))
+    for name in ('logs', 'storage', 'characters'):
+        os.mkdir(os.path.join(path, name))
+
+
+def build_server(loop):
+    from server import database
+    from server.tsuserver import TsuServer3
+    database.DB_FILE = ':memory:'
+    server = TsuServer3()
+    # The server logs every event to the console as well; that would
+    # measure the terminal rather than the server.
+    quiet_console()
+    server.config['use_masterserver'] = False
+    server.config['log_retention'] = {'enabled': False}
+    server.config['metrics'] = {'enabled': False}
+    server.loop = loop
+    server.start_tasks()
+    return server
+
+
+def run_due(loop):
+    """Run the callbacks and timers that are due on the fake clock."""
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+
+
+def replay(records, clock, loop, speed, limit):
+    from server.network.aoprotocol import AOProtocol
+    server = build_server(loop)
+    stats = Stats()
+    protocols = {}
+    first = None
+    start = time.perf_counter()
+
+    for timestamp, connection, kind, payload in records:
+        if first is None:
+            first = timestamp
+        if speed is not None:
+            delay = (timestamp - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        clock.now = max(clock.now, timestamp)
+        run_due(loop)
+
+        protocol = protocols.get(connection)
+        if kind == capture.CONNECT:
+            if protocol is not None:
+                # A previous run of the server used the same number.
+                protocol.transport.close()
+            protocol = AOProtocol(server)
+            protocol.transport = ReplayTransport(
+                loop, protocol, payload.decode('utf-8'), stats)
+            protocols[connection] = protocol
+            stats.connections += 1
+            protocol.connection_made(protocol.transport)
+        elif protocol is None:
+            # The connection started before the oldest segment.
+            continue
+        elif kind == capture.INBOUND:
+            if protocol.transport.is_closing():
+                continue
+            stats.received += 1
+            stats.received_bytes += len(payload)
+            try:
+                protocol.data_received(payload)
+            except Exception:
+                logging.getLogger('debug').exception('Replay error')
+        elif kind == capture.OUTBOUND:
+            stats.captured_sent += 1
+        elif kind == capture.CLOSE:
+            protocol.transport.close()
+            del protocols[connection]
+
+        if limit is not None and stats.received >= limit:
+            break
+
+    for protocol in protocols.values():
+        protocol.transport.close()
+    run_due(loop)
+    return stats, time.perf_counter() - start, \
+        (clock.now - first if first is not None else 0)
+
+
+def report(stats, elapsed, captured):
+    print(f'Replayed {stats.connections} connections, {stats.received} '
+          f'packets ({stats.received_bytes} bytes) in {elapsed:.2f}s; '
+          f'the capture covers {captured:.1f}s.')
+    if elapsed > 0:
+        print(f'Throughput: {stats.received / elapsed:.0f} packets/s '
+              f'received, {stats.sent / elapsed:.0f} packets/s sent')
+    print(f'Sent {stats.sent} packets ({stats.sent_bytes} bytes); '
+          f'the capture has {stats.captured_sent}.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a traffic capture against a fresh server.')
+    parser.add_argument('capture', help='path of the capture, as set in '
+                                        'config.yaml (older segments are '
+                                        'read too)')
+    parser.add_argument('--config', default='config',
+                        help='config folder to build the server from')
+    parser.add_argument('--speed', type=float,
+                        help='replay at this multiple of the recorded pace '
+                             '(default: as fast as possible)')
+    parser.add_argument('--limit', type=int,
+                        help='stop after this many received packets')
+    args = parser.parse_args()
+    if args.speed is not None and args.speed <= 0:
+        parser.error('--speed must be positive')
+
+    path = os.path.abspath(args.capture)
+    if not capture.segment_paths(path):
+        print(f'error: no capture at {args.capture}', file=sys.stderr)
+        sys.exit(1)
+
+    records = capture.read_capture(path)
+    try:
+        first = next(records)
+    except StopIteration:
+        print('The capture is empty.')
+        return
+    except ValueError as exc:
+        print(f'error: {exc}', file=sys.stderr)
+        sys.exit(1)
+
+    def all_records():
+        yield first
+        yield from records
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        make_scratch_dir(scratch, os.path.abspath(args.config))
+        os.chdir(scratch)
+        try:
+            clock = FakeClock(first[0])
+            clock.install()
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            stats, elapsed, captured = replay(all_records(), clock, loop,
+                                              args.speed, args.limit)
+        finally:
+            stop_logger()
+            logging.shutdown()
+            os.chdir(cwd)
+    report(stats, elapsed, captured)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,7 +23,7 @@ import yaml
 
 from dataclasses import dataclass
 from enum import Enum
-from typing import List
+from typing import List, Tuple
 
 from server import database
 from server.exceptions import AreaError
@@ -31,7 +31,22 @@ from server.evidence import EvidenceList
 from server.client_manager import ClientManager
 
 
+def _packet(command: str, *args) -> str:
+    """Encode a packet the same way `Client.send_command` does."""
+    return f'{command}#{"#".join([str(x) for x in args])}#%'
+
+
 class AreaManager:
+    @dataclass(frozen=True)
+    class JoinSnapshot:
+        """
+        Encoded packets that bring a client entering an area up to date.
+        Running timers cannot be encoded ahead of time, so they are kept
+        as (timer ID, timer) pairs in between the encoded packets.
+        """
+        timers: Tuple
+        penalties: Tuple[str, str]
+
     @dataclass
     class Timer:
         set: bool = False
@@ -56,9 +71,11 @@ class AreaManager:
                      shouts_allowed=True,
                      jukebox=False,
                      abbreviation='',
-                     non_int_pres_only=False):
+                     non_int_pres_only=False,
+                     floodguard=None):
             self.iniswap_allowed = iniswap_allowed
             self.clients = set()
+            self.mods = set()
             self.invite_list = {}
             self.id = area_id
             self.name = name
@@ -92,12 +109,14 @@ class AreaManager:
             self.is_locked = self.Locked.FREE
             self.blankposting_allowed = True
             self.non_int_pres_only = non_int_pres_only
+            self.floodguard = floodguard or {}
             self.jukebox = jukebox
-            self.jukebox_votes = []
+            self.jukebox_votes = self.JukeboxQueue()
             self.jukebox_prev_char_id = -1
 
             # Timers ID 1 thru 4, (indexes 0 to 3 in area), timer ID 0 is global.
             self.timers = [AreaManager.Timer() for _ in range(4)]
+            self._join_snapshot = None
 
             self.owners = []
             self.DJs = []
@@ -121,54 +140,96 @@ class AreaManager:
         def new_client(self, client: ClientManager.Client):
             """Add a client to the area."""
             self.clients.add(client)
+            if client.is_mod:
+                self.mods.add(client)
             self.server.area_manager.send_arup_players()
             if client.char_id != -1:
                 database.log_room('area.join', client, self)
             
-            # Update the timers
-            timer = self.server.area_manager.timer
-            if timer.set:
-                s = int(not timer.started)
-                current_time = timer.static
-                if timer.started:
-                    current_time = timer.target - arrow.get()
-                int_time = int(current_time.total_seconds()) * 1000
-                # Unhide the timer
-                client.send_command('TI', 0, 2)
-                # Start the timer
-                client.send_command('TI', 0, s, int_time)
-            else:
-                # Stop the timer
-                client.send_command('TI', 0, 3, 0)
-                # Hide the timer
-                client.send_command('TI', 0, 1)
-
-            for timer_id, timer in enumerate(self.timers):
-                # Send static time if applicable
-                if timer.set:
-                    s = int(not timer.started)
-                    current_time = timer.static
-                    if timer.started:
-                        current_time = timer.target - arrow.get()
-                    int_time = int(current_time.total_seconds()) * 1000
-                    # Start the timer
-                    client.send_command('TI', timer_id+1, s, int_time)
+            snapshot = self.join_snapshot()
+            for packet in snapshot.timers:
+                if isinstance(packet, str):
+                    client.send_packet(packet)
+                else:
+                    self.send_running_timer(client, *packet)
+
+        def join_snapshot(self) -> 'AreaManager.JoinSnapshot':
+            """Get the timer and penalty packets for clients entering the
+            area, encoding them again only if they have changed since."""
+            if self._join_snapshot is None:
+                timers = []
+                global_timer = self.server.area_manager.timer
+                if global_timer.started:
+                    timers.append((0, global_timer))
+                elif global_timer.set:
+                    int_time = int(global_timer.static.total_seconds()) * 1000
                     # Unhide the timer
-                    client.send_command('TI', timer_id+1, 2)
-                    client.send_ooc(f'Timer {timer_id+1} is at {current_time}')
+                    timers.append(_packet('TI', 0, 2))
+                    # Set the timer
+                    timers.append(_packet('TI', 0, 1, int_time))
                 else:
                     # Stop the timer
-                    client.send_command('TI', timer_id+1, 1, 0)
+                    timers.append(_packet('TI', 0, 3, 0))
                     # Hide the timer
-                    client.send_command('TI', timer_id+1, 3)
+                    timers.append(_packet('TI', 0, 1))
+
+                for timer_id, timer in enumerate(self.timers, 1):
+                    if timer.started:
+                        timers.append((timer_id, timer))
+                    elif timer.set:
+                        int_time = int(timer.static.total_seconds()) * 1000
+                        # Set the timer
+                        timers.append(_packet('TI', timer_id, 1, int_time))
+                        # Unhide the timer
+                        timers.append(_packet('TI', timer_id, 2))
+                        timers.append(_packet(
+                            'CT', self.server.config['hostname'],
+                            f'Timer {timer_id} is at {timer.static}', '1'))
+                    else:
+                        # Stop the timer
+                        timers.append(_packet('TI', timer_id, 1, 0))
+                        # Hide the timer
+                        timers.append(_packet('TI', timer_id, 3))
+
+                self._join_snapshot = AreaManager.JoinSnapshot(
+                    tuple(timers),
+                    (_packet('HP', 1, self.hp_def),
+                     _packet('HP', 2, self.hp_pro)))
+            return self._join_snapshot
+
+        def invalidate_join_snapshot(self):
+            """Discard the join snapshot after the area's timers or
+            penalties change."""
+            self._join_snapshot = None
+
+        @staticmethod
+        def send_running_timer(client: ClientManager.Client, timer_id: int,
+                               timer: 'AreaManager.Timer'):
+            """Send the remaining time of a running timer to a client."""
+            current_time = timer.target - arrow.get()
+            int_time = int(current_time.total_seconds()) * 1000
+            if timer_id == 0:
+                # Unhide the timer
+                client.send_command('TI', 0, 2)
+                # Start the timer
+                client.send_command('TI', 0, 0, int_time)
+            else:
+                # Start the timer
+                client.send_command('TI', timer_id, 0, int_time)
+                # Unhide the timer
+                client.send_command('TI', timer_id, 2)
+                client.send_ooc(f'Timer {timer_id} is at {current_time}')
 
         def remove_client(self, client: ClientManager.Client):
             """Remove a disconnected client from the area.
             Args:
                 client (ClientManager.Client): Client to remove
             """
-
+            if client not in self.clients:
+                # Arriving from an area owned by another worker process
+                return
             self.clients.remove(client)
+            self.mods.discard(client)
             if client in self.afkers:
                 self.afkers.remove(client)
             if len(self.clients) == 0:
@@ -267,6 +328,24 @@ class AreaManager:
                 '[' + self.abbreviation + ']' + self.server.config['hostname'],
                 msg, '1')
 
+        def floodguard_config(self, kind: str):
+            """Get the limits of a flood guard in this area.
+            Args:
+                kind (str): flood guard name, e.g. 'wtce' for `wtce_floodguard`
+            Returns:
+                (times_per_interval, interval_length, mute_length), or None
+                if the flood guard is disabled
+            """
+
+            config = self.server.config.get(f'{kind}_floodguard') or {}
+            if kind in self.floodguard:
+                config = {**config, **self.floodguard[kind]}
+            if config.get('times_per_interval', 0) <= 0:
+                return None
+            return (config['times_per_interval'],
+                    config.get('interval_length', 0),
+                    config.get('mute_length', 0))
+
         def set_next_msg_delay(self, msg_length: int):
             """Set the delay when the next IC message can be send by any client.
             Args:
@@ -315,7 +394,7 @@ class AreaManager:
                 self.remove_jukebox_vote(client, False)
             else:
                 self.remove_jukebox_vote(client, True)
-                self.jukebox_votes.append(
+                self.jukebox_votes.add(
                     self.JukeboxVote(client, music_name, length, showname))
                 client.send_ooc('Your song was added to the jukebox.')
                 if len(self.jukebox_votes) == 1:
@@ -330,9 +409,7 @@ class AreaManager:
 
             if not self.jukebox:
                 return
-            for current_vote in self.jukebox_votes:
-                if current_vote.client.id == client.id:
-                    self.jukebox_votes.remove(current_vote)
+            self.jukebox_votes.remove(client)
             if not silent:
                 client.send_ooc(
                     'You removed your song from the jukebox.')
@@ -341,18 +418,7 @@ class AreaManager:
             """Randomly choose a track from the jukebox."""
             if not self.jukebox:
                 return
-            if len(self.jukebox_votes) == 0:
-                return None
-            elif len(self.jukebox_votes) == 1:
-                return self.jukebox_votes[0]
-            else:
-                weighted_votes = []
-                for current_vote in self.jukebox_votes:
-                    i = 0
-                    while i < current_vote.chance:
-                        weighted_votes.append(current_vote)
-                        i += 1
-                return random.choice(weighted_votes)
+            return self.jukebox_votes.pick()
 
         def start_jukebox(self):
             """Initialize jukebox mode if needed and play the next track."""
@@ -397,7 +463,7 @@ class AreaManager:
 
             if self.music_looper:
                 self.music_looper.cancel()
-            self.music_looper = asyncio.get_event_loop().call_later(
+            self.music_looper = self.server.loop.call_later(
                 vote_picked.length, lambda: self.start_jukebox())
 
         def play_music(self, name: str, cid: int, loop: int = 0, showname: str ="", effects: int = 0):
@@ -454,6 +520,7 @@ class AreaManager:
                 self.hp_def = val
             elif side == 2:
                 self.hp_pro = val
+            self.invalidate_join_snapshot()
             self.send_command('HP', side, val)
 
         def change_background(self, bg: str):
@@ -556,13 +623,23 @@ class AreaManager:
             client.evi_list, evi_list = self.evi_list.create_evi_list(client)
             return evi_list
 
+        def send_evidence_list(self, client: ClientManager.Client):
+            """Send the evidence list of the area to a client.
+            Args:
+                client (ClientManager.Client): recipient
+            """
+            client.evi_list, _, packet = self.evi_list.render(client)
+            client.send_packet(packet)
+
         def broadcast_evidence_list(self):
             """
             Broadcast an updated evidence list.
             LE#<name>&<desc>&<img>#<name>
+            Each distinct list is rendered once and shared by every client
+            of the same viewer class.
             """
             for client in self.clients:
-                client.send_command('LE', *self.get_evidence_list(client))
+                self.send_evidence_list(client)
 
         def get_cms(self) -> str:
             """Get a list of CMs.
@@ -579,11 +656,7 @@ class AreaManager:
 
 
         def get_mods(self):
-            mods = []
-            for client in self.clients:
-                if client.is_mod:
-                    mods.append(client)
-            return mods
+            return list(self.mods)
 
         class Testimony:
             """Represents a complete group of statements to be pressed or objected to."""
@@ -840,6 +913,46 @@ class AreaManager:
                 self.chance = 1
                 self.showname = showname
 
+        class JukeboxQueue:
+            """
+            The votes cast for the jukebox, at most one per client, in the
+            order they were cast.
+            """
+            def __init__(self):
+                self.votes = {}
+
+            def __len__(self):
+                return len(self.votes)
+
+            def __iter__(self):
+                return iter(self.votes.values())
+
+            def add(self, vote):
+                """Cast a vote, replacing the client's previous one."""
+                self.votes.pop(vote.client.id, None)
+                self.votes[vote.client.id] = vote
+
+            def remove(self, client):
+                """Remove the vote of a client, if it has one."""
+                self.votes.pop(client.id, None)
+
+            def clear(self):
+                self.votes.clear()
+
+            def pick(self):
+                """Randomly choose a vote, weighted by the chance of each.
+                If every vote has just been played, choose among them
+                evenly."""
+                if len(self.votes) == 0:
+                    return None
+                votes = list(self.votes.values())
+                if len(votes) == 1:
+                    return votes[0]
+                weights = [vote.chance for vote in votes]
+                if sum(weights) == 0:
+                    return random.choice(votes)
+                return random.choices(votes, weights)[0]
+
     def __init__(self, server):
         self.server = server
         self.cur_id = 0
@@ -847,6 +960,12 @@ class AreaManager:
         self.load_areas()
         self.timer = AreaManager.Timer()
 
+    def invalidate_join_snapshot(self):
+        """Discard the join snapshots of all areas after the global timer
+        changes."""
+        for area in self.areas:
+            area.invalidate_join_snapshot()
+
     def load_areas(self):
         """Create all areas from a YAML file."""
         with open('config/areas.yaml', 'r') as chars:
@@ -866,6 +985,8 @@ class AreaManager:
                 item['jukebox'] = False
             if 'noninterrupting_pres' not in item:
                 item['noninterrupting_pres'] = False
+            if 'floodguard' not in item:
+                item['floodguard'] = None
             if 'abbreviation' not in item:
                 item['abbreviation'] = self.abbreviate(
                     item['area'])
@@ -876,7 +997,8 @@ class AreaManager:
                           item['iniswap_allowed'],
                           item['showname_changes_allowed'],
                           item['shouts_allowed'], item['jukebox'],
-                          item['abbreviation'], item['noninterrupting_pres']))
+                          item['abbreviation'], item['noninterrupting_pres'],
+                          item['floodguard']))
             self.cur_id += 1
 
     def default_area(self):
@@ -940,9 +1062,14 @@ class AreaManager:
             cmd (str): command name
         """
 
+        shard = self.server.shard
         for a_id in area_ids:
-            self.get_area_by_id(a_id).send_command(cmd, *args)
-            self.get_area_by_id(a_id).send_owner_command(cmd, *args)
+            area = self.get_area_by_id(a_id)
+            if shard is None or shard.owns(area):
+                area.send_command(cmd, *args)
+                area.send_owner_command(cmd, *args)
+        if shard is not None:
+            shard.send_remote_command(area_ids, cmd, args)
 
     def send_arup_players(self):
         """Broadcast ARUP packet containing player counts."""
@@ -976,7 +1103,7 @@ class AreaManager:
         self.server.send_arup(lock_list)
 
     def mods_online(self):
-        num = 0
-        for area in self.areas:
-            num += len(area.get_mods())
-        return num
+        count = len(self.server.client_manager.mods)
+        if self.server.shard is not None:
+            count += self.server.shard.remote_mod_count()
+        return count
@@ -0,0 +1,147 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import struct
+import time
+
+# Every segment starts with this, followed by records of a header and
+# a payload. The header holds the wall clock time, the connection
+# number, the kind of record and the length of the payload.
+MAGIC = b'AOCAP\x01'
+HEADER = struct.Struct('<dIBI')
+
+# Kinds of records
+CONNECT = 0  # payload: the peer address
+INBOUND = 1  # payload: bytes received from the client
+OUTBOUND = 2  # payload: bytes sent to the client
+CLOSE = 3  # no payload
+
+
+class TrafficRecorder:
+    """
+    Records the traffic of every connection into a rotating set of
+    binary segments, for replaying it later with `scripts/replay.py`.
+
+    The current segment is `path`; full segments are renamed to
+    `path.1`, `path.2` and so on up to `segments - 1`, and the oldest
+    one is deleted, so the capture never takes more than about
+    `segments * segment_size` bytes of disk space.
+    """
+
+    def __init__(self, config):
+        self.path = config.get('path', 'logs/capture.bin')
+        self.segment_size = config.get('segment_size', 64 * 1024 * 1024)
+        self.segments = max(1, config.get('segments', 4))
+        # Seconds between flushes of the file buffer
+        self.flush_interval = config.get('flush_interval', 1)
+        self.next_connection = 0
+        self.file = None
+        self.size = 0
+        self.last_flush = 0
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if os.path.exists(self.path):
+            # Keep the capture of the previous run as an older segment.
+            self.rotate()
+        else:
+            self.open()
+
+    def open(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+        oldest = f'{self.path}.{self.segments - 1}'
+        if self.segments == 1:
+            oldest = self.path
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(self.segments - 2, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.rename(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.segments > 1:
+            os.rename(self.path, f'{self.path}.1')
+        self.open()
+
+    def write(self, connection, kind, payload=b''):
+        if self.size + HEADER.size + len(payload) > self.segment_size and \
+                self.size > len(MAGIC):
+            self.rotate()
+        now = time.time()
+        self.file.write(HEADER.pack(now, connection, kind, len(payload)))
+        self.file.write(payload)
+        self.size += HEADER.size + len(payload)
+        if now - self.last_flush > self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def connect(self, address):
+        """Record a new connection. Returns its number in the capture."""
+        connection = self.next_connection
+        self.next_connection = (self.next_connection + 1) % 2**32
+        self.write(connection, CONNECT, address.encode('utf-8'))
+        return connection
+
+    def inbound(self, connection, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.write(connection, INBOUND, data)
+
+    def outbound(self, connection, msg):
+        self.write(connection, OUTBOUND, msg.encode('utf-8'))
+
+    def close_connection(self, connection):
+        self.write(connection, CLOSE)
+
+    def close(self):
+        self.file.close()
+
+
+def segment_paths(path):
+    """The existing segments of a capture, oldest first."""
+    paths = []
+    i = 1
+    while os.path.exists(f'{path}.{i}'):
+        paths.insert(0, f'{path}.{i}')
+        i += 1
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def read_capture(path):
+    """
+    Yield the records of a capture, oldest first, as tuples of
+    (time, connection, kind, payload). A record cut short at the end
+    of a segment, e.g. because the server was killed, is skipped.
+    """
+    for segment in segment_paths(path):
+        with open(segment, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{segment} is not a traffic capture.')
+            while True:
+                header = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                timestamp, connection, kind, length = HEADER.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length:
+                    break
+                yield timestamp, connection, kind, payload
@@ -0,0 +1,217 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import json
+import os
+import re
+import struct
+import time
+
+# Every segment starts with this, followed by records of a length and
+# a JSON object of that many bytes.
+MAGIC = b'AOCHAT\x01'
+LENGTH = struct.Struct('<I')
+# Every segment has an index next to it, which starts with this,
+# followed by one entry per record: its time, the IPID of the client
+# (-1 for none) and the offset of the record in the segment.
+INDEX_MAGIC = b'AOCIDX\x01'
+INDEX_ENTRY = struct.Struct('<dqQ')
+
+SEGMENT_NAME = re.compile(r'^(.+)-(\d{6})\.log$')
+
+
+class ChatLog:
+    """
+    Logs IC messages and room events as sequential appends to a
+    directory of segments, instead of inserting rows into the database.
+
+    Segments are named `<name>-000001.log`, `<name>-000002.log` and so
+    on, each with an index, `<name>-000001.idx`, that is small enough
+    to scan for the records of an IPID or a time range. Each process
+    writes under its own name, so area workers never share a file.
+    """
+
+    def __init__(self, config, name='chat'):
+        self.directory = config.get('directory', 'logs/chat')
+        self.segment_size = config.get('segment_size', 64 * 1024 * 1024)
+        # Seconds between flushes of the file buffers
+        self.flush_interval = config.get('flush_interval', 1)
+        self.name = name
+        self.file = None
+        self.index = None
+        self.size = 0
+        self.last_flush = 0
+        os.makedirs(self.directory, exist_ok=True)
+        numbers = [number for _, number in _segments(self.directory)
+                   .get(name, [])]
+        # Never append to a segment of a previous run, which may end
+        # with a record cut short.
+        self.number = max(numbers, default=0)
+        self.open()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f'{self.name}-{number:06d}.log')
+
+    def open(self):
+        self.number += 1
+        path = self.segment_path(self.number)
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+        self.index = open(path[:-len('.log')] + '.idx', 'wb')
+        self.index.write(INDEX_MAGIC)
+
+    def rotate(self):
+        self.close()
+        self.open()
+
+    def write(self, ipid, entry):
+        now = time.time()
+        entry['event_time'] = now
+        data = json.dumps(entry, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+        if self.size + LENGTH.size + len(data) > self.segment_size and \
+                self.size > len(MAGIC):
+            self.rotate()
+        self.index.write(INDEX_ENTRY.pack(
+            now, ipid if ipid is not None else -1, self.size))
+        self.file.write(LENGTH.pack(len(data)))
+        self.file.write(data)
+        self.size += LENGTH.size + len(data)
+        if now - self.last_flush > self.flush_interval:
+            self.flush()
+            self.last_flush = now
+
+    def log_ic(self, client, room, showname, message):
+        self.write(client.ipid, {
+            'kind': 'ic', 'ipid': client.ipid, 'room_name': room.abbreviation,
+            'char_name': client.char_name, 'ic_name': showname,
+            'message': message,
+        })
+
+    def log_room(self, event_subtype, client, room, message=None,
+                 target=None):
+        ipid, char_name, ooc_name = (client.ipid, client.char_name,
+                                     client.name) if client is not None else (
+                                         None, None, None)
+        self.write(ipid, {
+            'kind': 'room', 'ipid': ipid, 'room_name': room.abbreviation,
+            'char_name': char_name, 'ooc_name': ooc_name,
+            'event_subtype': event_subtype, 'message': message,
+            'target_ipid': target.ipid if target is not None else None,
+        })
+
+    def flush(self):
+        # Until both are flushed, the index on disk can point past the
+        # end of the segment; readers skip those records.
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.index.close()
+
+
+def _segments(directory):
+    """The segments in a directory as (path, number), oldest first, by
+    the name of the process that wrote them."""
+    writers = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return writers
+    for filename in names:
+        match = SEGMENT_NAME.match(filename)
+        if match is not None:
+            writers.setdefault(match.group(1), []).append(
+                (os.path.join(directory, filename), int(match.group(2))))
+    for segments in writers.values():
+        segments.sort(key=lambda segment: segment[1])
+    return writers
+
+
+def _time_at(index, number):
+    index.seek(len(INDEX_MAGIC) + number * INDEX_ENTRY.size)
+    return INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+
+
+def _read_writer(segments, since, until, ipid, reverse):
+    if reverse:
+        segments = reversed(segments)
+    for path, _ in segments:
+        try:
+            index = open(path[:-len('.log')] + '.idx', 'rb')
+        except FileNotFoundError:
+            continue
+        with index:
+            if index.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(f'{path} has no valid index.')
+            # An entry cut short at the end is left out.
+            count = (os.fstat(index.fileno()).st_size - len(INDEX_MAGIC)) \
+                // INDEX_ENTRY.size
+            if count == 0:
+                continue
+            # Skip segments outside of the time range without reading
+            # their whole index; once a segment is past the end of the
+            # range, so are the ones after it.
+            if until is not None and _time_at(index, 0) > until:
+                if reverse:
+                    continue
+                break
+            if since is not None and _time_at(index, count - 1) < since:
+                if reverse:
+                    break
+                continue
+            index.seek(len(INDEX_MAGIC))
+            entries = list(INDEX_ENTRY.iter_unpack(
+                index.read(count * INDEX_ENTRY.size)))
+        if reverse:
+            entries.reverse()
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a chat log.')
+            for timestamp, entry_ipid, offset in entries:
+                if since is not None and timestamp < since or \
+                        until is not None and timestamp > until or \
+                        ipid is not None and entry_ipid != ipid:
+                    continue
+                file.seek(offset)
+                header = file.read(LENGTH.size)
+                if len(header) < LENGTH.size:
+                    continue
+                length, = LENGTH.unpack(header)
+                data = file.read(length)
+                if len(data) < length:
+                    continue
+                yield json.loads(data)
+
+
+def read_chat_log(directory, since=None, until=None, ipid=None,
+                  reverse=False):
+    """
+    Yield the records of a chat log in order of time, newest first if
+    `reverse` is set. Only the index is read to find the records within
+    `since` and `until` (Unix timestamps) and of `ipid`, if given. A
+    record cut short at the end of a segment, e.g. because the server
+    was killed, is skipped.
+    """
+    streams = [_read_writer(segments, since, until, ipid, reverse)
+               for segments in _segments(directory).values()]
+    return heapq.merge(*streams, key=lambda entry: entry['event_time'],
+                       reverse=reverse)
@@ -26,9 +26,102 @@ import arrow
 from typing import Any, List, Dict
 from heapq import heappop, heappush
 
+import logging
+logger = logging.getLogger('debug')
+
 from server import database
 from server.constants import TargetType
 from server.exceptions import ClientError, AreaError
+from server.prefix_index import PrefixIndex
+from server.ratelimit import RateLimiter
+
+def _discard(index, key, client):
+    """Remove a client from a dict of sets, dropping the set if empty."""
+    clients = index.get(key)
+    if clients is not None:
+        clients.discard(client)
+        if len(clients) == 0:
+            del index[key]
+
+
+class _LazyAttribute:
+    """
+    A client attribute that lives in a lazily allocated group of related
+    attributes. Reading it before anything in the group has been set
+    returns the default without allocating the group.
+    """
+
+    def __init__(self, group, factory, default):
+        self.group = group
+        self.factory = factory
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, client, owner=None):
+        if client is None:
+            return self
+        state = getattr(client, self.group)
+        if state is None:
+            return self.default
+        return getattr(state, self.name)
+
+    def __set__(self, client, value):
+        state = getattr(client, self.group)
+        if state is None:
+            state = self.factory()
+            setattr(client, self.group, state)
+        setattr(state, self.name, value)
+
+
+class CasingPreferences:
+    """Which case announcements a client subscribed to."""
+    __slots__ = ('casing_cm', 'casing_dj', 'casing_cases', 'casing_def',
+                 'casing_pro', 'casing_jud', 'casing_jur', 'casing_steno')
+
+    def __init__(self):
+        self.casing_cm = False
+        self.casing_dj = False
+        self.casing_cases = ''
+        self.casing_def = False
+        self.casing_pro = False
+        self.casing_jud = False
+        self.casing_jur = False
+        self.casing_steno = False
+
+
+class PairingState:
+    """What a client last showed in IC, for pairing with other characters."""
+    __slots__ = ('charid_pair', 'offset_pair', 'last_sprite', 'flip',
+                 'claimed_folder')
+
+    def __init__(self):
+        self.charid_pair = -1
+        self.offset_pair = 0
+        self.last_sprite = ''
+        self.flip = 0
+        self.claimed_folder = ''
+
+
+class ModerationEffects:
+    """Mutes, curses and fun-mode effects placed on a client by moderators."""
+    __slots__ = ('disemvowel', 'shaken', 'gimp', 'rainbow', 'dank',
+                 'charcurse', 'area_curse', 'area_curse_info', 'is_muted',
+                 'is_ooc_muted')
+
+    def __init__(self):
+        self.disemvowel = False
+        self.shaken = False
+        self.gimp = False
+        self.rainbow = False
+        self.dank = False
+        self.charcurse = ()
+        self.area_curse = None
+        self.area_curse_info = None
+        self.is_muted = False
+        self.is_ooc_muted = False
+
 
 class ClientManager:
     """Holds the list of all clients currently connected to the server."""
@@ -36,80 +129,82 @@ class ClientManager:
         """Represents a single instance of a user.
 
         Clients may only belong to a single room.
+
+        There can be thousands of clients, most of which are spectators,
+        so state that only some clients need is kept in groups that are
+        allocated on first write (see `_LazyAttribute`).
         """
-        
+        __slots__ = (
+            'is_checked', 'transport', '_hdid', 'release', 'major_version',
+            'minor_version', 'id', '_char_id', 'area', 'server', '_name',
+            'showname', 'fake_name', '_is_mod', 'mod_profile_name', 'is_dj',
+            'can_wtce', 'pos', 'evi_list', 'muted_global', 'muted_adverts',
+            'pm_mute', 'ipid', 'gm_save_time',
+            'last_move_time', 'move_delay', 'last_pkt_time', 'capture_id',
+            'ability_dice_set',
+            '_casing', '_pairing', '_effects', '_rate_limiters',
+        )
+
+        # Casing stuff
+        casing_cm = _LazyAttribute('_casing', CasingPreferences, False)
+        casing_dj = _LazyAttribute('_casing', CasingPreferences, False)
+        casing_cases = _LazyAttribute('_casing', CasingPreferences, '')
+        casing_def = _LazyAttribute('_casing', CasingPreferences, False)
+        casing_pro = _LazyAttribute('_casing', CasingPreferences, False)
+        casing_jud = _LazyAttribute('_casing', CasingPreferences, False)
+        casing_jur = _LazyAttribute('_casing', CasingPreferences, False)
+        casing_steno = _LazyAttribute('_casing', CasingPreferences, False)
+
+        # Pairing stuff
+        charid_pair = _LazyAttribute('_pairing', PairingState, -1)
+        offset_pair = _LazyAttribute('_pairing', PairingState, 0)
+        last_sprite = _LazyAttribute('_pairing', PairingState, '')
+        flip = _LazyAttribute('_pairing', PairingState, 0)
+        claimed_folder = _LazyAttribute('_pairing', PairingState, '')
+
+        # Moderation effects
+        disemvowel = _LazyAttribute('_effects', ModerationEffects, False)
+        shaken = _LazyAttribute('_effects', ModerationEffects, False)
+        gimp = _LazyAttribute('_effects', ModerationEffects, False)
+        rainbow = _LazyAttribute('_effects', ModerationEffects, False)
+        dank = _LazyAttribute('_effects', ModerationEffects, False)
+        charcurse = _LazyAttribute('_effects', ModerationEffects, ())
+        area_curse = _LazyAttribute('_effects', ModerationEffects, None)
+        area_curse_info = _LazyAttribute('_effects', ModerationEffects, None)
+        is_muted = _LazyAttribute('_effects', ModerationEffects, False)
+        is_ooc_muted = _LazyAttribute('_effects', ModerationEffects, False)
+
         def __init__(self, server, transport: asyncio.Transport, user_id: int, ipid: int):
             self.is_checked = False
             self.transport = transport
-            self.hdid = ''
+            self._hdid = ''
             self.release = ''
             self.major_version = ''
             self.minor_version = ''
             self.id = user_id
-            self.char_id = -1
+            self._char_id = -1
             self.area = server.area_manager.default_area()
             self.server = server
-            self.name = ''
+            self._name = ''
             self.showname = ''
             self.fake_name = ''
-            self.is_mod = False
+            self._is_mod = False
             self.mod_profile_name = None
             self.is_dj = True
             self.can_wtce = True
             self.pos = ''
             self.evi_list = []
-            self.disemvowel = False
-            self.shaken = False
-            self.gimp = False
-            self.charcurse = []
-            self.area_curse = None
-            self.area_curse_info = None
             self.muted_global = False
             self.muted_adverts = False
-            self.is_muted = False
-            self.is_ooc_muted = False
             self.pm_mute = False
-            self.mod_call_time = 0
             self.ipid = ipid
-            self.rainbow = False
-            self.dank = False
-
-            # Pairing stuff
-            self.charid_pair = -1
-            self.offset_pair = 0
-            self.last_sprite = ''
-            self.flip = 0
-            self.claimed_folder = ''
-
-            # Casing stuff
-            self.casing_cm = False
-            self.casing_dj = False
-            self.casing_cases = ''
-            self.casing_def = False
-            self.casing_pro = False
-            self.casing_jud = False
-            self.casing_jur = False
-            self.casing_steno = False
-            self.case_call_time = 0
-
-            # flood-guard stuff
-            self.mus_counter = 0
-            self.mus_mute_time = 0
-            self.mus_change_time = [
-                x * self.server.config['music_change_floodguard']
-                ['interval_length']
-                for x in range(self.server.config['music_change_floodguard']
-                               ['times_per_interval'])
-            ]
-            self.wtce_counter = 0
-            self.wtce_mute_time = 0
-            self.wtce_time = [
-                x * self.server.config['wtce_floodguard']['interval_length']
-                for x in range(self.server.config['wtce_floodguard']
-                               ['times_per_interval'])
-            ]
+
+            self._casing = None
+            self._pairing = None
+            self._effects = None
+            self._rate_limiters = None
+
             # security stuff
-            self.clientscon = 0
             self.gm_save_time = 0
 
             # movement system stuff
@@ -119,14 +214,112 @@ class ClientManager:
             # idle timeout stuff
             self.last_pkt_time = 0
 
+            # Number of the connection in the traffic capture, if recording
+            self.capture_id = None
+
+        # Identifying data that the client manager keeps indexes on
+        @property
+        def name(self) -> str:
+            """Get the client's OOC name."""
+            return self._name
+
+        @name.setter
+        def name(self, name: str):
+            self.server.client_manager.reindex(self, 'name', self._name, name)
+            self._name = name
+
+        @property
+        def char_id(self) -> int:
+            """Get the ID of the client's character (-1 for spectators)."""
+            return self._char_id
+
+        @char_id.setter
+        def char_id(self, char_id: int):
+            self.server.client_manager.reindex(self, 'char_id', self._char_id,
+                                               char_id)
+            self._char_id = char_id
+
+        @property
+        def hdid(self) -> str:
+            """Get the client's hard drive ID."""
+            return self._hdid
+
+        @hdid.setter
+        def hdid(self, hdid: str):
+            self.server.client_manager.reindex(self, 'hdid', self._hdid, hdid)
+            self._hdid = hdid
+
+        @property
+        def is_mod(self) -> bool:
+            """Get whether the client is logged in as a moderator."""
+            return self._is_mod
+
+        @is_mod.setter
+        def is_mod(self, is_mod: bool):
+            self.server.client_manager.reindex(self, 'is_mod', self._is_mod,
+                                               is_mod)
+            self._is_mod = is_mod
+
+        def export_state(self) -> dict:
+            """Get the state needed to recreate the client in another
+            worker process (see server/sharding.py)."""
+            return {attr: getattr(self, attr) for attr in self.__slots__
+                    if attr not in ('transport', 'server', 'area')
+                    and hasattr(self, attr)}
+
+        def check_flood(self, kind: str, record=True) -> float:
+            """Check a flood guard of the client's current area.
+
+            Args:
+                kind (str): which flood guard to check, e.g. 'ic'
+                record (bool, optional): count this as an event if it is
+                    allowed. Defaults to True.
+
+            Returns:
+                float: 0 if allowed, otherwise how many seconds the client
+                must wait
+            """
+            config = self.area.floodguard_config(kind)
+            if config is None:
+                return 0
+            if self._rate_limiters is None:
+                self._rate_limiters = {}
+            # Limiters are kept per configuration, so that moving between
+            # areas with different limits does not reset them.
+            limiter = self._rate_limiters.get((kind, config))
+            if limiter is None:
+                limiter = RateLimiter(*config)
+                self._rate_limiters[(kind, config)] = limiter
+            if record:
+                return limiter.check()
+            return limiter.wait_time()
+
         def send_raw_message(self, msg: str):
             """Send a raw packet over TCP.
 
             Args:
                 msg (str): Message to send
             """
+            # uvloop raises instead of dropping writes to closed
+            # transports, e.g. from timers that outlive the connection.
+            if self.transport.is_closing():
+                return
+            if self.capture_id is not None:
+                self.server.capture.outbound(self.capture_id, msg)
             self.transport.write(msg.encode('utf-8'))
 
+        def send_packet(self, packet: str):
+            """Send a packet that was encoded ahead of time, e.g. to be
+            shared by many clients, as `send_command` would send it.
+
+            Args:
+                packet (str): encoded packet, ending with `#%`
+            """
+            if self.server.metrics is not None:
+                command = packet.split('#', 1)[0]
+                self.server.metrics.packets_sent.labels(command).inc()
+            self.send_raw_message(packet)
+
         def send_command(self, command: str, *args):
             """Compose and send an AO-compatible message, with arguments
             delimited by `#` and ending with `#%`.
@@ -135,6 +328,8 @@ class ClientManager:
                 command (str): command name
                 *args: tuple containing the packet arguments
             """
+            if self.server.metrics is not None:
+                self.server.metrics.packets_sent.labels(command).inc()
             if args:
                 if command == 'MS':
                     for evi_num in range(len(self.evi_list)):
@@ -266,26 +461,7 @@ class ClientManager:
             """
             if self.is_mod:
                 return 0
-            if self.mus_mute_time:
-                if time.time() - self.mus_mute_time < self.server.config[
-                        'music_change_floodguard']['mute_length']:
-                    return self.server.config['music_change_floodguard'][
-                        'mute_length'] - (time.time() - self.mus_mute_time)
-                else:
-                    self.mus_mute_time = 0
-            times_per_interval = self.server.config['music_change_floodguard'][
-                'times_per_interval']
-            interval_length = self.server.config['music_change_floodguard'][
-                'interval_length']
-            if time.time() - self.mus_change_time[
-                (self.mus_counter - times_per_interval + 1) %
-                    times_per_interval] < interval_length:
-                self.mus_mute_time = time.time()
-                return self.server.config['music_change_floodguard'][
-                    'mute_length']
-            self.mus_counter = (self.mus_counter + 1) % times_per_interval
-            self.mus_change_time[self.mus_counter] = time.time()
-            return 0
+            return self.check_flood('music_change')
 
         def wtce_mute(self) -> int:
             """Check if the client can use WT/CE or not.
@@ -295,26 +471,7 @@ class ClientManager:
             """
             if self.is_mod or self in self.area.owners:
                 return 0
-            if self.wtce_mute_time:
-                if time.time() - self.wtce_mute_time < self.server.config[
-                        'wtce_floodguard']['mute_length']:
-                    return self.server.config['wtce_floodguard'][
-                        'mute_length'] - (time.time() - self.wtce_mute_time)
-                else:
-                    self.wtce_mute_time = 0
-            times_per_interval = self.server.config['wtce_floodguard'][
-                'times_per_interval']
-            interval_length = self.server.config['wtce_floodguard'][
-                'interval_length']
-            if time.time() - self.wtce_time[
-                (self.wtce_counter - times_per_interval + 1) %
-                    times_per_interval] < interval_length:
-                self.wtce_mute_time = time.time()
-                return self.server.config['wtce_floodguard'][
-                    'mute_length']
-            self.wtce_counter = (self.wtce_counter + 1) % times_per_interval
-            self.wtce_time[self.wtce_counter] = time.time()
-            return 0
+            return self.check_flood('wtce')
 
         def reload_character(self):
             """Reload the state of the current character."""
@@ -392,19 +549,24 @@ class ClientManager:
                     self.send_ooc(
                             f'Character taken, switched to {self.char_name}.')
 
+            shard = self.server.shard
+            if shard is not None and not shard.owns(area):
+                # The worker that owns the area checks the rest.
+                shard.migrate(self, area)
+                return
+
             self.area.remove_client(self)
             self.area = area
             area.new_client(self)
 
             self.send_ooc(
                     f'Changed area to {area.name} [{self.area.status}].')
-            self.area.send_command('CharsCheck',*self.get_available_char_list())
             self.area.send_command('CharsCheck', *self.get_available_char_list())
             self.area.shadow_status[self.char_id] = [self.ipid, self.hdid]
-            self.send_command('HP', 1, self.area.hp_def)
-            self.send_command('HP', 2, self.area.hp_pro)
+            for packet in self.area.join_snapshot().penalties:
+                self.send_packet(packet)
             self.send_command('BN', self.area.background, self.pos)
-            self.send_command('LE', *self.area.get_evidence_list(self))
+            self.area.send_evidence_list(self)
 
         def send_area_list(self):
             """Send a list of areas over OOC."""
@@ -541,10 +703,10 @@ class ClientManager:
             selection screen, even if the client has already joined.
             """
             self.send_command('CharsCheck', *self.get_available_char_list())
-            self.send_command('HP', 1, self.area.hp_def)
-            self.send_command('HP', 2, self.area.hp_pro)
+            for packet in self.area.join_snapshot().penalties:
+                self.send_packet(packet)
             self.send_command('BN', self.area.background, self.pos)
-            self.send_command('LE', *self.area.get_evidence_list(self))
+            self.area.send_evidence_list(self)
             self.send_command('MM', 1)
 
             self.server.area_manager.send_arup_players()
@@ -626,23 +788,7 @@ class ClientManager:
             self.pos = pos
             self.send_ooc(f'Position set to {pos}.')
             self.send_command('SP', self.pos)  # Send a "Set Position" packet
-            self.send_command('LE', *self.area.get_evidence_list(self))
-
-        def set_mod_call_delay(self):
-            """Begin the mod call cooldown."""
-            self.mod_call_time = round(time.time() * 1000.0 + 30000)
-
-        def can_call_mod(self):
-            """Whether or not the client can currently call mod."""
-            return (time.time() * 1000.0 - self.mod_call_time) > 0
-
-        def set_case_call_delay(self):
-            """Begin the case announcement cooldown."""
-            self.case_call_time = round(time.time() * 1000.0 + 60000)
-
-        def can_call_case(self):
-            """Whether or not the client can currently announce a case."""
-            return (time.time() * 1000.0 - self.case_call_time) > 0
+            self.area.send_evidence_list(self)
 
         def disemvowel_message(self, message):
             """Disemvowel a chat message."""
@@ -686,19 +832,94 @@ class ClientManager:
         self.server = server
         self.cur_id = [i for i in range(self.server.config['playerlimit'])]
 
+        # Indexes for finding targets without scanning every client
+        self.clients_by_id = {}
+        self.clients_by_ipid = {}
+        self.clients_by_hdid = {}
+        self.clients_by_char_id = {}
+        self.ooc_names = PrefixIndex()
+        self.char_names = PrefixIndex()
+        self.index_char_names()
+        self.mods = set()
+
+    def index_char_names(self):
+        """Rebuild the character name index after the character list
+        has been (re)loaded."""
+        self.char_names = PrefixIndex()
+        self.char_names.add('Spectator', -1)
+        for char_id, char_name in enumerate(self.server.char_list):
+            self.char_names.add(char_name, char_id)
+
+    def _index(self, client: Client):
+        self.clients_by_id[client.id] = client
+        self.clients_by_ipid.setdefault(client.ipid, set()).add(client)
+        self.clients_by_char_id.setdefault(client.char_id, set()).add(client)
+        if client.hdid != '':
+            self.clients_by_hdid.setdefault(client.hdid, set()).add(client)
+        self.ooc_names.add(client.name, client)
+        if client.is_mod:
+            self.mods.add(client)
+
+    def _unindex(self, client: Client):
+        del self.clients_by_id[client.id]
+        _discard(self.clients_by_ipid, client.ipid, client)
+        _discard(self.clients_by_char_id, client.char_id, client)
+        _discard(self.clients_by_hdid, client.hdid, client)
+        self.ooc_names.remove(client.name, client)
+        self.mods.discard(client)
+
+    def reindex(self, client: Client, attr: str, old, new):
+        """Update the indexes when identifying data of a client changes.
+
+        Args:
+            client (Client): client being changed
+            attr (str): 'name', 'char_id', 'hdid' or 'is_mod'
+            old: previous value
+            new: new value
+        """
+        if self.clients_by_id.get(client.id) is not client:
+            # Not connected yet, or already gone.
+            return
+        if attr == 'name':
+            self.ooc_names.remove(old, client)
+            self.ooc_names.add(new, client)
+        elif attr == 'char_id':
+            _discard(self.clients_by_char_id, old, client)
+            self.clients_by_char_id.setdefault(new, set()).add(client)
+        elif attr == 'hdid':
+            _discard(self.clients_by_hdid, old, client)
+            if new != '':
+                self.clients_by_hdid.setdefault(new, set()).add(client)
+        elif attr == 'is_mod':
+            area_mods = client.area.mods if client in client.area.clients \
+                else set()
+            if new:
+                self.mods.add(client)
+                area_mods.add(client)
+            else:
+                self.mods.discard(client)
+                area_mods.discard(client)
+
+    def connection_count(self, ipid: int) -> int:
+        """Get the number of clients connected from an IPID."""
+        return len(self.clients_by_ipid.get(ipid, ()))
+
+    @property
+    def player_count(self) -> int:
+        """Get the number of non-spectating clients."""
+        return len(self.clients) - len(self.clients_by_char_id.get(-1, ()))
+
     def new_client_preauth(self, client: Client) -> bool:
         maxclients = self.server.config['multiclient_limit']
-        for c in self.server.client_manager.clients:
-            if c.ipid == client.ipid:
-                if c.clientscon > maxclients:
-                    return False
-        return True
+        return self.connection_count(client.ipid) <= maxclients
 
-    def new_client(self, transport: asyncio.Transport) -> Client:
+    def new_client(self, transport: asyncio.Transport, user_id: int = None) -> Client:
         """Create a new client, add it to the list, and assign it a player ID.
 
         Args:
             transport (asyncio.Transport): Transport to send data across
+            user_id (int, optional): Player ID, if one was already assigned
+            by the supervisor process (see server/sharding.py)
 
         Raises:
             ClientError: The server is full
@@ -706,11 +927,12 @@ class ClientManager:
         Returns:
             Client: The newly constructed client
         """
-        try:
-            user_id = heappop(self.cur_id)
-        except IndexError:
-            transport.write(b'BD#This server is full.#%')
-            raise ClientError
+        if user_id is None:
+            try:
+                user_id = heappop(self.cur_id)
+            except IndexError:
+                transport.write(b'BD#This server is full.#%')
+                raise ClientError
 
         peername = transport.get_extra_info('peername')[0]
 		
@@ -724,10 +946,25 @@ class ClientManager:
             self.server, transport, user_id,
             database.ipid(peername))
         self.clients.add(c)
-        temp_ipid = c.ipid
-        for client in self.server.client_manager.clients:
-            if client.ipid == temp_ipid:
-                client.clientscon += 1
+        self._index(c)
+        return c
+
+    def adopt_client(self, transport: asyncio.Transport, state: dict) -> Client:
+        """Recreate a client that was handed over by another worker
+        process, keeping its player ID.
+
+        Args:
+            transport (asyncio.Transport): Transport to send data across
+            state (dict): State from `Client.export_state`
+
+        Returns:
+            Client: The recreated client
+        """
+        c = self.Client(self.server, transport, state['id'], state['ipid'])
+        for attr, value in state.items():
+            setattr(c, attr, value)
+        self.clients.add(c)
+        self._index(c)
         return c
 
     def remove_client(self, client: Client):
@@ -736,6 +973,19 @@ class ClientManager:
         Args:
             client (Client): Disconnected client
         """
+        self.detach_client(client)
+        if self.server.shard is not None:
+            self.server.shard.release_id(client.id)
+        else:
+            heappush(self.cur_id, client.id)
+
+    def detach_client(self, client: Client):
+        """Remove a client from the client list without giving up its
+        player ID, e.g. when it moves to another worker process.
+
+        Args:
+            client (Client): Client to remove
+        """
         if client.area.jukebox:
             client.area.remove_jukebox_vote(client, True)
         for a in self.server.area_manager.areas:
@@ -746,12 +996,38 @@ class ClientManager:
                 if len(a.owners) == 0:
                     if a.is_locked != a.Locked.FREE:
                         a.unlock()
-        heappush(self.cur_id, client.id)
-        temp_ipid = client.ipid
-        for c in self.server.client_manager.clients:
-            if c.ipid == temp_ipid:
-                c.clientscon -= 1
         self.clients.remove(client)
+        self._unindex(client)
+
+    def check_consistency(self):
+        """Rebuild the client indexes from scratch and compare them to the
+        maintained ones. Any differences are logged and then fixed.
+
+        Returns:
+            bool: True if the indexes were consistent
+        """
+        maintained = (self.clients_by_id, self.clients_by_ipid,
+                      self.clients_by_hdid, self.clients_by_char_id,
+                      self.ooc_names.root, self.mods)
+        self.clients_by_id = {}
+        self.clients_by_ipid = {}
+        self.clients_by_hdid = {}
+        self.clients_by_char_id = {}
+        self.ooc_names = PrefixIndex()
+        self.mods = set()
+        for client in self.clients:
+            self._index(client)
+        rebuilt = (self.clients_by_id, self.clients_by_ipid,
+                   self.clients_by_hdid, self.clients_by_char_id,
+                   self.ooc_names.root, self.mods)
+        names = ('id', 'ipid', 'hdid', 'char_id', 'OOC name', 'mod status')
+        consistent = True
+        for name, old, new in zip(names, maintained, rebuilt):
+            if old != new:
+                consistent = False
+                logger.debug('Client index by %s was inconsistent: '
+                             '%d keys, expected %d', name, len(old), len(new))
+        return consistent
 
     def get_targets(self, client: Client, key: TargetType, value: Any, local=False, single=False) -> List[Client]:
         """Find players by a combination of identifying data.
@@ -769,38 +1045,48 @@ class ClientManager:
             List[Client]: A list containing the targeted clients
         """
 
-        areas = None
-        if local:
-            areas = [client.area]
-        else:
-            areas = client.server.area_manager.areas
-        targets = []
         if key == TargetType.ALL:
-            for nkey in range(6):
-                targets += self.get_targets(client, nkey, value, local)
-        for area in areas:
-            for client in area.clients:
-                if key == TargetType.IP:
-                    if value.lower().startswith(client.ip.lower()):
-                        targets.append(client)
-                elif key == TargetType.OOC_NAME:
-                    if value.lower().startswith(
-                            client.name.lower()) and client.name:
-                        targets.append(client)
-                elif key == TargetType.CHAR_NAME:
-                    if value.lower().startswith(
-                            client.char_name.lower()):
-                        targets.append(client)
-                elif key == TargetType.ID:
-                    if client.id == value:
-                        targets.append(client)
-                elif key == TargetType.IPID:
-                    if client.ipid == value:
-                        targets.append(client)
-                elif key == TargetType.AFK:
-                    if client in area.afkers:
-                        targets.append(client)
-        return targets
+            targets = []
+            for nkey in (TargetType.IP, TargetType.OOC_NAME, TargetType.ID,
+                         TargetType.CHAR_NAME, TargetType.IPID,
+                         TargetType.HDID):
+                for target in self.get_targets(client, nkey, value, local):
+                    if target not in targets:
+                        targets.append(target)
+            return targets
+
+        if key == TargetType.IP:
+            # IP addresses are not exposed, so this matches IPIDs that
+            # the value starts with.
+            value = str(value)
+            candidates = []
+            for end in range(1, len(value) + 1):
+                if value[:end].isdigit():
+                    candidates.extend(self.clients_by_ipid.get(
+                        int(value[:end]), ()))
+        elif key == TargetType.OOC_NAME:
+            candidates = self.ooc_names.prefixes_of(str(value))
+        elif key == TargetType.CHAR_NAME:
+            candidates = []
+            for char_id in self.char_names.prefixes_of(str(value)):
+                candidates.extend(self.clients_by_char_id.get(char_id, ()))
+        elif key == TargetType.ID:
+            candidates = [self.clients_by_id[value]] \
+                if value in self.clients_by_id else []
+        elif key == TargetType.IPID:
+            candidates = self.clients_by_ipid.get(value, ())
+        elif key == TargetType.HDID:
+            candidates = self.clients_by_hdid.get(value, ())
+        elif key == TargetType.AFK:
+            candidates = []
+            for area in self.server.area_manager.areas:
+                candidates.extend(area.afkers)
+        else:
+            return []
+
+        # Only clients that have finished joining an area are targetable.
+        return [c for c in candidates if c in c.area.clients and
+                (not local or c.area == client.area)]
 
     def get_muted_clients(self):
         """Get a list of muted clients."""
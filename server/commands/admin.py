@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from datetime import datetime
 import shlex
+import sqlite3
 import arrow
 import json
 
@@ -9,6 +10,7 @@ from pytimeparse import parse
 from server import database
 from server.constants import TargetType
 from server.exceptions import ClientError, ServerError, ArgumentError
+from server.profiler import SamplingProfiler
 from . import mod_only, list_commands, list_submodules, help
 
 __all__ = [
@@ -31,7 +33,11 @@ __all__ = [
     'ooc_cmd_bans',
     'ooc_cmd_baninfo',
     'ooc_cmd_lastchar',
-    'ooc_cmd_warn'
+    'ooc_cmd_warn',
+    'ooc_cmd_logsearch',
+    'ooc_cmd_throttled',
+    'ooc_cmd_loopdebug',
+    'ooc_cmd_profile'
 ]
 
 
@@ -293,8 +299,19 @@ def kickban(client, arg: str, include_hdid=False):
     ban_id = database.ban(ipid, reason, ban_type='ipid', banned_by=client,
                           ban_id=ban_id, unban_date=unban_date)
 
-    targets = client.server.client_manager.get_targets(
-        client, TargetType.IPID, ipid, False)
+    kicked = _kick_banned(client.server, ipid, ban_id, reason, unban_date,
+                          include_hdid, client)
+    if client.server.shard is not None:
+        # Clients with this IPID in other area workers
+        client.server.shard.call_holders(ipid, _kick_banned, ipid, ban_id,
+                                         reason, unban_date, include_hdid)
+    if kicked:
+        client.send_ooc(f'{kicked} clients were kicked.')
+    client.send_ooc(f'{ipid} was banned. Ban ID: {ban_id}')
+
+def _kick_banned(server, ipid, ban_id, reason, unban_date, include_hdid,
+                 banned_by=None):
+    targets = list(server.client_manager.clients_by_ipid.get(ipid, ()))
 
     for c in targets:
         if include_hdid:
@@ -305,10 +322,8 @@ def kickban(client, arg: str, include_hdid=False):
         msg += f'Until: {unban_time.humanize()}'
         c.send_command('KB', msg)
         c.disconnect()
-        database.log_misc('ban', client, target=c, data={'reason': reason})
-    if targets:
-        client.send_ooc(f'{len(targets)} clients were kicked.')
-    client.send_ooc(f'{ipid} was banned. Ban ID: {ban_id}')
+        database.log_misc('ban', banned_by, target=c, data={'reason': reason})
+    return len(targets)
 
 def _area_uncurse(client, ban_info):
     for ipid in ban_info.ipids:
@@ -498,7 +513,7 @@ def ooc_cmd_mods(client, arg):
     else:
         client.send_ooc(
         "There are {} mods online. {} is in the area.".format(client.server.area_manager.mods_online(),
-                                                              len(client.area.get_mods())))
+                                                              len(client.area.mods)))
 
 
 def ooc_cmd_unmod(client, arg):
@@ -694,3 +709,140 @@ def ooc_cmd_warn(client, arg):
                 'No targets to warn!')
 
 
+
+
+@mod_only()
+def ooc_cmd_logsearch(client, arg):
+    """
+    Search IC messages and OOC chat logs, newest first.
+    Wrap multi-word queries in quotes. A word ending in * matches any
+    word starting with it.
+    Usage: /logsearch "<query>" [page]
+    """
+    try:
+        args = shlex.split(arg)
+    except ValueError:
+        raise ArgumentError('Invalid query. Use /logsearch "<query>" [page]')
+    if len(args) == 0:
+        raise ArgumentError('You must specify a query. Use /logsearch "<query>" [page]')
+    page = 1
+    if len(args) > 1 and args[-1].isdigit():
+        page = max(1, int(args.pop()))
+    query = ' '.join(args)
+    client.send_ooc(f'Searching logs for "{query}"...')
+    client.server.loop.create_task(_logsearch(client, query, page))
+
+
+async def _logsearch(client, query, page, page_size=10):
+    try:
+        rows = await client.server.loop.run_in_executor(
+            None, database.search_logs, query, page_size,
+            (page - 1) * page_size)
+    except ServerError as ex:
+        client.send_ooc(ex)
+        return
+    except sqlite3.Error:
+        client.send_ooc(f'Invalid query "{query}".')
+        return
+
+    if len(rows) == 0:
+        client.send_ooc(f'No results for "{query}" on page {page}.')
+        return
+    msg = f'Results for "{query}" (page {page}):'
+    for row in rows:
+        message = row['message']
+        if len(message) > 100:
+            message = message[:100] + '...'
+        msg += f'\n[{row["event_time"]}][{row["room_name"]}][{row["kind"]}] ' \
+               f'{row["name"]} ({row["ipid"]}): {message}'
+    if len(rows) == page_size:
+        msg += f'\nUse /logsearch "{query}" {page + 1} for more.'
+    client.send_ooc(msg)
+
+
+@mod_only()
+def ooc_cmd_throttled(client, arg):
+    """
+    Show the IPIDs that were throttled most often for flooding the
+    server with packets since it started. Only the 1000 most throttled
+    IPIDs are remembered.
+    Usage: /throttled [count]
+    """
+    try:
+        count = int(arg) if arg else 10
+    except ValueError:
+        raise ArgumentError('Usage: /throttled [count]')
+    throttled = client.server.throttled_ipids.most_common(count)
+    if len(throttled) == 0:
+        client.send_ooc('No one has been throttled.')
+        return
+    msg = 'Most throttled IPIDs:'
+    for ipid, times in throttled:
+        msg += f'\n{ipid}: {times} time(s)'
+    client.send_ooc(msg)
+
+
+@mod_only()
+def ooc_cmd_loopdebug(client, arg):
+    """
+    Turn the debug mode of the event loop on or off. While it is on, callbacks
+    that block the server for too long and coroutines that were never awaited
+    are logged to the console. It slows the server down, so turn it off when
+    you are done.
+    Usage: /loopdebug [on|off]
+    """
+    loop = client.server.loop
+    if arg == '':
+        enabled = not loop.get_debug()
+    elif arg in ('on', 'off'):
+        enabled = arg == 'on'
+    else:
+        raise ArgumentError('Usage: /loopdebug [on|off]')
+    loop.set_debug(enabled)
+    database.log_misc('loopdebug', client, data={'enabled': enabled})
+    client.send_ooc(
+        f'Event loop debug mode is now {"on" if enabled else "off"}.')
+
+
+@mod_only()
+def ooc_cmd_profile(client, arg):
+    """
+    Find out where the server spends its CPU time under its current load.
+    The profiler samples the server's stack until it is stopped, for at most
+    the given number of seconds (default: 60, at most 600), then writes the
+    samples to logs/ for flamegraph.pl or speedscope and shows the busiest
+    handlers. Dump writes the samples so far without stopping.
+    Usage: /profile start [seconds] | stop | dump
+    """
+    args = arg.split()
+    if len(args) == 0 or args[0] not in ('start', 'stop', 'dump') or \
+            (len(args) > 1 and args[0] != 'start') or len(args) > 2:
+        raise ArgumentError('Usage: /profile start [seconds] | stop | dump')
+    profiler = client.server.profiler
+
+    if args[0] == 'start':
+        if profiler is not None and profiler.running:
+            raise ClientError('The profiler is already running.')
+        try:
+            seconds = int(args[1]) if len(args) > 1 else 60
+        except ValueError:
+            raise ArgumentError('Usage: /profile start [seconds]')
+        if not 1 <= seconds <= 600:
+            raise ArgumentError('Profile for 1 to 600 seconds.')
+        profiler = SamplingProfiler()
+        profiler.start(client.server.loop, seconds)
+        client.server.profiler = profiler
+        database.log_misc('profile.start', client, data={'seconds': seconds})
+        client.send_ooc(f'Profiling for {seconds} seconds. '
+                        'Use /profile stop to stop sooner.')
+        return
+
+    if profiler is None:
+        raise ClientError('The profiler has not been started.')
+    if args[0] == 'stop':
+        if not profiler.running:
+            raise ClientError('The profiler is not running.')
+        profiler.stop()
+        database.log_misc('profile.stop', client)
+    profiler.write()
+    client.send_ooc(profiler.summary())
@@ -1,4 +1,5 @@
 import re
+import math
 import random
 
 from server import database
@@ -76,6 +77,7 @@ def ooc_cmd_evidence_mod(client, arg):
         if client.area.evidence_mod == 'HiddenCM':
             for i in range(len(client.area.evi_list.evidences)):
                 client.area.evi_list.evidences[i].pos = 'all'
+            client.area.evi_list.invalidate()
         client.area.evidence_mod = arg
         client.send_ooc(
             f'current evidence mod: {client.area.evidence_mod}')
@@ -296,9 +298,10 @@ def ooc_cmd_anncase(client, arg):
     """
     # XXX: Merge with aoprotocol.net_cmd_casea
     if client in client.area.owners:
-        if not client.can_call_case():
+        wait = client.check_flood('casing', record=False)
+        if wait:
             raise ClientError(
-                'Please wait 60 seconds between case announcements!')
+                f'Please wait {math.ceil(wait)} seconds before announcing another case!')
         args = re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', arg)
         if len(args) == 0:
             raise ArgumentError('Please do not call this command manually!')
@@ -324,7 +327,7 @@ def ooc_cmd_anncase(client, arg):
             client.server.send_all_cmd_pred('CASEA', msg, args[1], args[2],
                                             args[3], args[4], args[5], '1')
 
-            client.set_case_call_delay()
+            client.check_flood('casing')
 
             log_data = {k: v for k, v in
                 zip(('message', 'def', 'pro', 'jud', 'jur', 'steno'), args)}
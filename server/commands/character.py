@@ -173,7 +173,7 @@ def ooc_cmd_charcurse(client, arg):
             for raw_cid in args[1:]:
                 try:
                     cid = int(raw_cid)
-                    c.charcurse.append(cid)
+                    c.charcurse = (*c.charcurse, cid)
                     part_msg += ' ' + str(client.server.char_list[cid]) + ','
                     log_msg += ' ' + str(client.server.char_list[cid]) + ','
                 except:
@@ -207,7 +207,7 @@ def ooc_cmd_uncharcurse(client, arg):
     if targets:
         for c in targets:
             if len(c.charcurse) > 0:
-                c.charcurse = []
+                c.charcurse = ()
                 database.log_room('uncharcurse', client, client.area, target=c)
                 client.send_ooc(f'Uncharcursed [{c.id}].')
                 c.char_select()
@@ -69,7 +69,7 @@ def ooc_cmd_jukebox_toggle(client, arg):
     if len(arg) != 0:
         raise ArgumentError('This command has no arguments.')
     client.area.jukebox = not client.area.jukebox
-    client.area.jukebox_votes = []
+    client.area.jukebox_votes.clear()
     client.area.broadcast_ooc('{} [{}] has set the jukebox to {}.'.format(
         client.char_name, client.id, client.area.jukebox))
     database.log_room('jukebox_toggle', client, client.area,
@@ -1,6 +1,5 @@
 import random
 
-import asyncio
 import arrow
 import datetime
 import pytimeparse
@@ -353,6 +352,11 @@ def ooc_cmd_timer(client, arg):
         else:
             client.area.send_command('TI', timer_id, 3)
 
+    target = client.area
+    if timer_id == 0:
+        target = client.server.area_manager
+    target.invalidate_join_snapshot()
+
     # Send static time if applicable
     if timer.set:
         s = int(not timer.started)
@@ -365,10 +369,6 @@ def ooc_cmd_timer(client, arg):
 
         client.send_ooc(f'Timer {timer_id} is at {timer.static}')
 
-        target = client.area
-        if timer_id == 0:
-            target = client.server.area_manager
-
         def timer_expired():
             if timer.schedule:
                 timer.schedule.cancel()
@@ -378,10 +378,11 @@ def ooc_cmd_timer(client, arg):
             target.broadcast_ooc(f'Timer {timer_id} has expired.')
             timer.static = datetime.timedelta(0)
             timer.started = False
+            target.invalidate_join_snapshot()
             database.log_room('timer.expired', None, target, message=str(timer_id))
 
         if timer.schedule:
             timer.schedule.cancel()
         if timer.started:
-            timer.schedule = asyncio.get_event_loop().call_later(
+            timer.schedule = client.server.loop.call_later(
                 int(timer.static.total_seconds()), timer_expired)
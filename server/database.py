@@ -1,8 +1,10 @@
 import os
+import re
 
-import asyncio
+import time
 import sqlite3
 import json
+import tempfile
 
 import arrow
 
@@ -12,43 +14,97 @@ event_logger = logging.getLogger('events')
 
 from dataclasses import dataclass, field
 from datetime import datetime
-from functools import reduce
 from textwrap import dedent
 from typing import List
 
+from .chatlog import read_chat_log
 from .exceptions import ServerError
+from .jsonstream import iter_object_items
 
 
 DB_FILE = 'storage/db.sqlite3'
+MIGRATIONS_DIR = 'migrations'
+# Log tables that are subject to retention, oldest rows first.
+LOG_TABLES = ('ic_events', 'room_events', 'connect_events', 'misc_events')
+# Seconds of the chat log searched for the last known name of an IPID
+CHAT_LOG_NAME_WINDOW = 24 * 60 * 60
+# Rows per `executemany` call when importing in bulk
+IMPORT_BATCH_SIZE = 1000
+# Bans lifted per query; older SQLite builds allow only 999 parameters
+EXPIRE_BATCH_SIZE = 500
+# Tables included in an export, in an order that satisfies foreign keys
+EXPORT_GROUPS = {
+    'ipids': ('ipids',),
+    'hdids': ('hdids',),
+    'bans': ('bans', 'ip_bans', 'hdid_bans'),
+    'logs': ('room_event_types', 'misc_event_types', 'ic_events',
+             'room_events', 'login_events', 'connect_events', 'misc_events',
+             'message_rollups'),
+}
 _database_singleton = None
 
 def __getattr__(name):
     global _database_singleton
+    if name.startswith('__'):
+        # The import system probes for attributes like `__path__`;
+        # those should not open the database.
+        raise AttributeError(name)
     if _database_singleton is None:
         _database_singleton = Database()
     return getattr(_database_singleton, name)
 
 
+def reset():
+    """
+    Close the connection of this process, if it has one; the next use
+    of the module opens a new one. Used before forking worker processes
+    so that they do not share a connection.
+    """
+    global _database_singleton
+    if _database_singleton is not None:
+        _database_singleton.db.close()
+        _database_singleton = None
+
+
+def _split_sql(script):
+    """Split an SQL script into its individual statements."""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+    if statement.strip() != '':
+        yield statement.strip()
+
+
 class Database:
     """
     Represents a connection to an SQLite database that persists
     information about the server, such as users, bans, and logs.
     """
 
-    def __init__(self):
-        new = not os.path.exists('storage/db.sqlite3')
+    def __init__(self, auto_migrate=True):
+        new = not os.path.exists(DB_FILE)
         self.db = sqlite3.connect(DB_FILE)
         self.db.execute('PRAGMA foreign_keys = ON')
+        # Write-ahead logging lets log searches read from another
+        # connection without blocking writes from the server.
+        self.db.execute('PRAGMA journal_mode = WAL')
         self.db.row_factory = sqlite3.Row
+        self.unban_scheduler = None
+        self.metrics = None
+        self.chat_log = None
         if new:
             self.migrate_json_to_v1()
-        self.migrate()
+        if auto_migrate:
+            self.migrate()
 
     def migrate_json_to_v1(self):
         """Migrate to v1 of the database from JSON."""
         with self.db as conn:
             logger.debug('Initializing database')
-            with open('migrations/v1.sql', 'r') as file:
+            with open(os.path.join(MIGRATIONS_DIR, 'v1.sql'), 'r') as file:
                 conn.executescript(file.read())
 
             if not os.path.exists('storage/ip_ids.json'):
@@ -58,55 +114,61 @@ class Database:
             with open('storage/ip_ids.json', 'r') as ipids_file:
                 # Sometimes, there are multiple IP addresses mapped to
                 # the same IPID, so we have to reassign those IPIDs.
-                ip_ipids = json.loads(ipids_file.read())
-                ipids = set([ipid for ip, ipid in ip_ipids.items()])
-                next_fallback_id = reduce(
-                    lambda max_ipid, ipid: max(max_ipid, ipid), ipids)
-                for ip, ipid in ip_ipids.items():
+                # The files can be huge, so they are read incrementally
+                # and inserted in batches.
+                ipids = set()
+                reassigned = []
+                batch = []
+                for ip, ipid in iter_object_items(ipids_file):
+                    if ipid in ipids:
+                        reassigned.append((ip, ipid))
+                        continue
                     ipids.add(ipid)
-                    effective_id = ipid
-                    while True:
-                        try:
-                            conn.execute(dedent('''
-                                INSERT INTO ipids(ipid, ip_address)
-                                VALUES (?, ?)
-                                '''), (effective_id, ip))
-                        except sqlite3.IntegrityError:
-                            effective_id = next_fallback_id
-                            effective_id += 1
-                            next_fallback_id = effective_id
-                        else:
-                            if effective_id != ipid:
-                                logger.debug(f'IPID {ipid} reassigned to {effective_id}')
-                            break
+                    batch.append((ipid, ip))
+                    if len(batch) >= IMPORT_BATCH_SIZE:
+                        self._insert_ipids(conn, batch)
+                        batch = []
+                self._insert_ipids(conn, batch)
+
+                next_fallback_id = max(ipids, default=0)
+                for ip, ipid in reassigned:
+                    next_fallback_id += 1
+                    self._insert_ipids(conn, [(next_fallback_id, ip)])
+                    logger.debug('IPID %s reassigned to %s', ipid, next_fallback_id)
 
             with open('storage/hd_ids.json', 'r') as hdids_file:
-                hdids = json.loads(hdids_file.read())
-                for hdid, hdid_ipids in hdids.items():
+                batch = []
+                for hdid, hdid_ipids in iter_object_items(hdids_file):
                     for ipid in hdid_ipids:
                         # Sometimes, there are HDID entries that do not
                         # correspond to any IPIDs in the IPID table.
                         if ipid not in ipids:
-                            logger.debug(f'IPID {ipid} in HDID list does not exist. Ignoring.')
+                            logger.debug('IPID %s in HDID list does not exist. Ignoring.', ipid)
                             continue
-                        conn.execute(dedent('''
+                        batch.append((hdid, ipid))
+                    if len(batch) >= IMPORT_BATCH_SIZE:
+                        conn.executemany(dedent('''
                             INSERT OR IGNORE INTO hdids(hdid, ipid)
                             VALUES (?, ?)
-                            '''), (hdid, ipid))
+                            '''), batch)
+                        batch = []
+                conn.executemany(dedent('''
+                    INSERT OR IGNORE INTO hdids(hdid, ipid)
+                    VALUES (?, ?)
+                    '''), batch)
 
             if not os.path.exists('storage/banlist.json'):
-                logger.debug(f'banlist.json not found. Not migrating bans.')
+                logger.debug('banlist.json not found. Not migrating bans.')
                 return
             with open('storage/banlist.json', 'r') as banlist_file:
-                bans = json.load(banlist_file)
-                for ipid, ban_info in bans.items():
+                for ipid, ban_info in iter_object_items(banlist_file):
                     try:
                         ipid = int(ipid)
                     except ValueError:
-                        logger.debug(f'Bad IPID {ipid} in ban list. Ignoring.')
+                        logger.debug('Bad IPID %s in ban list. Ignoring.', ipid)
                         continue
                     if ipid not in ipids:
-                        logger.debug(f'IPID {ipid} in ban list does not exist. Ignoring.')
+                        logger.debug('IPID %s in ban list does not exist. Ignoring.', ipid)
                         continue
                     ban_id = conn.execute(dedent('''
                         INSERT INTO bans(ban_id, reason)
@@ -119,20 +181,98 @@ class Database:
 
             logger.debug('Migration to v1 complete')
 
-    def migrate(self):
-        for version in [2, 3, 4, 5, 6]:
-            self.migrate_to_version(version)
+    @staticmethod
+    def _insert_ipids(conn, rows):
+        conn.executemany(dedent('''
+            INSERT INTO ipids(ipid, ip_address) VALUES (?, ?)
+            '''), rows)
+
+    def pending_migrations(self, conn=None):
+        """Get the migration versions that have not been applied yet."""
+        conn = conn or self.db
+        cur_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        versions = []
+        for name in os.listdir(MIGRATIONS_DIR):
+            match = re.fullmatch(r'v(\d+)\.sql', name)
+            if match is not None and int(match.group(1)) > max(cur_version, 1):
+                versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    def migrate(self, vacuum=False, dry_run=False, progress=logger.debug):
+        """
+        Bring the database up to the latest version.
 
-    def migrate_to_version(self, version):
-        with self.db as conn:
-            cur_version = conn.execute('PRAGMA user_version') \
-                .fetchone()['user_version']
-            if cur_version >= version:
-                return
+        All pending migrations are planned up front and applied in a
+        single transaction, so a failure leaves the database untouched.
+        Rewriting tables leaves free pages behind; pass `vacuum` to
+        reclaim them once at the end, which can take minutes on a large
+        database.
 
-            with open(f'migrations/v{version}.sql', 'r') as file:
-                conn.executescript(file.read())
-        logger.debug(f'Migration to v{version} complete')
+        With `dry_run`, the migrations are applied to a temporary copy
+        of the database instead, to find out how long they would take.
+
+        Progress messages go to `progress`, the debug log by default.
+
+        :returns: dict mapping each applied version to seconds taken
+        """
+        pending = self.pending_migrations()
+        if len(pending) == 0:
+            return {}
+
+        if not dry_run:
+            return self._run_migrations(self.db, pending, vacuum, progress)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            copy = sqlite3.connect(os.path.join(tmp_dir, 'db.sqlite3'))
+            try:
+                start = time.perf_counter()
+                self.db.backup(copy)
+                progress(f'Copied database in {time.perf_counter() - start:.2f}s')
+                return self._run_migrations(copy, pending, vacuum, progress)
+            finally:
+                copy.close()
+
+    def _run_migrations(self, conn, pending, vacuum, progress):
+        timings = {}
+        isolation_level = conn.isolation_level
+        # Take control of the transaction: foreign key enforcement can
+        # only be toggled outside of one, and the migration scripts
+        # rebuild tables that other tables refer to.
+        conn.isolation_level = None
+        conn.execute('PRAGMA foreign_keys = OFF')
+        try:
+            conn.execute('BEGIN')
+            for i, version in enumerate(pending):
+                progress(f'Migrating database to v{version} ({i + 1}/{len(pending)})...')
+                start = time.perf_counter()
+                with open(os.path.join(MIGRATIONS_DIR, f'v{version}.sql'), 'r') as file:
+                    for statement in _split_sql(file.read()):
+                        conn.execute(statement)
+                timings[version] = time.perf_counter() - start
+                logger.debug('Migration to v%d complete (%.2fs)', version,
+                             timings[version])
+
+            violations = conn.execute('PRAGMA foreign_key_check').fetchall()
+            if len(violations) > 0:
+                raise ServerError(f'Migration left {len(violations)} '
+                                  'foreign key violations; rolled back.')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.execute('PRAGMA foreign_keys = ON')
+            conn.isolation_level = isolation_level
+
+        if vacuum:
+            progress('Vacuuming database...')
+            start = time.perf_counter()
+            conn.execute('VACUUM')
+            timings['vacuum'] = time.perf_counter() - start
+
+        progress(f'Database migrated to v{pending[-1]} in '
+                 f'{sum(timings.values()):.2f}s')
+        return timings
 
     def ipid(self, ip):
         """Get an IPID from an IP address."""
@@ -169,16 +309,17 @@ class Database:
         if ban_type not in ('ipid', 'hdid'):
             raise ServerError(f'Unknown ban type {ban_type}')
 
+        new_ban = ban_id is None
         with self.db as conn:
-            if ban_id is None:
+            if new_ban:
                 existing_ban = self.find_ban(**{ ban_type: target_id })
                 if existing_ban is not None:
                     raise ServerError(f'This ban is already covered by ban ID {existing_ban.ban_id}.')
 
                 ban_date = arrow.get().datetime
 
-                event_logger.info(f'{banned_by.name} ({banned_by.ipid}) ' +
-                                  f'banned {target_id}: \'{reason}\'.')
+                event_logger.info("%s (%s) banned %s: '%s'.", banned_by.name,
+                                  banned_by.ipid, target_id, reason)
                 ban_id = conn.execute(dedent('''
                     INSERT INTO bans(reason, banned_by, ban_date, unban_date, ban_data)
                     VALUES (?, ?, ?, ?, ?)
@@ -212,8 +353,9 @@ class Database:
                 except sqlite3.IntegrityError as exc:
                     raise ServerError(f'Error inserting ban: {exc}')
 
-        if unban_date is not None:
-            self._schedule_unban(ban_id)
+        if new_ban and unban_date is not None and \
+                self.unban_scheduler is not None:
+            self.unban_scheduler.schedule(ban_id, unban_date)
 
         return ban_id
 
@@ -221,6 +363,18 @@ class Database:
         """
         Find the last known OOC name of an IPID.
         """
+        if ipid is None:
+            return None
+        if self.chat_log is not None:
+            # Only the recent part of the chat log is searched, since
+            # this runs on the event loop; older names come from the
+            # database, if it has any.
+            self.chat_log.flush()
+            for entry in read_chat_log(
+                    self.chat_log.directory, ipid=ipid, reverse=True,
+                    since=time.time() - CHAT_LOG_NAME_WINDOW):
+                if entry['kind'] == 'room' and entry['ooc_name']:
+                    return entry['ooc_name']
         with self.db as conn:
             row = conn.execute(dedent('''
                 SELECT ooc_name FROM room_events
@@ -323,56 +477,94 @@ class Database:
 
     def unban(self, ban_id):
         """Remove a ban entry."""
-        event_logger.info(f'Unbanning {ban_id}')
+        event_logger.info('Unbanning %s', ban_id)
         with self.db as conn:
             unbans = conn.execute(dedent('''
                 UPDATE bans SET unbanned = 1 WHERE ban_id = ?
                 '''), (ban_id,)).rowcount
             return unbans > 0
 
-    def schedule_unbans(self):
-        """
-        Schedule unbans from the database.
+    def set_unban_scheduler(self, scheduler):
+        """Set the scheduler that is notified of newly issued timed bans."""
+        self.unban_scheduler = scheduler
+
+    def set_metrics(self, metrics):
+        """Set the metrics that the time spent writing events goes to."""
+        self.metrics = metrics
 
-        There is a bug in Python 3.7 and below where functions cannot be
-        scheduled with a timeout longer than one day. As a workaround,
-        schedule_unbans will only get the unbans for the next 12 hours
-        and then will have to be called again 12 hours later.
+    def set_chat_log(self, chat_log):
         """
-        dated_bans = []
+        Set the chat log that IC messages and room events are written
+        to instead of the database.
+        """
+        self.chat_log = chat_log
+
+    def _log_event(self, table, sql, params):
+        """Insert a row into one of the log tables."""
+        if self.metrics is None:
+            with self.db as conn:
+                conn.execute(sql, params)
+            return
+        start = time.perf_counter()
         with self.db as conn:
-            dated_bans = conn.execute(dedent('''
-                SELECT ban_id FROM bans
-                WHERE unban_date IS NOT NULL AND unbanned = 0 AND
-                    datetime(unban_date) < datetime(?, '+12 hours')
-                '''), (arrow.utcnow().datetime,)).fetchall()
-
-        for ban in dated_bans:
-            self._schedule_unban(ban['ban_id'])
+            conn.execute(sql, params)
+        self.metrics.db_write_seconds.labels(table).observe(
+            time.perf_counter() - start)
 
-    def _schedule_unban(self, ban_id):
+    def pending_unbans(self):
+        """
+        Get the ID and unban date of every timed ban that has not been
+        lifted yet, soonest first.
+        """
         with self.db as conn:
-            ban = conn.execute(dedent('''
-                SELECT unban_date FROM bans WHERE unbanned = 0 AND ban_id = ?
-                '''), (ban_id,)).fetchone()
-            time_to_unban = (arrow.get(ban['unban_date']) - arrow.utcnow()).total_seconds()
-
-            def auto_unban():
-                self.unban(ban_id)
-                self.log_misc('auto_unban', data={'id': ban_id})
+            return [(row['ban_id'], arrow.get(row['unban_date']).datetime)
+                for row in conn.execute(dedent('''
+                    SELECT ban_id, unban_date FROM bans
+                    WHERE unbanned = 0 AND unban_date IS NOT NULL
+                    ORDER BY unban_date
+                    ''')).fetchall()
+            ]
+
+    def expire_bans(self, ban_ids):
+        """
+        Lift expired bans, `EXPIRE_BATCH_SIZE` at a time.
+        :returns: the bans that were lifted, excluding those that had
+        already been lifted by hand
+        """
+        ban_ids = list(ban_ids)
+        lifted = []
+        for start in range(0, len(ban_ids), EXPIRE_BATCH_SIZE):
+            batch = ban_ids[start:start + EXPIRE_BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            with self.db as conn:
+                bans = [Database.Ban(**row) for row in
+                    conn.execute(dedent(f'''
+                        SELECT * FROM bans
+                        WHERE unbanned = 0 AND ban_id IN ({placeholders})
+                        '''), batch).fetchall()
+                ]
+                conn.executemany(dedent('''
+                    UPDATE bans SET unbanned = 1 WHERE ban_id = ?
+                    '''), [(ban.ban_id,) for ban in bans])
 
-            asyncio.get_event_loop().call_later(time_to_unban, auto_unban)
+            for ban in bans:
+                self.log_misc('auto_unban', data={'id': ban.ban_id})
+            lifted.extend(bans)
+        return lifted
 
     def log_ic(self, client, room, showname, message):
         """Log an IC message."""
-        event_logger.info(f'[{room.abbreviation}] {showname}/{client.char_name}' +
-                          f'/{client.name} ({client.ipid}): {message}')
-        with self.db as conn:
-            conn.execute(dedent('''
-                INSERT INTO ic_events(ipid, room_name, char_name, ic_name,
-                    message) VALUES (?, ?, ?, ?, ?)
-                '''), (client.ipid, room.abbreviation, client.char_name,
-                    showname, message))
+        event_logger.info('[%s] %s/%s/%s (%s): %s', room.abbreviation,
+                          showname, client.char_name, client.name,
+                          client.ipid, message)
+        if self.chat_log is not None:
+            self.chat_log.log_ic(client, room, showname, message)
+            return
+        self._log_event('ic_events', dedent('''
+            INSERT INTO ic_events(ipid, room_name, char_name, ic_name,
+                message) VALUES (?, ?, ?, ?, ?)
+            '''), (client.ipid, room.abbreviation, client.char_name,
+                showname, message))
 
     def log_room(self, event_subtype, client, room, message=None, target=None):
         """
@@ -382,29 +574,32 @@ class Database:
         ipid, char_name, ooc_name = (client.ipid, client.char_name,
                                      client.name) if client is not None else (
                                          None, None, None)
+        event_logger.info('[%s] %s/%s (%s): event %s (%s)', room.abbreviation,
+                          char_name, ooc_name, ipid, event_subtype, message)
+        if self.chat_log is not None:
+            self.chat_log.log_room(event_subtype, client, room, message,
+                                   target)
+            return
+
         target_ipid = target.ipid if target is not None else None
         subtype_id = self._subtype_atom('room', event_subtype)
         if isinstance(message, dict):
             message = json.dumps(message)
-
-        event_logger.info(f'[{room.abbreviation}] {client.char_name}' +
-                    f'/{client.name} ({client.ipid}): event {event_subtype} ({message})')
-        with self.db as conn:
-            conn.execute(dedent('''
-                INSERT INTO room_events(ipid, room_name, char_name, ooc_name,
-                    event_subtype, message, target_ipid)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                '''), (ipid, room.abbreviation, char_name, ooc_name,
-                    subtype_id, message, target_ipid))
+        self._log_event('room_events', dedent('''
+            INSERT INTO room_events(ipid, room_name, char_name, ooc_name,
+                event_subtype, message, target_ipid)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            '''), (ipid, room.abbreviation, char_name, ooc_name,
+                subtype_id, message, target_ipid))
 
     def log_connect(self, client, failed=False):
         """Log a connect attempt."""
-        event_logger.info(f'{client.ipid} (HDID: {client.hdid}) ' +
-                          f'{"was blocked from connecting" if failed else "connected"}.')
-        with self.db as conn:
-            conn.execute(dedent('''
-                INSERT INTO connect_events(ipid, hdid, failed) VALUES (?, ?, ?)
-                '''), (client.ipid, client.hdid, failed))
+        event_logger.info('%s (HDID: %s) %s.', client.ipid, client.hdid,
+                          'was blocked from connecting' if failed
+                          else 'connected')
+        self._log_event('connect_events', dedent('''
+            INSERT INTO connect_events(ipid, hdid, failed) VALUES (?, ?, ?)
+            '''), (client.ipid, client.hdid, failed))
 
     def log_misc(self, event_subtype, client=None, target=None, data=None):
         """
@@ -415,13 +610,13 @@ class Database:
         target_ipid = target.ipid if target is not None else None
         subtype_id = self._subtype_atom('misc', event_subtype)
         data_json = json.dumps(data)
-        event_logger.info(f'{event_subtype} ({client_ipid} onto {target_ipid}): {data}')
+        event_logger.info('%s (%s onto %s): %s', event_subtype, client_ipid,
+                          target_ipid, data)
 
-        with self.db as conn:
-            conn.execute(dedent('''
-                INSERT INTO misc_events(ipid, target_ipid, event_subtype,
-                    event_data) VALUES (?, ?, ?, ?)
-                '''), (client_ipid, target_ipid, subtype_id, data_json))
+        self._log_event('misc_events', dedent('''
+            INSERT INTO misc_events(ipid, target_ipid, event_subtype,
+                event_data) VALUES (?, ?, ?, ?)
+            '''), (client_ipid, target_ipid, subtype_id, data_json))
 
     def recent_bans(self, count=5):
         """
@@ -436,6 +631,191 @@ class Database:
                     ORDER BY ban_date ASC
                     '''), (count,)).fetchall()]
 
+    def search_logs(self, query, limit=10, offset=0, time_budget=5):
+        """
+        Search IC messages and OOC chat, newest first.
+
+        This opens its own read-only connection, so it is safe to call
+        from an executor thread. The query is aborted with a ServerError
+        once it runs for longer than `time_budget` seconds.
+        """
+        # Quote every term so that user input can never be parsed as
+        # FTS5 query syntax. A trailing asterisk still works as a prefix.
+        terms = []
+        for term in query.split():
+            prefix = term.endswith('*') and len(term) > 1
+            if prefix:
+                term = term[:-1]
+            term = '"{}"'.format(term.replace('"', '""'))
+            terms.append(term + '*' if prefix else term)
+        if len(terms) == 0:
+            raise ServerError('Empty search query.')
+        match = ' '.join(terms)
+
+        conn = sqlite3.connect(f'file:{DB_FILE}?mode=ro', uri=True)
+        conn.row_factory = sqlite3.Row
+        deadline = time.monotonic() + time_budget
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        try:
+            # Each half only looks at the newest `offset + limit` matches
+            # by walking the index in rowid order, which follows time.
+            return conn.execute(dedent('''
+                SELECT * FROM (
+                    SELECT 'IC' AS kind, e.event_time, e.room_name,
+                        e.char_name AS name, e.ipid, e.message
+                    FROM ic_events_fts
+                    JOIN ic_events AS e ON e.rowid = ic_events_fts.rowid
+                    WHERE ic_events_fts MATCH :match
+                    ORDER BY ic_events_fts.rowid DESC LIMIT :count
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT 'OOC' AS kind, e.event_time, e.room_name,
+                        e.ooc_name AS name, e.ipid, e.message
+                    FROM room_events_fts
+                    JOIN room_events AS e ON e.rowid = room_events_fts.rowid
+                    WHERE room_events_fts MATCH :match
+                    ORDER BY room_events_fts.rowid DESC LIMIT :count
+                )
+                ORDER BY event_time DESC LIMIT :limit OFFSET :offset
+                '''), {'match': match, 'count': offset + limit,
+                         'limit': limit, 'offset': offset}).fetchall()
+        except sqlite3.OperationalError as exc:
+            if time.monotonic() > deadline:
+                raise ServerError('The search took too long. Try a more specific query.')
+            raise ServerError(f'Search failed: {exc}')
+        finally:
+            conn.close()
+
+    def expired_events(self, table, cutoff, limit):
+        """
+        Get up to `limit` of the oldest rows in a log table that were
+        logged before `cutoff` (a UTC 'YYYY-MM-DD HH:MM:SS' string).
+        """
+        if table not in LOG_TABLES:
+            raise AssertionError()
+
+        with self.db as conn:
+            return conn.execute(dedent(f'''
+                SELECT rowid, * FROM {table}
+                WHERE event_time < ?
+                ORDER BY event_time LIMIT ?
+                '''), (cutoff, limit)).fetchall()
+
+    def purge_events(self, table, rows):
+        """
+        Delete archived rows from a log table. Chat messages are folded
+        into hourly per-area counts first so that statistics survive
+        the deletion.
+        """
+        if table not in LOG_TABLES:
+            raise AssertionError()
+
+        rollups = {}
+        if table in ('ic_events', 'room_events'):
+            ooc_subtype = self._subtype_atom('room', 'ooc')
+            for row in rows:
+                if table == 'ic_events':
+                    kind = 'ic'
+                elif row['event_subtype'] == ooc_subtype:
+                    kind = 'ooc'
+                else:
+                    continue
+                key = (f'{row["event_time"][:13]}:00:00',
+                       row['room_name'] or '', kind)
+                rollups[key] = rollups.get(key, 0) + 1
+
+        with self.db as conn:
+            conn.executemany(dedent('''
+                INSERT INTO message_rollups(hour, room_name, kind, messages)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (hour, room_name, kind)
+                DO UPDATE SET messages = messages + excluded.messages
+                '''), [(*key, count) for key, count in rollups.items()])
+            conn.executemany(
+                f'DELETE FROM {table} WHERE rowid = ?',
+                [(row['rowid'],) for row in rows])
+
+    def export_rows(self, groups=EXPORT_GROUPS.keys()):
+        """
+        Iterate over the rows of the given export groups as
+        (table, row dict) pairs. Rows are read lazily from SQLite.
+        """
+        for group in EXPORT_GROUPS:
+            if group not in groups:
+                continue
+            for table in EXPORT_GROUPS[group]:
+                for row in self.db.execute(f'SELECT * FROM {table}'):
+                    yield table, dict(row)
+
+    def import_rows(self, rows, batch_size=IMPORT_BATCH_SIZE):
+        """
+        Insert (table, row dict) pairs produced by `export_rows`,
+        batching consecutive rows of the same table. IDs are kept as
+        they are, so this is meant for filling a fresh database: a
+        table that already has rows is refused with a ServerError,
+        rather than mixing its rows up with the imported ones. Event
+        types are matched up by name.
+        :returns: dict mapping each table to the number of rows read
+        """
+        columns = {}
+        for group in EXPORT_GROUPS.values():
+            for table in group:
+                columns[table] = {col['name'] for col in
+                    self.db.execute(f'PRAGMA table_info({table})')}
+        type_ids = {'room_event_types': {}, 'misc_event_types': {}}
+        counts = {}
+        batch_key = None
+        batch = []
+
+        def flush():
+            if len(batch) == 0:
+                return
+            table, cols = batch_key
+            with self.db as conn:
+                conn.executemany(dedent(f'''
+                    INSERT OR IGNORE INTO {table}({', '.join(cols)})
+                    VALUES ({', '.join('?' * len(cols))})
+                    '''), batch)
+            batch.clear()
+
+        # Logs may refer to IPIDs that were not exported with them.
+        self.db.execute('PRAGMA foreign_keys = OFF')
+        try:
+            for table, row in rows:
+                if table not in columns or not row.keys() <= columns[table]:
+                    raise ServerError(f'Unexpected row for table {table}: {row}')
+                if table not in counts and table not in type_ids and \
+                        self.db.execute(f'SELECT 1 FROM {table} LIMIT 1') \
+                        .fetchone() is not None:
+                    raise ServerError(f'{table} already has rows. Import '
+                                      'into a fresh database instead.')
+                counts[table] = counts.get(table, 0) + 1
+
+                if table in type_ids:
+                    type_ids[table][row['type_id']] = self._subtype_atom(
+                        table.split('_')[0], row['type_name'])
+                    continue
+                if table in ('room_events', 'misc_events'):
+                    types = type_ids[table.replace('events', 'event_types')]
+                    row['event_subtype'] = types.get(row['event_subtype'],
+                                                     row['event_subtype'])
+
+                key = (table, tuple(row.keys()))
+                if key != batch_key or len(batch) >= batch_size:
+                    flush()
+                    batch_key = key
+                batch.append(tuple(row.values()))
+            flush()
+        finally:
+            self.db.execute('PRAGMA foreign_keys = ON')
+
+        violations = self.db.execute('PRAGMA foreign_key_check').fetchall()
+        if len(violations) > 0:
+            logger.debug('Import left %d rows referring to missing IPIDs '
+                         'or bans', len(violations))
+        return counts
+
     def _subtype_atom(self, event_type, event_subtype):
         if event_type not in ('room', 'misc'):
             raise AssertionError()
@@ -46,9 +46,9 @@ class Emotes:
             if self._has_valid_ini_sections(char_ini):
                 return char_ini
             else:
-                logger.warn(f'{char_path} does not have the required sections')
+                logger.warning('%s does not have the required sections', char_path)
         else:
-            logger.warn(f'Character file {char_path} not found')
+            logger.warning('Character file %s not found', char_path)
 
         return None
 
@@ -56,7 +56,7 @@ class Emotes:
         char_ini = self._read_ini()
         if char_ini is not None:
             if self._is_valid_emotions_section(char_ini['Emotions']) is False:
-                logger.warn('Emotions needs a number section')
+                logger.warning('Emotions needs a number section')
                 return
 
             total_char_emotions = char_ini['Emotions'].getint('number')
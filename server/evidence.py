@@ -17,7 +17,13 @@
 
 
 class EvidenceList:
-    """Contains a list of evidence items."""
+    """
+    Contains a list of evidence items.
+
+    What a client sees depends only on whether it can see hidden evidence
+    and, if it cannot, on its position, so rendered lists are cached per
+    viewer class until the evidence changes.
+    """
     limit = 35
 
     class Evidence:
@@ -48,6 +54,11 @@ class EvidenceList:
 
     def __init__(self):
         self.evidences = []
+        self._rendered = {}
+
+    def invalidate(self):
+        """Discard rendered lists after the evidence has changed."""
+        self._rendered = {}
 
     def can_see(self, evi, pos):  # used with hiddenCM ebidense
         pos = pos.strip(' ')
@@ -120,6 +131,7 @@ class EvidenceList:
             pos = 'all'
             self.evidences.append(self.Evidence(
                 name, description, image, pos))
+        self.invalidate()
 
     def evidence_swap(self, client, id1, id2):
         """
@@ -134,34 +146,67 @@ class EvidenceList:
 
         self.evidences[id1], self.evidences[id2] = self.evidences[
             id2], self.evidences[id1]
+        self.invalidate()
 
-    def create_evi_list(self, client):
+    def viewer_class(self, client):
         """
-        Compose an evidence list to send to a client.
+        Get the key under which the list rendered for a client is cached.
         :param client: client to send list to
 
         """
-        evi_list = []
+        if client in client.area.owners or client.is_mod:
+            return True, client.area.evidence_mod == 'HiddenCM'
+        return False, client.pos.strip(' ')
+
+    def render(self, client):
+        """
+        Render the evidence list for a client, reusing the list rendered
+        for clients of the same viewer class.
+        :param client: client to send list to
+        :returns: tuple of evidence numbers, serialized items and the
+        encoded LE packet
+
+        """
+        key = self.viewer_class(client)
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            rendered = self._rendered[key] = self._render(*key)
+        return rendered
+
+    def _render(self, privileged, arg):
         nums_list = [0]
-        for i in range(len(self.evidences)):
-            if client in client.area.owners or client.is_mod:
-                nums_list.append(i+1)
-                evi = self.evidences[i]
+        evi_list = []
+        for i, evi in enumerate(self.evidences):
+            if privileged:
                 desc = evi.desc
-                if client.area.evidence_mod == 'HiddenCM':
+                # `arg` is whether the area is in HiddenCM mode
+                if arg:
                     desc = f'<owner={evi.pos}>\n{evi.desc}'
-                evi_list.append(
-                    self.Evidence(evi.name, desc,
-                                  evi.image, evi.pos).to_string())
-            elif self.can_see(self.evidences[i], client.pos):
                 nums_list.append(i+1)
-                evi_list.append(self.evidences[i].to_string())
+                evi_list.append('&'.join((evi.name, desc, evi.image)))
+            elif self.can_see(evi, arg):
+                nums_list.append(i+1)
+                evi_list.append(evi.to_string())
+        if evi_list:
+            packet = f'LE#{"#".join(evi_list)}#%'
+        else:
+            packet = 'LE#%'
+        return tuple(nums_list), tuple(evi_list), packet
+
+    def create_evi_list(self, client):
+        """
+        Compose an evidence list to send to a client.
+        :param client: client to send list to
+
+        """
+        nums_list, evi_list, _ = self.render(client)
         return nums_list, evi_list
 
     def import_evidence(self, data):
         for evi in data:
             name, description, image, pos = evi['name'], evi['desc'], evi['image'], evi['pos']
             self.evidences.append(self.Evidence(name, description, image, pos))
+        self.invalidate()
 
     def del_evidence(self, client, id):
         """
@@ -175,6 +220,7 @@ class EvidenceList:
         if not client in client.area.owners and not client.is_mod:
             id = client.evi_list[id+1]-1
         self.evidences.pop(id)
+        self.invalidate()
 
     def edit_evidence(self, client, id, arg):
         """
@@ -206,3 +252,4 @@ class EvidenceList:
             idx = client.evi_list[id+1]-1
             self.evidences[idx] = self.Evidence(
                 arg[0], arg[1], arg[2], self.evidences[idx].pos)
+        self.invalidate()
@@ -15,19 +15,47 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import sys
+import queue
+import atexit
 import logging
 import logging.handlers
 import time
 
 from server.client_manager import ClientManager
 
+# Moves records from the loggers to the handlers, started by `setup_logger`
+_listener = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Passes records to the listener thread untouched, so that messages
+    are also formatted there rather than on the event loop.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            # The traceback refers to frames that keep changing, so
+            # render it while it is still accurate.
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
 
 def setup_logger(debug: bool):
     """Set up all loggers.
+
+    The handlers run on a background thread, so that file I/O and
+    rotation never hold up the server: the loggers only put records
+    into a queue.
+
     Args:
         debug (bool): whether debug mode should be enabled
     """
+    global _listener
     logging.Formatter.converter = time.gmtime
     debug_formatter = logging.Formatter('[%(asctime)s UTC] %(message)s')
 
@@ -36,7 +64,6 @@ def setup_logger(debug: bool):
     formatter = logging.Formatter(
         '[%(name)s] %(module)s@%(lineno)d : %(message)s')
     stdoutHandler.setFormatter(formatter)
-    logging.getLogger().addHandler(stdoutHandler)
 
     debug_log = logging.getLogger('debug')
     debug_log.setLevel(logging.DEBUG)
@@ -45,7 +72,7 @@ def setup_logger(debug: bool):
                                                          maxBytes=1024 * 1024 * 4)
     debug_handler.setLevel(logging.DEBUG)
     debug_handler.setFormatter(debug_formatter)
-    debug_log.addHandler(debug_handler)
+    debug_handler.addFilter(logging.Filter('debug'))
 
     # Intended to be a brief log for `tail -f`. To search through events,
     # use the database.
@@ -55,7 +82,20 @@ def setup_logger(debug: bool):
                                                         maxBytes=1024 * 512)
     file_handler.setFormatter(logging.Formatter(
         '[%(asctime)s UTC] %(message)s'))
-    info_log.addHandler(file_handler)
+    file_handler.addFilter(logging.Filter('events'))
+
+    # Every logger propagates to the root logger, whose only handler
+    # queues the record; each file handler picks its own logger's
+    # records back out.
+    log_queue = queue.SimpleQueue()
+    logging.getLogger().addHandler(_QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(
+        log_queue, stdoutHandler, debug_handler, file_handler,
+        respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logger)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_restart_listener)
 
     if not debug:
         debug_log.disabled = True
@@ -63,6 +103,37 @@ def setup_logger(debug: bool):
         debug_log.debug('Logger started')
 
 
+def stop_logger():
+    """Write out the queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def quiet_console():
+    """Stop echoing log records to standard output."""
+    if _listener is not None:
+        _listener.handlers = tuple(
+            handler for handler in _listener.handlers
+            if isinstance(handler, logging.FileHandler))
+
+
+def _restart_listener():
+    """Start a new listener thread in a forked worker process, where
+    the thread of the parent does not exist."""
+    global _listener
+    if _listener is None:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _QueueHandler):
+            handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(
+        log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
 def parse_client_info(client: ClientManager.Client) -> str:
     """Prepend information about a client to a log entry.
 
@@ -0,0 +1,247 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from bisect import bisect_left
+
+import logging
+logger = logging.getLogger('debug')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ('bounds', 'buckets', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One more bucket for values above the last bound
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Family:
+    """
+    A metric with one child per value of its label. Look children up
+    once with `labels` and keep them, or look them up on every call;
+    either way a child is only created the first time.
+    """
+
+    def __init__(self, name, help, kind, label=None, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label = label
+        self.bounds = bounds
+        self.children = {}
+
+    def labels(self, value=None):
+        child = self.children.get(value)
+        if child is None:
+            if self.kind == 'histogram':
+                child = Histogram(self.bounds)
+            else:
+                child = Counter()
+            self.children[value] = child
+        return child
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} {self.kind}')
+        for value, child in self.children.items():
+            label = prefix = labels = ''
+            if self.label is not None:
+                label = f'{self.label}="{escape(value)}"'
+                prefix = label + ','
+                labels = '{' + label + '}'
+            if self.kind == 'counter':
+                lines.append(f'{self.name}{labels} {child.value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(self.bounds + ('+Inf',), child.buckets):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_sum{labels} {child.sum}')
+            lines.append(f'{self.name}_count{labels} {child.count}')
+
+
+class Gauge:
+    """A metric read when the metrics are collected. `collect` returns
+    a number, or a dict of numbers by label value."""
+
+    def __init__(self, name, help, collect, label=None):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.label = label
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} gauge')
+        values = self.collect()
+        if self.label is None:
+            lines.append(f'{self.name} {values}')
+            return
+        for value, number in values.items():
+            lines.append(f'{self.name}{{{self.label}="{escape(value)}"}} '
+                         f'{number}')
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Counters and histograms about the internals of the server, served
+    in the Prometheus text format from `http://<host>:<port>/metrics`.
+
+    Hot paths bump pre-bound counters and histograms, which costs a
+    dictionary lookup and a few additions; values that are cheap to
+    read on demand, like the clients in each area, are only read when
+    the metrics are collected.
+    """
+
+    def __init__(self, server, net_commands=()):
+        self.server = server
+        self.packets_received = Family(
+            'tsuserver_packets_received_total',
+            'Packets received from clients, by command.', 'counter',
+            'command')
+        self.packets_sent = Family(
+            'tsuserver_packets_sent_total',
+            'Packets sent to clients, by command.', 'counter', 'command')
+        self.net_cmd_seconds = Family(
+            'tsuserver_net_cmd_seconds',
+            'Time spent handling packets, by command.', 'histogram',
+            'command')
+        self.ooc_cmd_seconds = Family(
+            'tsuserver_ooc_cmd_seconds',
+            'Time spent running OOC commands, by command.', 'histogram',
+            'command')
+        self.db_write_seconds = Family(
+            'tsuserver_db_write_seconds',
+            'Time spent writing log events to the database, by table.',
+            'histogram', 'table')
+        self.arup_broadcasts = Family(
+            'tsuserver_arup_broadcasts_total',
+            'Area updates broadcast to clients, by kind (0: players, '
+            '1: status, 2: CM, 3: lock).', 'counter', 'kind')
+        self.loop_lag_seconds = Family(
+            'tsuserver_loop_lag_seconds',
+            'How late the event loop ran a timer.', 'histogram',
+            bounds=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                    2.5, 5))
+        self.families = [
+            self.packets_received, self.packets_sent, self.net_cmd_seconds,
+            self.ooc_cmd_seconds, self.db_write_seconds,
+            self.arup_broadcasts, self.loop_lag_seconds,
+        ]
+        self.gauges = [
+            Gauge('tsuserver_clients', 'Connected clients.',
+                  lambda: len(self.server.client_manager.clients)),
+            Gauge('tsuserver_area_clients', 'Clients in each area.',
+                  self.area_clients, 'area'),
+            Gauge('tsuserver_write_buffer_bytes',
+                  'Bytes waiting to be sent to all clients.',
+                  lambda: sum(self.write_buffer_sizes())),
+            Gauge('tsuserver_write_buffer_max_bytes',
+                  'Bytes waiting to be sent to the most backed up client.',
+                  lambda: max(self.write_buffer_sizes(), default=0)),
+        ]
+
+        # Bind the children of known commands up front, so handling a
+        # packet never allocates one.
+        for command in net_commands:
+            self.packets_received.labels(command)
+            self.net_cmd_seconds.labels(command)
+        self.unknown_packets = self.packets_received.labels('unknown')
+        self.loop_lag = self.loop_lag_seconds.labels()
+        self.arup = [self.arup_broadcasts.labels(kind) for kind in range(4)]
+
+    def area_clients(self):
+        return {area.name: len(area.clients)
+                for area in self.server.area_manager.areas
+                if self.server.shard is None or self.server.shard.owns(area)}
+
+    def write_buffer_sizes(self):
+        for client in self.server.client_manager.clients:
+            try:
+                yield client.transport.get_write_buffer_size()
+            except (AttributeError, NotImplementedError):
+                # Websocket transports do not report one.
+                pass
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            family.render(lines)
+        for gauge in self.gauges:
+            gauge.render(lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+    async def measure_loop_lag(self, interval=0.5):
+        """Measure how late the event loop wakes up from a sleep."""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0, loop.time() - start - interval))
+
+    async def serve(self, host, port):
+        """Serve the metrics over HTTP."""
+        from aiohttp import web
+
+        async def metrics(request):
+            return web.Response(body=self.render().encode('utf-8'),
+                                headers={'Content-Type': CONTENT_TYPE})
+
+        app = web.Application()
+        app.router.add_get('/metrics', metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        try:
+            await site.start()
+        except OSError as exc:
+            print(f'Could not serve metrics on {host}:{port}: {exc}')
+            await runner.cleanup()
+            return
+        logger.debug('Serving metrics on http://%s:%d/metrics', host, port)
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import re
+import math
 import arrow
 import asyncio
 import logging
@@ -24,11 +25,13 @@ import json
 
 from enum import Enum
 from typing import List
-from time import localtime, strftime, time
+from time import localtime, perf_counter, strftime, time
 
 from .. import commands
 from server import database
 from server.fantacrypt import fanta_decrypt
+from server.predicates import mods_only
+from server.ratelimit import TokenBucket
 from server.constants import ESCAPE_CHARACTERS
 from server.exceptions import ClientError, AreaError, ArgumentError, ServerError
 
@@ -36,6 +39,9 @@ from server.exceptions import ClientError, AreaError, ArgumentError, ServerError
 logger_debug = logging.getLogger('debug')
 logger = logging.getLogger('events')
 
+# IPIDs remembered by /throttled
+THROTTLED_IPIDS_LIMIT = 1000
+
 
 class ProtocolError(Exception):
     pass
@@ -52,12 +58,27 @@ class AOProtocol(asyncio.Protocol):
         INT = 3,
         INT_OR_STR = 3
 
-    def __init__(self, server):
+    def __init__(self, server, user_id=None):
         super().__init__()
         self.server = server
+        self.user_id = user_id
         self.client = None
         self.buffer = ''
         self.ping_timeout = None
+        # Number of this connection in the traffic capture, if recording
+        self.capture_id = None
+
+        # Per-connection budgets for raw traffic, if configured. Going
+        # over either one stops reading from the socket until the budget
+        # recovers.
+        self.packet_bucket = self.byte_bucket = None
+        floodguard = server.config['packet_floodguard']
+        if floodguard is not None:
+            self.packet_bucket = TokenBucket(floodguard['packets_per_second'],
+                                             floodguard['packet_burst'])
+            self.byte_bucket = TokenBucket(floodguard['bytes_per_second'],
+                                           floodguard['byte_burst'])
+        self.throttle_handle = None
 
     def dezalgo(self, input):
         """
@@ -91,11 +112,17 @@ class AOProtocol(asyncio.Protocol):
 
         """
         buf = data
-        ipid = self.client.ipid
 
         if buf is None:
             buf = b''
 
+        if self.capture_id is not None:
+            self.server.capture.inbound(self.capture_id, buf)
+
+        wait = 0
+        if self.byte_bucket is not None:
+            wait = self.byte_bucket.consume(len(buf))
+
         if not isinstance(buf, str):
             # try to decode as utf-8, ignore any erroneous characters
             self.buffer += buf.decode('utf-8', 'ignore')
@@ -106,6 +133,17 @@ class AOProtocol(asyncio.Protocol):
 
         if len(self.buffer) > 8192:
             self.client.disconnect()
+        if wait > 0:
+            self.throttle(wait)
+        elif self.throttle_handle is None:
+            self.process_buffer()
+
+    def process_buffer(self):
+        """Handle the complete messages in the buffer, unless the
+        client runs out of its packet budget."""
+        ipid = self.client.ipid
+        timed = self.server.metrics is not None or \
+            self.server.watchdog is not None
         try:
             for msg in self.get_messages():
                 if len(msg) < 2:
@@ -118,27 +156,108 @@ class AOProtocol(asyncio.Protocol):
                     msg = '#'.join([fanta_decrypt(spl[0])] + spl[1:])
                 try:
                     cmd, *args = msg.split('#')
-                    self.net_cmd_dispatcher[cmd](self, args)
-                    if cmd != 'CH':
+                    handler = self.net_cmd_dispatcher[cmd]
+                    if timed:
+                        self.run_timed('packet', cmd, handler, self, args)
+                    else:
+                        handler(self, args)
+                    if cmd != 'CH' and self.client is not None:
                         self.client.last_pkt_time = time()
                 except KeyError:
+                    if self.server.metrics is not None:
+                        self.server.metrics.unknown_packets.inc()
                     logger_debug.debug(
-                        f'Unknown incoming message from {ipid}: {msg}')
+                        'Unknown incoming message from %s: %s', ipid, msg)
                     if not self.client.is_checked:
                         raise ProtocolError
+                if self.client is None:
+                    # The client was handed over to another worker
+                    # process along with the rest of the buffer.
+                    return
+                if self.packet_bucket is None:
+                    continue
+                wait = self.packet_bucket.consume()
+                if wait > 0:
+                    # The rest of the buffer is handled once the
+                    # throttle is lifted.
+                    self.throttle(wait)
+                    break
         except ProtocolError:
             self.client.disconnect()
 
+    def run_timed(self, kind, name, function, *args):
+        """Run a packet handler or an OOC command, recording how long
+        it takes in the metrics and reporting it to the watchdog.
+
+        :param kind: 'packet' or 'command'
+        :param name: header of the packet, or name of the command
+        :param function: the handler or command
+        :param args: arguments to call it with; the packet arguments or
+        the command argument come last
+
+        """
+        metrics = self.server.metrics
+        watchdog = self.server.watchdog
+        area = self.client.area
+        if watchdog is not None:
+            watchdog.begin()
+        start = perf_counter()
+        try:
+            function(*args)
+        finally:
+            elapsed = perf_counter() - start
+            if metrics is not None:
+                if kind == 'packet':
+                    metrics.packets_received.labels(name).inc()
+                    metrics.net_cmd_seconds.labels(name).observe(elapsed)
+                else:
+                    metrics.ooc_cmd_seconds.labels(name).observe(elapsed)
+            if watchdog is not None:
+                watchdog.end(elapsed, f'{kind} {name}', args[-1], area)
+
+    def throttle(self, wait):
+        """Stop reading from the client for a while.
+
+        :param wait: seconds to wait
+
+        """
+        if self.throttle_handle is not None:
+            return
+        ipid = self.client.ipid
+        throttled = self.server.throttled_ipids
+        if ipid not in throttled:
+            logger_debug.debug('Throttling %s for sending too much data.', ipid)
+            if len(throttled) >= THROTTLED_IPIDS_LIMIT:
+                # Forget the IPID throttled least often to make room.
+                del throttled[min(throttled, key=throttled.get)]
+        throttled[ipid] += 1
+        self.client.transport.pause_reading()
+        self.throttle_handle = self.server.loop.call_later(
+            wait, self.unthrottle)
+
+    def unthrottle(self):
+        """Resume reading from the client after a throttle."""
+        self.throttle_handle = None
+        self.client.transport.resume_reading()
+        self.process_buffer()
+
     def connection_made(self, transport):
         """Called upon a new client connecting
 
         :param transport: the transport object
         """
+        if self.server.capture is not None:
+            self.capture_id = self.server.capture.connect(
+                transport.get_extra_info('peername')[0])
         try:
-            self.client = self.server.new_client(transport)
+            self.client = self.server.new_client(transport, self.user_id)
         except ClientError:
             transport.close()
+            if self.user_id is not None:
+                # Give back the ID the supervisor assigned to us
+                self.server.shard.release_id(self.user_id)
             return
+        self.client.capture_id = self.capture_id
 
         if not self.server.client_manager.new_client_preauth(self.client):
             self.client.send_command(
@@ -148,10 +267,10 @@ class AOProtocol(asyncio.Protocol):
 
         # Client needs to send CHECK#% within the timeout - otherwise,
         # it will be automatically dropped.
-        self.ping_timeout = asyncio.get_event_loop().call_later(
+        self.ping_timeout = self.server.loop.call_later(
             self.server.config['timeout'], self.client.disconnect)
 
-        asyncio.get_event_loop().call_later(0.25, self.client.send_command,
+        self.server.loop.call_later(0.25, self.client.send_command,
                                             'decryptor',
                                             34)  # just fantacrypt things)
 
@@ -162,10 +281,14 @@ class AOProtocol(asyncio.Protocol):
 
         """
         if self.client is not None:
-            logger.debug(f'{self.client.ipid} disconnected.')
+            logger.debug('%s disconnected.', self.client.ipid)
             self.server.remove_client(self.client)
         if self.ping_timeout is not None:
             self.ping_timeout.cancel()
+        if self.throttle_handle is not None:
+            self.throttle_handle.cancel()
+        if self.capture_id is not None:
+            self.server.capture.close_connection(self.capture_id)
 
     def get_messages(self):
         """Parses out full messages from the buffer.
@@ -237,7 +360,6 @@ class AOProtocol(asyncio.Protocol):
                     if special_ban_data['ban_type'] == 'area_curse':
                         self.client.area_curse = special_ban_data['target_area']
                         self.client.area_curse_info = ban
-                        self.client.change_area(self.server.area_manager.get_area_by_id(self.client.area_curse))
                 except (KeyError, ValueError):
                     pass
             else:
@@ -264,6 +386,16 @@ class AOProtocol(asyncio.Protocol):
                                  self.server.player_count,
                                  self.server.config['playerlimit'])
 
+        # Moving the client may hand it over to another worker process
+        # (see server/sharding.py), so it comes last.
+        client = self.client
+        if client.area_curse is not None:
+            area = self.server.area_manager.get_area_by_id(client.area_curse)
+            if area != client.area:
+                client.change_area(area)
+        if self.client is not None and self.server.shard is not None:
+            self.server.shard.admit(client)
+
     def net_cmd_id(self, args):
         """Client version and PV
 
@@ -297,7 +429,7 @@ class AOProtocol(asyncio.Protocol):
         """
         self.client.send_command('CHECK')
         self.ping_timeout.cancel()
-        self.ping_timeout = asyncio.get_event_loop().call_later(
+        self.ping_timeout = self.server.loop.call_later(
             self.server.config['timeout'], self.client.disconnect)
 
     def net_cmd_askchaa(self, _):
@@ -431,6 +563,10 @@ class AOProtocol(asyncio.Protocol):
             return
         elif not self.client.area.can_send_message(self.client):
             return
+        elif not self.client.is_mod and self.client.check_flood('ic'):
+            self.client.send_ooc(
+                f'You are sending IC messages too fast. Please try again after {math.ceil(self.client.check_flood("ic", record=False))} seconds.')
+            return
 
         target_area = []
         showname = ""
@@ -712,6 +848,7 @@ class AOProtocol(asyncio.Protocol):
         # Reveal evidence to everyone if hidden
         elif evidence and self.client.area.evi_list.evidences[self.client.evi_list[evidence] - 1].pos != 'all':
             self.client.area.evi_list.evidences[self.client.evi_list[evidence] - 1].pos = 'all'
+            self.client.area.evi_list.invalidate()
             self.client.area.broadcast_evidence_list()
 
 
@@ -830,6 +967,10 @@ class AOProtocol(asyncio.Protocol):
             max_char = 256
         if len(args[1]) > max_char:
             return
+        if not self.client.is_mod and self.client.check_flood('ooc'):
+            self.client.send_ooc(
+                f'You are sending OOC messages too fast. Please try again after {math.ceil(self.client.check_flood("ooc", record=False))} seconds.')
+            return
         if args[1].startswith(' /'):
             self.client.send_ooc(
                 'Your message was not sent for safety reasons: you left a space before that slash.')
@@ -845,7 +986,13 @@ class AOProtocol(asyncio.Protocol):
                 if not hasattr(commands, called_function):
                     self.client.send_ooc('Invalid command.')
                 else:
-                    getattr(commands, called_function)(self.client, arg)
+                    function = getattr(commands, called_function)
+                    if self.server.metrics is not None or \
+                            self.server.watchdog is not None:
+                        self.run_timed('command', cmd, function,
+                                       self.client, arg)
+                    else:
+                        function(self.client, arg)
             except (ClientError, AreaError, ArgumentError, ServerError) as ex:
                 self.client.send_ooc(ex)
             except Exception as ex:
@@ -1022,9 +1169,10 @@ class AOProtocol(asyncio.Protocol):
         if not self.client.is_checked:
             return
         if self.client in self.client.area.owners:
-            if not self.client.can_call_case():
+            wait = self.client.check_flood('casing', record=False)
+            if wait:
                 self.client.send_ooc(
-                    'Please wait 60 seconds between case announcements!')
+                    f'Please wait {math.ceil(wait)} seconds before announcing another case!')
                 return
 
             if not args[1] == "1" and not args[2] == "1" and not args[
@@ -1047,7 +1195,7 @@ class AOProtocol(asyncio.Protocol):
                                                  args[2], args[3], args[4],
                                                  args[5], '1')
 
-            self.client.set_case_call_delay()
+            self.client.check_flood('casing')
 
             log_data = {k: v for k, v in
                         zip(('message', 'def', 'pro', 'jud', 'jur', 'steno'), args)}
@@ -1157,9 +1305,10 @@ class AOProtocol(asyncio.Protocol):
                 "You cannot call a moderator while spectating.")
             return
 
-        if not self.client.can_call_mod():
+        wait = self.client.check_flood('modcall', record=False)
+        if wait:
             self.client.send_ooc(
-                "You must wait 30 seconds between mod calls.")
+                f"You must wait {math.ceil(wait)} seconds before calling a moderator again.")
             return
 
         current_time = strftime("%H:%M", localtime())
@@ -1170,8 +1319,8 @@ class AOProtocol(asyncio.Protocol):
                 '[{}] {} ({}) in {} without reason (not using 2.6?)'.format(
                     current_time, self.client.char_name,
                     self.client.ip, self.client.area.name),
-                pred=lambda c: c.is_mod)
-            self.client.set_mod_call_delay()
+                pred=mods_only)
+            self.client.check_flood('modcall')
             database.log_room('modcall', self.client, self.client.area)
         else:
             args[0] = self.dezalgo(args[0])
@@ -1181,8 +1330,8 @@ class AOProtocol(asyncio.Protocol):
                     current_time, self.client.char_name,
                     self.client.ip, self.client.area.name,
                     args[0][:100]),
-                pred=lambda c: c.is_mod)
-            self.client.set_mod_call_delay()
+                pred=mods_only)
+            self.client.check_flood('modcall')
             database.log_room('modcall', self.client,
                               self.client.area, message=args[0])
 
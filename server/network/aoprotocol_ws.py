@@ -28,8 +28,12 @@ class AOProtocolWS(AOProtocol):
     class TransportWrapper:
         """A class to wrap asyncio's Transport class."""
 
-        def __init__(self, websocket):
+        def __init__(self, websocket, loop):
             self.ws = websocket
+            self.loop = loop
+            self.closing = False
+            self.reading = asyncio.Event()
+            self.reading.set()
 
         def get_extra_info(self, key):
             """Get extra info about the client.
@@ -48,11 +52,24 @@ class AOProtocolWS(AOProtocol):
 
             """
             message = message.decode('utf-8')
-            asyncio.ensure_future(self.ws_try_writing_message(message))
+            self.loop.create_task(self.ws_try_writing_message(message))
 
         def close(self):
             """Disconnect the client by force."""
-            asyncio.ensure_future(self.ws.close())
+            self.closing = True
+            self.loop.create_task(self.ws.close())
+
+        def is_closing(self):
+            """Check whether the connection was closed by the server."""
+            return self.closing
+
+        def pause_reading(self):
+            """Stop receiving messages until resume_reading is called."""
+            self.reading.clear()
+
+        def resume_reading(self):
+            """Resume receiving messages."""
+            self.reading.set()
 
         async def ws_try_writing_message(self, message):
             """
@@ -73,10 +90,12 @@ class AOProtocolWS(AOProtocol):
 
     def ws_on_connect(self):
         """Handle a new client connection."""
-        self.connection_made(self.TransportWrapper(self.ws))
+        self.transport = self.TransportWrapper(self.ws, self.server.loop)
+        self.connection_made(self.transport)
 
     async def ws_handle(self):
         try:
+            await self.transport.reading.wait()
             data = await self.ws.recv()
             self.data_received(data)
         except Exception as exc:
@@ -53,9 +53,8 @@ class MasterServerClient:
       return str(conn.getresponse().read())
 
     async def send_server_info(self, http: aiohttp.ClientSession):
-        loop = asyncio.get_event_loop()
         cfg = self.server.config
-        my_ip = await loop.run_in_executor(None, self.get_my_ip)
+        my_ip = await self.server.loop.run_in_executor(None, self.get_my_ip)
         body = {
             'ip': my_ip,
             'port': cfg['port'],
@@ -74,6 +73,7 @@ class MasterServerClient:
             try:
                 res.raise_for_status()
             except aiohttp.ClientResponseError as err:
-                logging.error(f"Got status={err.status} advertising {body}: {err_body}")
+                logger.error('Got status=%d advertising %s: %s', err.status,
+                             body, err_body)
 
-        logger.debug(f'Heartbeat to {API_BASE_URL}/servers')
+        logger.debug('Heartbeat to %s/servers', API_BASE_URL)
@@ -0,0 +1,37 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Predicates for `TsuServer3.send_all_cmd_pred`. When areas are split
+# across worker processes, broadcasts are replayed in every worker, so
+# predicates have to be picklable: define them at module level rather
+# than as lambdas.
+
+
+def everyone(client):
+    return True
+
+
+def mods_only(client):
+    return client.is_mod
+
+
+def hears_global(client):
+    return not client.muted_global
+
+
+def hears_adverts(client):
+    return not client.muted_adverts
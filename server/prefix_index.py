@@ -0,0 +1,75 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Marks the node where a key ends. Trie edges are single characters,
+# so this can never collide with one.
+_VALUES = ''
+
+
+class PrefixIndex:
+    """
+    A case-insensitive trie mapping strings to sets of values.
+
+    Target lookups by name accept a name followed by more text, such as
+    `/pm <name> <message>`, so the index answers which keys are prefixes
+    of a given string in time proportional to the length of the string.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, key: str, value):
+        """Associate a value with a key. Empty keys are ignored."""
+        if key == '':
+            return
+        node = self.root
+        for char in key.lower():
+            node = node.setdefault(char, {})
+        node.setdefault(_VALUES, set()).add(value)
+
+    def remove(self, key: str, value):
+        """Remove a value from a key, if it is there."""
+        if key == '':
+            return
+        path = [self.root]
+        for char in key.lower():
+            node = path[-1].get(char)
+            if node is None:
+                return
+            path.append(node)
+        values = path[-1].get(_VALUES)
+        if values is None:
+            return
+        values.discard(value)
+        if len(values) == 0:
+            del path[-1][_VALUES]
+        # Prune the branch if nothing else hangs off it.
+        for char, parent in zip(reversed(key.lower()), reversed(path[:-1])):
+            if len(parent[char]) > 0:
+                break
+            del parent[char]
+
+    def prefixes_of(self, text: str):
+        """Get every value whose key is a prefix of `text`."""
+        found = []
+        node = self.root
+        for char in text.lower():
+            node = node.get(char)
+            if node is None:
+                break
+            found.extend(node.get(_VALUES, ()))
+        return found
@@ -0,0 +1,135 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import signal
+from collections import Counter
+from time import strftime
+
+import logging
+logger = logging.getLogger('events')
+
+from server.exceptions import ServerError
+
+# Seconds of CPU time between samples
+SAMPLE_INTERVAL = 0.005
+
+
+class SamplingProfiler:
+    """
+    Finds out where the server spends its CPU time, with little enough
+    overhead to run on a live server.
+
+    A profiling timer interrupts the process every `interval` seconds
+    of CPU time, and the signal handler counts the stack it interrupted.
+    Idle time waiting for the network is not sampled. The samples are
+    written in the collapsed stack format read by flamegraph.pl,
+    speedscope and similar tools.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, directory='logs'):
+        self.interval = interval
+        self.path = os.path.join(directory,
+                                 strftime('profile-%Y%m%d-%H%M%S.folded'))
+        # Stacks of code objects, innermost first, and how often each
+        # was sampled
+        self.samples = Counter()
+        self.running = False
+        self.stop_handle = None
+        self.previous_handler = None
+
+    def start(self, loop, seconds):
+        """Start sampling, and stop after `seconds` seconds."""
+        if not hasattr(signal, 'setitimer'):
+            raise ServerError('Profiling is not supported on this system.')
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        self.stop_handle = loop.call_later(seconds, self.finish)
+
+    def stop(self):
+        """Stop sampling."""
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+        self.running = False
+        self.stop_handle.cancel()
+
+    def finish(self):
+        """Stop at the end of the profiling window and save the samples."""
+        self.stop()
+        self.write()
+        logger.info('Profiling finished. %s', self.summary())
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self.samples[tuple(stack)] += 1
+
+    @property
+    def count(self):
+        return sum(self.samples.values())
+
+    def collapsed(self):
+        """The samples as lines of `outer;...;inner count`."""
+        labels = {}
+
+        def label(code):
+            if code not in labels:
+                filename = code.co_filename
+                if filename.startswith(os.getcwd()):
+                    filename = os.path.relpath(filename)
+                labels[code] = \
+                    f'{code.co_name} ({filename}:{code.co_firstlineno})'
+            return labels[code]
+
+        return [';'.join(label(code) for code in reversed(stack)) +
+                f' {count}' for stack, count in self.samples.items()]
+
+    def write(self):
+        """Write the samples so far, replacing the last write."""
+        with open(self.path, 'w', encoding='utf-8') as file:
+            for line in self.collapsed():
+                file.write(line + '\n')
+        return self.path
+
+    def top_handlers(self, count=5):
+        """
+        The packet handlers and OOC commands that took the most samples,
+        with their number of samples. A sample counts towards the
+        innermost one on its stack, so an OOC command is counted instead
+        of the CT packet it came in.
+        """
+        handlers = Counter()
+        for stack, samples in self.samples.items():
+            for code in stack:
+                if code.co_name.startswith(('net_cmd_', 'ooc_cmd_')):
+                    handlers[code.co_name] += samples
+                    break
+        return handlers.most_common(count)
+
+    def summary(self):
+        msg = f'{self.count} samples written to {self.path}.'
+        top = self.top_handlers()
+        if len(top) > 0:
+            # No percent signs: they end a packet in the AO protocol.
+            msg += ' Top handlers: ' + ', '.join(
+                f'{name} ({samples})' for name, samples in top)
+        return msg
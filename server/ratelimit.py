@@ -0,0 +1,131 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import time
+
+from array import array
+
+
+class RateLimiter:
+    """
+    Allows at most `times` events in any window of `interval` seconds.
+
+    The times of the last `times` events are kept in a fixed-size ring
+    buffer, so the oldest of them decides whether another event fits in
+    the window. Going over the limit starts a mute of `mute_length`
+    seconds; without a mute length, the caller only has to wait until
+    the oldest event leaves the window.
+
+    Times come from a monotonic clock, so changes to the system clock do
+    not lift or extend limits.
+    """
+    __slots__ = ('times', 'interval', 'mute_length', 'events', 'oldest',
+                 'muted_until')
+
+    def __init__(self, times: int, interval: float, mute_length: float = 0):
+        self.times = times
+        self.interval = interval
+        self.mute_length = mute_length
+        self.events = array('d', [-math.inf]) * times
+        self.oldest = 0
+        self.muted_until = -math.inf
+
+    def wait_time(self, now: float = None) -> float:
+        """Get how many seconds until the next event would be allowed.
+
+        Args:
+            now (float, optional): current monotonic time
+
+        Returns:
+            float: 0 if an event is allowed right now
+        """
+        if now is None:
+            now = time.monotonic()
+        if now < self.muted_until:
+            return self.muted_until - now
+        return max(0, self.events[self.oldest] + self.interval - now)
+
+    def hit(self, now: float = None):
+        """Record an event, whether or not it was allowed.
+
+        Args:
+            now (float, optional): current monotonic time
+        """
+        if now is None:
+            now = time.monotonic()
+        self.events[self.oldest] = now
+        self.oldest = (self.oldest + 1) % self.times
+
+    def check(self, now: float = None) -> float:
+        """Record an event if it is allowed, or start the mute if not.
+
+        Args:
+            now (float, optional): current monotonic time
+
+        Returns:
+            float: 0 if the event is allowed, otherwise how many seconds
+            the caller must wait
+        """
+        if now is None:
+            now = time.monotonic()
+        wait = self.wait_time(now)
+        if wait == 0:
+            self.hit(now)
+        elif now >= self.muted_until and self.mute_length > 0:
+            self.muted_until = now + self.mute_length
+            wait = self.mute_length
+        return wait
+
+
+class TokenBucket:
+    """
+    Allows a sustained `rate` of units per second, with bursts of up to
+    `burst` units.
+
+    Units that have already arrived cannot be refused, so taking more
+    than the bucket holds puts it in debt, and the caller is told how
+    long to hold off until the debt is paid back.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, amount: float = 1, now: float = None) -> float:
+        """Take units out of the bucket.
+
+        Args:
+            amount (float, optional): how many units. Defaults to 1.
+            now (float, optional): current monotonic time
+
+        Returns:
+            float: 0 if the bucket had enough, otherwise how many seconds
+            until it is out of debt
+        """
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
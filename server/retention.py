@@ -0,0 +1,124 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import gzip
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import arrow
+
+import logging
+logger = logging.getLogger('debug')
+
+from server import database
+
+
+class LogRetention:
+    """
+    Moves expired rows out of the log tables and into compressed
+    monthly archives, so that the database does not grow forever.
+
+    Archives are gzipped JSON Lines files, one per table and month,
+    e.g. `storage/archive/ic_events/2020-05.jsonl.gz`. Each run appends
+    a new gzip member, which `zcat` and `gzip.open` read transparently.
+    """
+
+    def __init__(self, config):
+        self.interval = config.get('interval', 3600)
+        self.batch_size = config.get('batch_size', 1000)
+        self.archive_dir = config.get('archive_dir', 'storage/archive')
+        self.ttl_days = {table: ttl for table, ttl
+                         in config.get('ttl_days', {}).items()
+                         if table in database.LOG_TABLES and ttl}
+        # Batches run on a thread of their own, with a connection of
+        # their own, so deletes and gzip writes never block the server.
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='retention')
+        self.db = None
+
+    async def run(self):
+        """Archive expired rows periodically."""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                for table, ttl in self.ttl_days.items():
+                    archived = 0
+                    while True:
+                        count = await loop.run_in_executor(
+                            self.executor, self.archive_batch, table, ttl)
+                        archived += count
+                        if count < self.batch_size:
+                            break
+                        # Let the server breathe between batches.
+                        await asyncio.sleep(0.05)
+                    if archived > 0:
+                        logger.debug('Archived %d rows from %s', archived,
+                                     table)
+            except Exception:
+                # Try again on the next pass rather than stopping.
+                logger.exception('Log retention failed')
+            await asyncio.sleep(self.interval)
+
+    def archive_all(self):
+        """
+        Archive every expired row right away, on the calling thread.
+        Returns rows archived.
+        """
+        archived = 0
+        for table, ttl in self.ttl_days.items():
+            while True:
+                count = self.archive_batch(table, ttl)
+                archived += count
+                if count < self.batch_size:
+                    break
+        return archived
+
+    def archive_batch(self, table, ttl):
+        """
+        Move one batch of rows older than `ttl` days from `table`
+        into the archive.
+        :returns: number of rows archived
+        """
+        cutoff = arrow.utcnow().shift(days=-ttl).format('YYYY-MM-DD HH:mm:ss')
+        if self.db is None:
+            self.db = database.Database(auto_migrate=False)
+        rows = self.db.expired_events(table, cutoff, self.batch_size)
+        if not rows:
+            return 0
+
+        months = {}
+        for row in rows:
+            months.setdefault(row['event_time'][:7], []).append(row)
+
+        # Write the archive before deleting anything. If the server dies
+        # in between, rows are archived twice rather than lost.
+        for month, month_rows in months.items():
+            self._write_archive(table, month, month_rows)
+        self.db.purge_events(table, rows)
+        return len(rows)
+
+    def _write_archive(self, table, month, rows):
+        path = os.path.join(self.archive_dir, table)
+        os.makedirs(path, exist_ok=True)
+        with gzip.open(os.path.join(path, f'{month}.jsonl.gz'), 'at',
+                       encoding='utf-8') as archive:
+            for row in rows:
+                entry = dict(row)
+                del entry['rowid']
+                archive.write(json.dumps(entry) + '\n')
@@ -0,0 +1,675 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Splits areas across worker processes, so that a busy server is not
+limited to one CPU core.
+
+Every worker listens on the server port with SO_REUSEPORT, so the
+kernel spreads new connections across them, and each worker runs the
+handshake of the connections it accepted. Area N belongs to worker
+N % `area_workers`. A client lives in the worker that owns its area:
+once its handshake is done, and whenever it moves to an area of another
+worker, its socket and state are handed over to that worker.
+
+The supervisor process never speaks the AO protocol. It keeps the
+registry of which worker holds each player ID, which it uses to hand
+out IDs, enforce `multiclient_limit` across workers and deliver bans to
+the workers holding the banned IPID, and it relays messages between
+workers.
+
+Everything that crosses areas goes through the supervisor as a call
+to a module-level function in each other worker: server-wide
+broadcasts (global chat, mod chat, adverts, mod calls, announcements),
+ARUP updates, IC messages sent to other areas, player counts and
+timed unbans.
+
+Limitations:
+ - Linux only (SOCK_SEQPACKET and socket.send_fds); Python 3.9+.
+ - Websocket connections are not supported.
+ - Mod commands other than bans only find targets in the same worker.
+ - CM status and the global timer do not cross workers.
+ - /refresh only reloads the worker it was sent to.
+"""
+
+import asyncio
+import collections
+import heapq
+import logging
+import os
+import pickle
+import signal
+import socket
+
+from server import database
+from server.exceptions import ClientError
+from server.logger import stop_logger
+from server.network.aoprotocol import AOProtocol
+from server.predicates import everyone
+
+logger = logging.getLogger('debug')
+
+# Upper bound on the size of a single message between processes
+MAX_MESSAGE = 1 << 20
+BUFFER_SIZE = 1 << 22
+
+# How often workers tell each other their player counts
+COUNT_INTERVAL = 1
+
+# How long a client's pending output may take to drain before it is
+# handed over to another worker
+HANDOFF_TIMEOUT = 5
+
+
+class Channel:
+    """
+    One end of a SOCK_SEQPACKET socket pair carrying pickled messages,
+    optionally with file descriptors attached.
+
+    Sends never block: messages that do not fit in the socket buffer
+    are queued until it drains. File descriptors passed to `send` are
+    closed once they have been sent.
+    """
+
+    def __init__(self, loop, sock, handler, on_close):
+        self.loop = loop
+        self.sock = sock
+        self.handler = handler
+        self.on_close = on_close
+        self.outbox = collections.deque()
+        self.closed = False
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFFER_SIZE)
+        loop.add_reader(sock.fileno(), self._readable)
+
+    def send(self, message, fds=()):
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        if len(data) > MAX_MESSAGE:
+            logger.error('Dropping a %d byte message to another worker '
+                         'process.', len(data))
+            self._close_fds(fds)
+            return
+        if self.closed:
+            self._close_fds(fds)
+            return
+        self.outbox.append((data, list(fds)))
+        if len(self.outbox) == 1 and not self._flush():
+            self.loop.add_writer(self.sock.fileno(), self._writable)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        self.loop.remove_writer(self.sock.fileno())
+        for _, fds in self.outbox:
+            self._close_fds(fds)
+        self.outbox.clear()
+        self.sock.close()
+        self.on_close()
+
+    def _flush(self):
+        """Send queued messages. Returns False if some are left."""
+        while self.outbox:
+            data, fds = self.outbox[0]
+            try:
+                socket.send_fds(self.sock, [data], fds)
+            except BlockingIOError:
+                return False
+            except OSError:
+                logger.exception('Lost the connection to another process')
+                self.close()
+                return True
+            self.outbox.popleft()
+            self._close_fds(fds)
+        return True
+
+    def _writable(self):
+        if self._flush():
+            self.loop.remove_writer(self.sock.fileno())
+
+    def _readable(self):
+        while not self.closed:
+            try:
+                data, fds, flags, _ = socket.recv_fds(
+                    self.sock, MAX_MESSAGE, 4)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.close()
+                return
+            if not data and not fds:
+                self.close()
+                return
+            if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+                logger.error('Dropping a truncated message from another '
+                             'worker process.')
+                self._close_fds(fds)
+                continue
+            try:
+                self.handler(pickle.loads(data), fds)
+            except Exception:
+                logger.exception('Error while handling a message from '
+                                 'another worker process')
+
+    @staticmethod
+    def _close_fds(fds):
+        for fd in fds:
+            os.close(fd)
+
+
+def _add(index, key, client_id):
+    index.setdefault(key, set()).add(client_id)
+
+
+def _discard(index, key, client_id):
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(client_id)
+        if len(ids) == 0:
+            del index[key]
+
+
+class Registry:
+    """
+    The supervisor's record of which worker holds each player ID, indexed
+    by the address and IPID of the client.
+    """
+
+    def __init__(self, playerlimit, multiclient_limit):
+        self.free_ids = list(range(playerlimit))
+        self.multiclient_limit = multiclient_limit
+        # Player ID -> [worker, address, IPID]
+        self.clients = {}
+        self.by_address = {}
+        self.by_ipid = {}
+
+    def acquire(self, worker, address):
+        """Assign a player ID to a new connection.
+
+        Returns:
+            tuple: the player ID and None, or None and why the connection
+            was refused
+        """
+        if len(self.by_address.get(address, ())) >= self.multiclient_limit:
+            return None, ('Maximum clients reached.\n'
+                          'Disconnect one of your clients to continue.')
+        if len(self.free_ids) == 0:
+            return None, 'This server is full.'
+        client_id = heapq.heappop(self.free_ids)
+        self.clients[client_id] = [worker, address, None]
+        _add(self.by_address, address, client_id)
+        return client_id, None
+
+    def register(self, client_id, ipid):
+        """Record the IPID of a client once its worker knows it."""
+        entry = self.clients.get(client_id)
+        if entry is None:
+            return
+        if entry[2] is not None:
+            _discard(self.by_ipid, entry[2], client_id)
+        entry[2] = ipid
+        _add(self.by_ipid, ipid, client_id)
+
+    def move(self, client_id, worker):
+        entry = self.clients.get(client_id)
+        if entry is not None:
+            entry[0] = worker
+
+    def release(self, client_id):
+        entry = self.clients.pop(client_id, None)
+        if entry is None:
+            return
+        _, address, ipid = entry
+        _discard(self.by_address, address, client_id)
+        if ipid is not None:
+            _discard(self.by_ipid, ipid, client_id)
+        heapq.heappush(self.free_ids, client_id)
+
+    def holders(self, ipid) -> set:
+        """Get the workers holding a client with this IPID."""
+        return {self.clients[client_id][0]
+                for client_id in self.by_ipid.get(ipid, ())}
+
+
+class Supervisor:
+    """Forks the workers, keeps the registry and relays messages."""
+
+    def __init__(self, server):
+        self.server = server
+        self.config = server.config
+        self.count = self.config['area_workers']
+        self.registry = Registry(self.config['playerlimit'],
+                                 self.config['multiclient_limit'])
+        self.channels = []
+        self.pids = []
+        self.loop = None
+
+    def listen(self):
+        """Open one listening socket per worker on the server port."""
+        bound_ip = '0.0.0.0'
+        if self.config['local']:
+            bound_ip = '127.0.0.1'
+        # SO_REUSEPORT would let a second server share the port with
+        # this one, so make sure that nothing is listening on it first.
+        socket.create_server((bound_ip, self.config['port'])).close()
+        listeners = []
+        for _ in range(self.count):
+            listeners.append(socket.create_server(
+                (bound_ip, self.config['port']), backlog=1024,
+                reuse_port=True))
+        return listeners
+
+    def run(self):
+        listeners = self.listen()
+
+        if self.config['use_websockets']:
+            print('Websockets are not supported with area_workers; '
+                  'only the TCP port will be open.')
+
+        # Apply pending migrations once, then make sure no connection is
+        # inherited by the workers.
+        database.migrate()
+        database.reset()
+
+        socks = []
+        for index in range(self.count):
+            parent, child = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_SEQPACKET)
+            pid = os.fork()
+            if pid == 0:
+                for other, listener in enumerate(listeners):
+                    if other != index:
+                        listener.close()
+                parent.close()
+                for sock in socks:
+                    sock.close()
+                code = 0
+                try:
+                    Shard(self.server, index, self.count, child,
+                          listeners[index]).run()
+                except BaseException:
+                    logger.exception('Worker %d crashed', index)
+                    code = 1
+                finally:
+                    # os._exit skips atexit, so flush the log queue here.
+                    stop_logger()
+                    os._exit(code)
+            child.close()
+            socks.append(parent)
+            self.pids.append(pid)
+        for listener in listeners:
+            listener.close()
+
+        self.loop = self.server.new_event_loop()
+        for index, sock in enumerate(socks):
+            self.channels.append(Channel(
+                self.loop, sock,
+                lambda message, fds, index=index:
+                    self.handle(index, message, fds),
+                self.loop.stop))
+
+        print(f'Server started with {self.count} area workers and is '
+              f'listening on port {self.config["port"]}')
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.pids:
+            os.waitpid(pid, 0)
+        self.loop.close()
+
+    def handle(self, index, message, fds):
+        kind = message[0]
+        if kind == 'acquire':
+            _, token, address = message
+            client_id, refusal = self.registry.acquire(index, address)
+            self.channels[index].send(('acquired', token, client_id, refusal))
+        elif kind == 'register':
+            self.registry.register(message[1], message[2])
+        elif kind == 'release':
+            self.registry.release(message[1])
+        elif kind == 'migrate':
+            _, target, client_id, payload = message
+            self.registry.move(client_id, target)
+            self.channels[target].send(('adopt', payload), fds)
+        elif kind == 'broadcast':
+            for other, channel in enumerate(self.channels):
+                if other != index:
+                    channel.send(('call', message[1]))
+        elif kind == 'call':
+            _, target, payload = message
+            self.channels[target].send(('call', payload))
+        elif kind == 'call_holders':
+            _, ipid, payload = message
+            for target in self.registry.holders(ipid) - {index}:
+                self.channels[target].send(('call', payload))
+
+
+class MigratedProtocol(AOProtocol):
+    """The protocol of a client handed over by another worker."""
+
+    def __init__(self, server, payload):
+        super().__init__(server)
+        self.payload = payload
+
+    def connection_made(self, transport):
+        payload = self.payload
+        self.client = self.server.client_manager.adopt_client(
+            transport, payload['state'])
+        self.buffer = payload['buffer']
+        self.ping_timeout = self.server.loop.call_later(
+            self.server.config['timeout'], self.client.disconnect)
+        self.server.shard.arrive(self.client, payload)
+        if self.client is not None:
+            self.process_buffer()
+
+
+class Shard:
+    """The state of a worker process that owns some of the areas."""
+
+    def __init__(self, server, index, count, sock, listener):
+        self.server = server
+        self.index = index
+        self.count = count
+        self.sock = sock
+        self.listener = listener
+        self.channel = None
+        # Accepted connections waiting for a player ID, by request number
+        self.accepted = {}
+        self.next_request = 0
+        # Player and mod counts of the other workers
+        self.counts = {}
+        self.published_counts = None
+        # ARUP values of every area, by ARUP type
+        self.arup = {}
+
+    def run(self):
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        loop = self.server.loop = self.server.new_event_loop()
+        self.channel = Channel(loop, self.sock, self.handle, loop.stop)
+        self.listener.setblocking(False)
+        loop.add_reader(self.listener.fileno(), self.accept)
+
+        server = self.server
+        server.shard = self
+        # Player IDs come from the supervisor
+        server.client_manager.cur_id = []
+        areas = server.area_manager.areas
+        self.arup = {
+            0: [len(area.clients) for area in areas],
+            1: [area.status for area in areas],
+            2: ['FREE' for area in areas],
+            3: [area.is_locked.name for area in areas],
+        }
+
+        primary = self.index == 0
+        server.start_tasks(primary)
+        if not primary:
+            database.set_unban_scheduler(self)
+        loop.create_task(self.count_loop())
+
+        if primary:
+            database.log_misc('start')
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        if primary:
+            database.log_misc('stop')
+        if server.chat_log is not None:
+            server.chat_log.close()
+
+    def owns(self, area) -> bool:
+        """Check whether an area belongs to this worker."""
+        return area.id % self.count == self.index
+
+    def handle(self, message, fds):
+        kind = message[0]
+        if kind == 'acquired':
+            self.acquired(*message[1:])
+        elif kind == 'adopt':
+            self.adopt(pickle.loads(message[1]), fds[0])
+        elif kind == 'call':
+            function, args = pickle.loads(message[1])
+            function(self.server, *args)
+
+    def broadcast(self, function, *args):
+        """Call `function(server, *args)` in every other worker."""
+        try:
+            payload = pickle.dumps((function, args), pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            logger.exception('Cannot send %r to other workers', function)
+            return
+        self.channel.send(('broadcast', payload))
+
+    def call(self, index, function, *args):
+        """Call `function(server, *args)` in one worker."""
+        payload = pickle.dumps((function, args), pickle.HIGHEST_PROTOCOL)
+        self.channel.send(('call', index, payload))
+
+    def call_holders(self, ipid, function, *args):
+        """Call `function(server, *args)` in every other worker that holds
+        a client with this IPID."""
+        payload = pickle.dumps((function, args), pickle.HIGHEST_PROTOCOL)
+        self.channel.send(('call_holders', ipid, payload))
+
+    def release_id(self, client_id):
+        self.channel.send(('release', client_id))
+
+    def accept(self):
+        while True:
+            try:
+                conn, address = self.listener.accept()
+            except BlockingIOError:
+                return
+            except OSError:
+                logger.exception('Failed to accept a connection')
+                return
+            request = self.next_request
+            self.next_request += 1
+            self.accepted[request] = conn
+            self.channel.send(('acquire', request, address[0]))
+
+    def acquired(self, request, client_id, refusal):
+        """Serve an accepted connection once the supervisor has assigned
+        it a player ID, or turn it away."""
+        conn = self.accepted.pop(request)
+        if client_id is None:
+            try:
+                conn.send(f'BD#{refusal}#%'.encode('utf-8'))
+            except OSError:
+                pass
+            conn.close()
+            return
+
+        async def serve():
+            try:
+                await self.server.loop.connect_accepted_socket(
+                    lambda: AOProtocol(self.server, client_id), conn)
+            except OSError:
+                conn.close()
+                self.release_id(client_id)
+        self.server.loop.create_task(serve())
+
+    def register(self, client):
+        """Tell the supervisor the IPID of a new client."""
+        self.channel.send(('register', client.id, client.ipid))
+
+    def admit(self, client):
+        """Hand a client that has finished its handshake here over to
+        the worker that owns its area."""
+        if client not in client.area.clients:
+            self.migrate(client, client.area, force=True)
+
+    def migrate(self, client, area, force=False):
+        """
+        Hand a client over to the worker that owns `area`.
+        :param client: client to move
+        :param area: area to move it to
+        :param force: skip the checks for entering the area
+        (Default value = False)
+
+        """
+        state = client.export_state()
+        transport = client.transport
+        protocol = transport.get_protocol()
+        transport.pause_reading()
+        protocol.client = None
+        if protocol.ping_timeout is not None:
+            protocol.ping_timeout.cancel()
+        if protocol.throttle_handle is not None:
+            protocol.throttle_handle.cancel()
+            protocol.throttle_handle = None
+
+        origin = client.area
+        origin.remove_client(client)
+        self.server.client_manager.detach_client(client)
+        self.server.loop.create_task(self.hand_off(
+            client.id, transport, protocol, area.id % self.count, {
+                'state': state,
+                'area': area.id,
+                'origin': origin.id,
+                'force': force,
+            }))
+
+    async def hand_off(self, client_id, transport, protocol, target, payload):
+        # Let the client receive what was sent to it here first.
+        loop = self.server.loop
+        deadline = loop.time() + HANDOFF_TIMEOUT
+        while transport.get_write_buffer_size() > 0 and \
+                not transport.is_closing() and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        if transport.is_closing() or transport.get_write_buffer_size() > 0:
+            transport.abort()
+            self.release_id(client_id)
+            return
+        fd = os.dup(transport.get_extra_info('socket').fileno())
+        # Whatever the client sent after the packet that moved it
+        payload['buffer'] = protocol.buffer
+        self.channel.send(
+            ('migrate', target, client_id, pickle.dumps(payload)), [fd])
+        transport.close()
+
+    def adopt(self, payload, fd):
+        """Take over a client handed over by another worker."""
+        async def serve():
+            sock = socket.socket(fileno=fd)
+            try:
+                await self.server.loop.connect_accepted_socket(
+                    lambda: MigratedProtocol(self.server, payload), sock)
+            except OSError:
+                sock.close()
+                self.release_id(payload['state']['id'])
+        self.server.loop.create_task(serve())
+
+    def arrive(self, client, payload):
+        """Put a client that was just handed over into its new area."""
+        area_manager = self.server.area_manager
+        area = area_manager.get_area_by_id(payload['area'])
+        origin = area_manager.get_area_by_id(payload['origin'])
+        if payload['force']:
+            client.area = area
+            area.new_client(client)
+            return
+        client.area = origin
+        try:
+            client.change_area(area)
+        except ClientError as ex:
+            client.send_ooc(ex)
+            self.migrate(client, origin, force=True)
+
+    def send_all_cmd_pred(self, cmd, args, pred):
+        self.broadcast(_send_all_cmd_pred, cmd, args, pred)
+
+    def send_remote_command(self, area_ids, cmd, args):
+        area_ids = [a_id for a_id in area_ids if a_id % self.count != self.index]
+        if len(area_ids) > 0:
+            self.broadcast(_send_remote_command, area_ids, cmd, args)
+
+    def send_arup(self, args):
+        """Publish the ARUP values of this worker's areas."""
+        kind, values = args[0], args[1:]
+        updates = {area.id: value for area, value
+                   in zip(self.server.area_manager.areas, values)
+                   if self.owns(area)}
+        self.broadcast(_update_arup, kind, updates)
+        _update_arup(self.server, kind, updates)
+
+    def remote_player_count(self):
+        return sum(players for players, _ in self.counts.values())
+
+    def remote_mod_count(self):
+        return sum(mods for _, mods in self.counts.values())
+
+    async def count_loop(self):
+        client_manager = self.server.client_manager
+        area_manager = self.server.area_manager
+        while True:
+            counts = (client_manager.player_count, len(client_manager.mods))
+            if counts != self.published_counts:
+                self.published_counts = counts
+                self.broadcast(_update_counts, self.index, counts)
+            # Areas only publish their player counts when someone joins,
+            # so catch up on clients that left.
+            players = self.arup[0]
+            if any(len(area.clients) != players[area.id]
+                   for area in area_manager.areas if self.owns(area)):
+                area_manager.send_arup_players()
+            await asyncio.sleep(COUNT_INTERVAL)
+
+    def schedule(self, ban_id, unban_date):
+        """Stand in for the unban scheduler, which runs in worker 0."""
+        self.call(0, _schedule_unban, ban_id, unban_date)
+
+
+# Calls made from other workers
+
+def _send_all_cmd_pred(server, cmd, args, pred):
+    for client in server.client_manager.clients:
+        if pred(client):
+            client.send_command(cmd, *args)
+
+
+def _send_remote_command(server, area_ids, cmd, args):
+    for a_id in area_ids:
+        area = server.area_manager.get_area_by_id(a_id)
+        if server.shard.owns(area):
+            area.send_command(cmd, *args)
+            area.send_owner_command(cmd, *args)
+
+
+def _update_arup(server, kind, updates):
+    values = server.shard.arup[kind]
+    for area_id, value in updates.items():
+        values[area_id] = value
+    _send_all_cmd_pred(server, 'ARUP', [kind] + values, everyone)
+
+
+def _update_counts(server, index, counts):
+    server.shard.counts[index] = counts
+
+
+def _schedule_unban(server, ban_id, unban_date):
+    server.unban_scheduler.schedule(ban_id, unban_date)
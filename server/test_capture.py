@@ -0,0 +1,49 @@
+import os
+
+from server import capture
+from server.capture import TrafficRecorder, read_capture
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'capture.bin')
+    recorder = TrafficRecorder({'path': path})
+    first = recorder.connect('10.0.0.1')
+    second = recorder.connect('10.0.0.2')
+    recorder.inbound(first, b'HI#hdid#%')
+    recorder.outbound(first, 'ID#0#tsuserver3#3.0.0#%')
+    recorder.close_connection(second)
+    recorder.close()
+    records = [(connection, kind, payload)
+               for _, connection, kind, payload in read_capture(path)]
+    assert records == [
+        (first, capture.CONNECT, b'10.0.0.1'),
+        (second, capture.CONNECT, b'10.0.0.2'),
+        (first, capture.INBOUND, b'HI#hdid#%'),
+        (first, capture.OUTBOUND, b'ID#0#tsuserver3#3.0.0#%'),
+        (second, capture.CLOSE, b''),
+    ]
+
+def test_rotation_bounds_disk_usage(tmp_path):
+    path = str(tmp_path / 'capture.bin')
+    recorder = TrafficRecorder({'path': path, 'segment_size': 1000,
+                                'segments': 3})
+    connection = recorder.connect('10.0.0.1')
+    for i in range(200):
+        recorder.inbound(connection, f'CT#name#message {i}#%')
+    recorder.close()
+    assert capture.segment_paths(path) == [path + '.2', path + '.1', path]
+    assert all(os.path.getsize(segment) <= 1000
+               for segment in capture.segment_paths(path))
+    # Only the newest messages are left, in order.
+    payloads = [payload for _, _, _, payload in read_capture(path)]
+    assert payloads[-1] == b'CT#name#message 199#%'
+    numbers = [int(payload.split(b' ')[1][:-2]) for payload in payloads]
+    assert numbers == sorted(numbers)
+
+def test_previous_capture_is_kept(tmp_path):
+    path = str(tmp_path / 'capture.bin')
+    recorder = TrafficRecorder({'path': path})
+    recorder.connect('10.0.0.1')
+    recorder.close()
+    TrafficRecorder({'path': path}).close()
+    assert capture.segment_paths(path) == [path + '.1', path]
+    assert len(list(read_capture(path))) == 1
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+from server import chatlog
+from server.chatlog import ChatLog, read_chat_log
+
+room = SimpleNamespace(abbreviation='BAS')
+
+def client(ipid):
+    return SimpleNamespace(ipid=ipid, char_name='Phoenix', name=f'player{ipid}')
+
+def test_records_round_trip(tmp_path):
+    log = ChatLog({'directory': str(tmp_path)})
+    log.log_ic(client(1), room, 'Nick', 'Objection!')
+    log.log_room('area.join', client(2), room)
+    log.log_room('invite', client(1), room, target=client(2))
+    log.close()
+    entries = list(read_chat_log(str(tmp_path)))
+    assert [entry['kind'] for entry in entries] == ['ic', 'room', 'room']
+    assert entries[0]['ic_name'] == 'Nick'
+    assert entries[0]['message'] == 'Objection!'
+    assert entries[1]['ooc_name'] == 'player2'
+    assert entries[2]['target_ipid'] == 2
+    assert [entry['ipid'] for entry
+            in read_chat_log(str(tmp_path), ipid=1)] == [1, 1]
+
+def test_rotation_and_time_range(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(chatlog.time, 'time', lambda: now[0])
+    log = ChatLog({'directory': str(tmp_path), 'segment_size': 500})
+    for i in range(100):
+        now[0] = 1000.0 + i
+        log.log_ic(client(i % 3), room, 'Nick', f'message {i}')
+    log.close()
+    assert len(chatlog._segments(str(tmp_path))['chat']) > 1
+    messages = [entry['message'] for entry
+                in read_chat_log(str(tmp_path), since=1010, until=1019)]
+    assert messages == [f'message {i}' for i in range(10, 20)]
+    newest = read_chat_log(str(tmp_path), ipid=2, reverse=True)
+    assert next(newest)['message'] == 'message 98'
+
+def test_writers_are_merged_and_cut_records_skipped(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(chatlog.time, 'time', lambda: now[0])
+    first = ChatLog({'directory': str(tmp_path)}, 'chat0')
+    second = ChatLog({'directory': str(tmp_path)}, 'chat1')
+    for i in range(6):
+        now[0] = 1000.0 + i
+        (first if i % 2 == 0 else second).log_ic(client(1), room, 'Nick',
+                                                 f'message {i}')
+    first.close()
+    second.close()
+    # A server killed in the middle of a write
+    with open(first.segment_path(1), 'r+b') as segment:
+        segment.truncate(segment.seek(0, 2) - 3)
+    messages = [entry['message'] for entry in read_chat_log(str(tmp_path))]
+    assert messages == ['message 0', 'message 1', 'message 2', 'message 3',
+                        'message 5']
+    # A restart starts a new segment.
+    ChatLog({'directory': str(tmp_path)}, 'chat0').close()
+    assert [number for _, number
+            in chatlog._segments(str(tmp_path))['chat0']] == [1, 2]
@@ -0,0 +1,110 @@
+import sqlite3
+
+import pytest
+
+from server import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'db.sqlite3'))
+    db = database.Database()
+    with db.db as conn:
+        conn.execute("INSERT INTO ipids(ipid, ip_address) VALUES (1, '1.2.3.4')")
+    yield db
+    db.db.close()
+
+def log(db, table, message, subtype='ooc'):
+    with db.db as conn:
+        if table == 'ic_events':
+            conn.execute('INSERT INTO ic_events(ipid, room_name, char_name, '
+                         'message) VALUES (1, ?, ?, ?)',
+                         ('BAS', 'Phoenix', message))
+        else:
+            conn.execute('INSERT INTO room_events(ipid, room_name, ooc_name, '
+                         'event_subtype, message) VALUES (1, ?, ?, ?, ?)',
+                         ('BAS', 'player', db._subtype_atom('room', subtype),
+                          message))
+
+def test_search_logs(db):
+    log(db, 'ic_events', 'Objection! The witness is lying.')
+    log(db, 'room_events', 'brb, getting objection.mp3')
+    log(db, 'room_events', 'objection.opus', subtype='music')
+    rows = db.search_logs('objection')
+    assert sorted(row['kind'] for row in rows) == ['IC', 'OOC']
+    assert [row['message'] for row in db.search_logs('witn*')] == \
+        ['Objection! The witness is lying.']
+    assert db.search_logs('hold it') == []
+    # FTS5 syntax in a query is searched for as text.
+    for query in ('"', 'a"b', 'NEAR(', 'message:lying', '-x AND'):
+        assert db.search_logs(query) == []
+
+def test_fts_follows_deletes(db):
+    log(db, 'ic_events', 'Take that!')
+    log(db, 'room_events', 'take that yourself')
+    assert len(db.search_logs('take')) == 2
+    with db.db as conn:
+        conn.execute('DELETE FROM ic_events')
+        conn.execute('DELETE FROM room_events')
+    assert db.search_logs('take') == []
+
+def test_import_into_fresh_database(db, tmp_path, monkeypatch):
+    with db.db as conn:
+        conn.execute('INSERT INTO bans(ban_id, banned_by, reason) '
+                     "VALUES (5, 1, 'spam')")
+        conn.execute("INSERT INTO ip_bans(ipid, ban_id) VALUES (1, 5)")
+    rows = list(db.export_rows(['ipids', 'bans']))
+
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'fresh.sqlite3'))
+    fresh = database.Database()
+    counts = fresh.import_rows(iter(rows))
+    assert counts == {'ipids': 1, 'bans': 1, 'ip_bans': 1}
+    assert tuple(fresh.db.execute(
+        'SELECT ipid, reason FROM ip_bans NATURAL JOIN bans').fetchone()) == \
+        ('1', 'spam')
+    fresh.db.close()
+
+def test_import_refuses_tables_with_rows(db):
+    rows = [('ipids', {'ipid': 1, 'ip_address': '5.6.7.8'})]
+    with pytest.raises(database.ServerError):
+        db.import_rows(iter(rows))
+
+def test_last_known_name_from_chat_log(db, tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    from server import chatlog
+    from server.chatlog import ChatLog
+
+    room = SimpleNamespace(abbreviation='BAS')
+    with db.db as conn:
+        conn.execute("INSERT INTO ipids(ipid, ip_address) VALUES (7, '7.7.7.7')")
+    now = [1000000.0]
+    monkeypatch.setattr(chatlog.time, 'time', lambda: now[0])
+    monkeypatch.setattr(database.time, 'time', lambda: now[0])
+    chat_log = ChatLog({'directory': str(tmp_path / 'chat')})
+    db.set_chat_log(chat_log)
+    try:
+        db.log_room('area.join', SimpleNamespace(
+            ipid=7, char_name='Phoenix', name='SomePlayer'), room)
+        # A ban issued by no one is not attributed to whoever spoke last.
+        assert db.last_known_name(None) is None
+        assert db.last_known_name(7) == 'SomePlayer'
+        assert db.last_known_name(1) is None
+        # Old parts of the chat log are not searched.
+        now[0] += database.CHAT_LOG_NAME_WINDOW + 1
+        assert db.last_known_name(7) is None
+    finally:
+        db.set_chat_log(None)
+        chat_log.close()
+
+def test_expire_more_bans_than_sqlite_parameters(db):
+    # Older SQLite builds allow at most 999 parameters per statement.
+    db.db.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    with db.db as conn:
+        conn.executemany(
+            'INSERT INTO bans(ban_id, unban_date, banned_by, reason) '
+            "VALUES (?, '2020-01-01 00:00:00', NULL, 'spam')",
+            [(ban_id,) for ban_id in range(1, 1201)])
+        conn.execute('UPDATE bans SET unbanned = 1 WHERE ban_id = 7')
+    bans = db.expire_bans(range(1, 1201))
+    assert len(bans) == 1199
+    assert db.db.execute(
+        'SELECT COUNT(*) FROM bans WHERE unbanned = 0').fetchone()[0] == 0
@@ -0,0 +1,14 @@
+import io
+import json
+
+from server.jsonstream import iter_object_items
+
+def test_iter_object_items():
+    data = {'1.2.3.4': 12345, 'abc': [1, {'x': 'y z'}], 'n': None, 'e': {}}
+    text = json.dumps(data, indent=2)
+    for chunk_size in (1, 3, 65536):
+        items = list(iter_object_items(io.StringIO(text), chunk_size))
+        assert items == list(data.items())
+
+def test_iter_object_items_empty():
+    assert list(iter_object_items(io.StringIO(' { } '), 1)) == []
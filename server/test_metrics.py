@@ -0,0 +1,30 @@
+from server.metrics import Family
+
+def test_counter_family():
+    family = Family('packets_total', 'Packets.', 'counter', 'command')
+    family.labels('MS').inc()
+    family.labels('MS').inc(2)
+    family.labels('say "hi"').inc()
+    lines = []
+    family.render(lines)
+    assert lines == [
+        '# HELP packets_total Packets.',
+        '# TYPE packets_total counter',
+        'packets_total{command="MS"} 3',
+        'packets_total{command="say \\"hi\\""} 1',
+    ]
+
+def test_histogram_buckets_are_cumulative():
+    family = Family('lag_seconds', 'Lag.', 'histogram', bounds=(0.1, 1))
+    histogram = family.labels()
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    lines = []
+    family.render(lines)
+    assert lines[2:] == [
+        'lag_seconds_bucket{le="0.1"} 2',
+        'lag_seconds_bucket{le="1"} 3',
+        'lag_seconds_bucket{le="+Inf"} 4',
+        'lag_seconds_sum 3.65',
+        'lag_seconds_count 4',
+    ]
@@ -0,0 +1,22 @@
+from server.prefix_index import PrefixIndex
+
+def test_prefixes_of():
+    index = PrefixIndex()
+    index.add('Phoenix', 1)
+    index.add('phoenix', 2)
+    index.add('Pho', 3)
+    index.add('Edgeworth', 4)
+    assert sorted(index.prefixes_of('PHOENIX hello there')) == [1, 2, 3]
+    assert index.prefixes_of('Ph') == []
+    assert index.prefixes_of('Edgeworth') == [4]
+
+def test_remove_prunes():
+    index = PrefixIndex()
+    index.add('Maya', 1)
+    index.add('Mia', 2)
+    index.remove('maya', 1)
+    index.remove('Maya', 1)
+    assert index.prefixes_of('Maya') == []
+    assert index.root == {'m': {'i': {'a': {'': {2}}}}}
+    index.remove('Mia', 2)
+    assert index.root == {}
@@ -0,0 +1,32 @@
+from server.profiler import SamplingProfiler
+
+def net_cmd_ct():
+    pass
+
+def ooc_cmd_roll():
+    pass
+
+def helper():
+    pass
+
+def test_collapsed_stacks_and_top_handlers(tmp_path):
+    profiler = SamplingProfiler(directory=str(tmp_path))
+    ct, roll, other = net_cmd_ct.__code__, ooc_cmd_roll.__code__, \
+        helper.__code__
+    # Stacks are innermost first.
+    profiler.samples[(other, roll, ct)] = 3
+    profiler.samples[(other, ct)] = 2
+    profiler.samples[(other,)] = 1
+    assert profiler.count == 6
+    assert profiler.top_handlers() == [('ooc_cmd_roll', 3),
+                                       ('net_cmd_ct', 2)]
+
+    path = profiler.write()
+    with open(path, encoding='utf-8') as file:
+        lines = file.read().splitlines()
+    assert len(lines) == 3
+    stack, count = lines[0].rsplit(' ', 1)
+    assert count == '3'
+    assert [frame.split(' ')[0] for frame in stack.split(';')] == \
+        ['net_cmd_ct', 'ooc_cmd_roll', 'helper']
+    assert 'test_profiler.py:' in stack
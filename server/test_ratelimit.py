@@ -0,0 +1,33 @@
+from server.ratelimit import RateLimiter, TokenBucket
+
+def test_sliding_window():
+    limiter = RateLimiter(3, 10)
+    assert [limiter.check(t) for t in (0, 1, 2)] == [0, 0, 0]
+    assert limiter.check(5) == 5
+    assert limiter.check(10) == 0
+    assert limiter.check(10.5) == 0.5
+
+def test_mute():
+    limiter = RateLimiter(2, 10, mute_length=60)
+    assert limiter.check(0) == 0
+    assert limiter.check(1) == 0
+    assert limiter.check(2) == 60
+    assert limiter.check(32) == 30
+    assert limiter.wait_time(62) == 0
+    assert limiter.check(62) == 0
+
+def test_wait_time_does_not_record():
+    limiter = RateLimiter(1, 30)
+    assert limiter.wait_time(0) == 0
+    assert limiter.wait_time(0) == 0
+    limiter.hit(0)
+    assert limiter.wait_time(10) == 20
+
+def test_token_bucket():
+    bucket = TokenBucket(10, 5)
+    bucket.updated = 0
+    assert [bucket.consume(1, 0) for _ in range(5)] == [0] * 5
+    assert bucket.consume(1, 0) == 0.1
+    assert bucket.consume(1, 1) == 0
+    assert bucket.tokens == 4
+    assert bucket.consume(24, 1) == 2
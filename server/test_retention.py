@@ -0,0 +1,50 @@
+import gzip
+import json
+
+from server import database
+from server.retention import LogRetention
+
+def test_archive_rollup_and_purge(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'db.sqlite3'))
+    db = database.Database()
+    ooc = db._subtype_atom('room', 'ooc')
+    music = db._subtype_atom('room', 'music')
+    with db.db as conn:
+        conn.execute("INSERT INTO ipids(ipid, ip_address) VALUES (1, '1.2.3.4')")
+        conn.executemany(
+            'INSERT INTO ic_events(event_time, ipid, room_name, message) '
+            'VALUES (?, 1, ?, ?)',
+            [('2020-05-01 10:15:00', 'BAS', 'first'),
+             ('2020-05-01 10:45:00', 'BAS', 'second'),
+             ('2020-06-02 11:00:00', 'CR1', 'third'),
+             ('2999-01-01 00:00:00', 'BAS', 'future')])
+        conn.executemany(
+            'INSERT INTO room_events(event_time, ipid, room_name, '
+            'event_subtype, message) VALUES (?, 1, ?, ?, ?)',
+            [('2020-05-01 10:30:00', 'BAS', ooc, 'hello'),
+             ('2020-05-01 10:31:00', 'BAS', music, 'song.opus')])
+
+    retention = LogRetention({
+        'archive_dir': str(tmp_path / 'archive'), 'batch_size': 2,
+        'ttl_days': {'ic_events': 30, 'room_events': 30},
+    })
+    assert retention.archive_all() == 5
+
+    with gzip.open(tmp_path / 'archive' / 'ic_events' / '2020-05.jsonl.gz',
+                   'rt', encoding='utf-8') as archive:
+        assert [json.loads(line)['message'] for line in archive] == \
+            ['first', 'second']
+    assert (tmp_path / 'archive' / 'ic_events' / '2020-06.jsonl.gz').exists()
+    assert (tmp_path / 'archive' / 'room_events' / '2020-05.jsonl.gz').exists()
+
+    rollups = db.db.execute(
+        'SELECT hour, room_name, kind, messages FROM message_rollups '
+        'ORDER BY hour, kind').fetchall()
+    assert [tuple(row) for row in rollups] == [
+        ('2020-05-01 10:00:00', 'BAS', 'ic', 2),
+        ('2020-05-01 10:00:00', 'BAS', 'ooc', 1),
+        ('2020-06-02 11:00:00', 'CR1', 'ic', 1),
+    ]
+    assert [row['message'] for row in
+            db.db.execute('SELECT message FROM ic_events')] == ['future']
+    assert db.db.execute('SELECT COUNT(*) FROM room_events').fetchone()[0] == 0
@@ -0,0 +1,26 @@
+from server.sharding import Registry
+
+def test_acquire_limits():
+    registry = Registry(playerlimit=3, multiclient_limit=2)
+    assert registry.acquire(0, '10.0.0.1') == (0, None)
+    assert registry.acquire(1, '10.0.0.1') == (1, None)
+    client_id, refusal = registry.acquire(0, '10.0.0.1')
+    assert client_id is None and refusal.startswith('Maximum clients')
+    assert registry.acquire(0, '10.0.0.2') == (2, None)
+    assert registry.acquire(0, '10.0.0.3') == (None, 'This server is full.')
+    registry.release(1)
+    assert registry.acquire(1, '10.0.0.1') == (1, None)
+
+def test_holders():
+    registry = Registry(playerlimit=10, multiclient_limit=10)
+    for worker in (0, 1, 1):
+        client_id, _ = registry.acquire(worker, '10.0.0.1')
+        registry.register(client_id, 42)
+    registry.move(0, 2)
+    assert registry.holders(42) == {1, 2}
+    registry.release(0)
+    assert registry.holders(42) == {1}
+    assert registry.holders(7) == set()
+    registry.release(1)
+    registry.release(2)
+    assert registry.by_ipid == {} and registry.by_address == {}
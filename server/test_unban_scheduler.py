@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+from server import database
+from server.unban_scheduler import UnbanScheduler
+
+def test_failed_batches_go_back_into_the_heap(monkeypatch):
+    monkeypatch.setattr(database, 'EXPIRE_BATCH_SIZE', 2)
+    scheduler = UnbanScheduler(SimpleNamespace(shard=None))
+    scheduler.deadlines = [(float(ban_id), ban_id) for ban_id in range(1, 7)]
+    scheduler.deadlines.append((100.0, 7))
+    lifted = []
+
+    def expire(ban_ids):
+        if 3 in ban_ids:
+            raise RuntimeError('database is locked')
+        lifted.extend(ban_ids)
+    scheduler.expire = expire
+
+    assert not scheduler.expire_due(10.0)
+    assert lifted == [1, 2]
+    assert sorted(ban_id for _, ban_id in scheduler.deadlines) == \
+        [3, 4, 5, 6, 7]
+
+    scheduler.expire = lambda ban_ids: lifted.extend(ban_ids)
+    assert scheduler.expire_due(10.0)
+    assert lifted == [1, 2, 3, 4, 5, 6]
+    assert scheduler.deadlines == [(100.0, 7)]
@@ -0,0 +1,43 @@
+import logging
+import threading
+import time
+
+from server.watchdog import Watchdog
+
+class Area:
+    clients = [1, 2, 3]
+    abbreviation = 'CR1'
+
+def block(seconds):
+    time.sleep(seconds)
+
+def test_slow_handler_is_reported_with_stack(caplog):
+    watchdog = Watchdog({'slow_handler_threshold': 0.02})
+    watchdog.thread_id = threading.get_ident()
+    thread = threading.Thread(target=watchdog.watch, daemon=True)
+    thread.start()
+    try:
+        with caplog.at_level(logging.WARNING, logger='events'):
+            watchdog.begin()
+            watchdog.end(0.001, 'packet CH', ['0'], Area)
+            watchdog.begin()
+            block(0.1)
+            watchdog.end(0.1, 'packet MS', ['ab', 5], Area)
+    finally:
+        watchdog.stopped.set()
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert message.startswith('Slow handler: packet MS took 100 ms '
+                              '(3 characters of arguments, 3 clients in [CR1])')
+    assert 'in block' in message
+
+def test_nested_command_is_reported_once(caplog):
+    watchdog = Watchdog({'slow_handler_threshold': 0.02})
+    with caplog.at_level(logging.WARNING, logger='events'):
+        watchdog.begin()
+        watchdog.begin()
+        watchdog.end(0.05, 'command area', '1', Area)
+        watchdog.end(0.05, 'packet CT', ['name', '/area 1'], Area)
+    assert [record.getMessage().split(' took')[0]
+            for record in caplog.records] == ['Slow handler: command area']
+    assert watchdog.depth == 0 and watchdog.handler_start is None
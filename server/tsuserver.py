@@ -22,16 +22,24 @@ import websockets
 import geoip2.database
 import yaml
 import logging
+from collections import Counter
 
 import server.logger
 from server import database
 from server.area_manager import AreaManager
+from server.capture import TrafficRecorder
+from server.chatlog import ChatLog
 from server.client_manager import ClientManager
 from server.emotes import Emotes
 from server.exceptions import ClientError,ServerError
+from server.metrics import Metrics
 from server.network.aoprotocol import AOProtocol
 from server.network.aoprotocol_ws import new_websocket_client
 from server.network.masterserverclient import MasterServerClient
+from server.predicates import everyone, mods_only, hears_global, hears_adverts
+from server.retention import LogRetention
+from server.unban_scheduler import UnbanScheduler
+from server.watchdog import Watchdog
 
 logger = logging.getLogger('debug')
 
@@ -55,6 +63,8 @@ class TsuServer3:
         self.backgrounds = None
         self.zalgo_tolerance = None
         self.ipRange_bans = []
+        # How many times each IPID was throttled for flooding packets
+        self.throttled_ipids = Counter()
         self.geoIpReader = None
         self.useGeoIp = False
 
@@ -67,6 +77,20 @@ class TsuServer3:
             pass
 
         self.ms_client = None
+        # Set when areas are split across worker processes
+        self.shard = None
+        # The event loop the server runs on, created by `start`
+        self.loop = None
+        # Records the traffic of every connection, if enabled
+        self.capture = None
+        # Where IC messages and room events are logged, if not the database
+        self.chat_log = None
+        # Counters and histograms for the metrics endpoint, if enabled
+        self.metrics = None
+        # Reports what blocks the event loop, if enabled
+        self.watchdog = None
+        # The last profiler started with /profile
+        self.profiler = None
 
         try:
             self.load_config()
@@ -98,9 +122,30 @@ class TsuServer3:
         self.client_manager = ClientManager(self)
         server.logger.setup_logger(debug=self.config['debug'])
 
+    def new_event_loop(self):
+        """Create an event loop of the kind set by the `event_loop`
+        option, and make it the current one."""
+        loop = None
+        if self.config['event_loop'] == 'uvloop':
+            try:
+                import uvloop
+                loop = uvloop.new_event_loop()
+            except ImportError:
+                print('uvloop is not installed; using the asyncio event loop.')
+        elif self.config['event_loop'] != 'asyncio':
+            print(f'Unknown event_loop {self.config["event_loop"]!r}; '
+                  'using the asyncio event loop.')
+        if loop is None:
+            loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
     def start(self):
         """Start the server."""
-        loop = asyncio.get_event_loop()
+        loop = self.loop = self.new_event_loop()
+
+        if self.config['capture']['enabled']:
+            self.capture = TrafficRecorder(self.config['capture'])
 
         bound_ip = '0.0.0.0'
         if self.config['local']:
@@ -114,19 +159,9 @@ class TsuServer3:
             ao_server_ws = websockets.serve(new_websocket_client(self),
                                             bound_ip,
                                             self.config['websocket_port'])
-            asyncio.ensure_future(ao_server_ws)
-
-        if self.config['use_masterserver']:
-            self.ms_client = MasterServerClient(self)
-            asyncio.ensure_future(self.ms_client.connect(), loop=loop)
-
-        if self.config['zalgo_tolerance']:
-            self.zalgo_tolerance = self.config['zalgo_tolerance']
-        
-        if self.config['idle_timeout']['use_idle_timeout']:
-            asyncio.ensure_future(self.idle_loop())
+            loop.run_until_complete(ao_server_ws)
 
-        asyncio.ensure_future(self.schedule_unbans())
+        self.start_tasks()
 
         database.log_misc('start')
         print('Server started and is listening on port {}'.format(
@@ -142,12 +177,72 @@ class TsuServer3:
         ao_server.close()
         loop.run_until_complete(ao_server.wait_closed())
         loop.close()
+        if self.capture is not None:
+            self.capture.close()
+        if self.chat_log is not None:
+            self.chat_log.close()
+
+    def start_tasks(self, primary=True):
+        """
+        Start the background tasks of the server.
+        :param primary: also start the tasks that must only run in one
+        process when areas are split across worker processes
+        (Default value = True)
+
+        """
+        if self.config['zalgo_tolerance']:
+            self.zalgo_tolerance = self.config['zalgo_tolerance']
+
+        if self.config['chat_log']['enabled']:
+            # Each worker writes its own segments.
+            name = 'chat' if self.shard is None else f'chat{self.shard.index}'
+            self.chat_log = ChatLog(self.config['chat_log'], name)
+            database.set_chat_log(self.chat_log)
+
+        if self.config['metrics']['enabled']:
+            self.metrics = Metrics(self, AOProtocol.net_cmd_dispatcher)
+            database.set_metrics(self.metrics)
+            port = self.config['metrics'].get('port', 9150)
+            if self.shard is not None:
+                # Each worker serves its own metrics.
+                port += self.shard.index
+            self.loop.create_task(self.metrics.serve(
+                self.config['metrics'].get('host', '127.0.0.1'), port))
+            self.loop.create_task(self.metrics.measure_loop_lag())
+
+        if self.config['watchdog']['enabled']:
+            self.watchdog = Watchdog(self.config['watchdog'])
+            self.loop.create_task(self.watchdog.run())
+            # asyncio's debug mode, toggled with /loopdebug, reports
+            # slow callbacks with the same threshold.
+            self.loop.slow_callback_duration = self.watchdog.slow_threshold
+
+        if self.config['idle_timeout']['use_idle_timeout']:
+            self.loop.create_task(self.idle_loop())
 
-    async def schedule_unbans(self):
+        if self.config['debug']:
+            self.loop.create_task(self.consistency_loop())
+
+        if not primary:
+            return
+
+        if self.config['use_masterserver']:
+            self.ms_client = MasterServerClient(self)
+            self.loop.create_task(self.ms_client.connect())
+
+        self.unban_scheduler = UnbanScheduler(self)
+        database.set_unban_scheduler(self.unban_scheduler)
+        self.loop.create_task(self.unban_scheduler.run())
+
+        if self.config['log_retention']['enabled']:
+            retention = LogRetention(self.config['log_retention'])
+            self.loop.create_task(retention.run())
+
+    async def consistency_loop(self):
         while True:
-            database.schedule_unbans()
-            await asyncio.sleep(3600 * 12)
-         
+            await asyncio.sleep(300)
+            self.client_manager.check_consistency()
+
     async def idle_loop(self):
         while True:
             self.client_manager.check_idlers()
@@ -158,11 +253,13 @@ class TsuServer3:
         """Get the server's current version."""
         return f'{self.release}.{self.major_version}.{self.minor_version}'
 
-    def new_client(self, transport):
+    def new_client(self, transport, user_id=None):
         """
         Create a new client based on a raw transport by passing
         it to the client manager.
         :param transport: asyncio transport
+        :param user_id: player ID assigned by the supervisor process
+        (Default value = None)
         :returns: created client object
         """
         peername = transport.get_extra_info('peername')[0]
@@ -188,10 +285,16 @@ class TsuServer3:
                 transport.write(msg.encode('utf-8'))
                 raise ClientError
 
-        c = self.client_manager.new_client(transport)
+        c = self.client_manager.new_client(transport, user_id)
         c.server = self
+        if self.shard is not None:
+            self.shard.register(c)
         c.area = self.area_manager.default_area()
-        c.area.new_client(c)
+        # With area workers, a client accepted by a worker that does not
+        # own the default area joins it after the handshake (see
+        # Shard.admit).
+        if self.shard is None or self.shard.owns(c.area):
+            c.area.new_client(c)
         return c
 
     def remove_client(self, client):
@@ -206,8 +309,10 @@ class TsuServer3:
     @property
     def player_count(self):
         """Get the number of non-spectating clients."""
-        return len([client for client in self.client_manager.clients
-            if client.char_id != -1])
+        count = self.client_manager.player_count
+        if self.shard is not None:
+            count += self.shard.remote_player_count()
+        return count
 
     def load_config(self):
         """Load the main server configuration from a YAML file."""
@@ -233,6 +338,28 @@ class TsuServer3:
                 'interval_length': 0,
                 'mute_length': 0
             }
+        if 'modcall_floodguard' not in self.config:
+            self.config['modcall_floodguard'] = {
+                'times_per_interval': 1,
+                'interval_length': 30,
+                'mute_length': 0
+            }
+        if 'casing_floodguard' not in self.config:
+            self.config['casing_floodguard'] = {
+                'times_per_interval': 1,
+                'interval_length': 60,
+                'mute_length': 0
+            }
+        if 'packet_floodguard' in self.config:
+            self.config['packet_floodguard'] = {
+                'packets_per_second': 30,
+                'packet_burst': 100,
+                'bytes_per_second': 32768,
+                'byte_burst': 131072,
+                **(self.config['packet_floodguard'] or {})
+            }
+        else:
+            self.config['packet_floodguard'] = None
         if 'idle_timeout' not in self.config:
             self.config['idle_timeout'] = {
                 'use_idle_timeout': False,
@@ -253,6 +380,20 @@ class TsuServer3:
             self.config['default_ban_duration'] = '6 hours'
         if 'asset_url' not in self.config:
             self.config['asset_url'] = None
+        if 'log_retention' not in self.config:
+            self.config['log_retention'] = {'enabled': False}
+        if 'area_workers' not in self.config:
+            self.config['area_workers'] = 0
+        if 'event_loop' not in self.config:
+            self.config['event_loop'] = 'asyncio'
+        if 'capture' not in self.config:
+            self.config['capture'] = {'enabled': False}
+        if 'chat_log' not in self.config:
+            self.config['chat_log'] = {'enabled': False}
+        if 'metrics' not in self.config:
+            self.config['metrics'] = {'enabled': False}
+        if 'watchdog' not in self.config:
+            self.config['watchdog'] = {'enabled': False}
 
     def load_characters(self):
         """Load the character list from a YAML file."""
@@ -334,7 +475,7 @@ class TsuServer3:
                     song_list.append('{}#{}'.format(index, song['name']))
                     index += 1
                 else:
-                    logger.debug(f"{song['name']} is not a valid song name")
+                    logger.debug('%s is not a valid song name', song['name'])
         song_list = [song_list[x:x + 10] for x in range(0, len(song_list), 10)]
         return song_list
 
@@ -348,7 +489,7 @@ class TsuServer3:
                 if self._is_valid_song_name(song['name']):
                     song_list.append(song['name'])
                 else:
-                    logger.debug(f"{song['name']} is not a valid song name")
+                    logger.debug('%s is not a valid song name', song['name'])
         return song_list
 
     @staticmethod
@@ -411,7 +552,7 @@ class TsuServer3:
                 return True
         return False
     
-    def send_all_cmd_pred(self, cmd, *args, pred=lambda x: True):
+    def send_all_cmd_pred(self, cmd, *args, pred=everyone):
         """
         Broadcast an AO-compatible command to all clients that satisfy
         a predicate.
@@ -419,6 +560,8 @@ class TsuServer3:
         for client in self.client_manager.clients:
             if pred(client):
                 client.send_command(cmd, *args)
+        if self.shard is not None:
+            self.shard.send_all_cmd_pred(cmd, args, pred)
 
     def broadcast_global(self, client, msg, as_mod=False):
         """
@@ -437,7 +580,7 @@ class TsuServer3:
         self.send_all_cmd_pred('CT',
                                ooc_name,
                                msg,
-                               pred=lambda x: not x.muted_global)
+                               pred=hears_global)
 
     def send_modchat(self, client, msg):
         """
@@ -449,7 +592,7 @@ class TsuServer3:
         name = client.name
         ooc_name = '{}[{}][{}]'.format('<dollar>M', client.area.abbreviation,
                                        name)
-        self.send_all_cmd_pred('CT', ooc_name, msg, pred=lambda x: x.is_mod)
+        self.send_all_cmd_pred('CT', ooc_name, msg, pred=mods_only)
 
     def broadcast_need(self, client, msg):
         """
@@ -468,7 +611,7 @@ class TsuServer3:
             '=== Advert ===\r\n{} in {} [{}] needs {}\r\n==============='.
             format(char_name, area_name, area_id, msg),
             '1',
-            pred=lambda x: not x.muted_adverts)
+            pred=hears_adverts)
 
     def send_arup(self, args):
         """Update the area properties for 2.6 clients.
@@ -504,7 +647,13 @@ class TsuServer3:
                 except:
                     return
 
-        self.send_all_cmd_pred('ARUP', *args, pred=lambda x: True)
+        if self.metrics is not None:
+            self.metrics.arup[args[0]].inc()
+        if self.shard is not None:
+            # Each worker only knows the state of its own areas
+            self.shard.send_arup(args)
+            return
+        self.send_all_cmd_pred('ARUP', *args)
 
     def refresh(self):
         """
@@ -546,6 +695,7 @@ class TsuServer3:
             self.config['modpass'] = cfg_yaml['modpass']
 
         self.load_characters()
+        self.client_manager.index_char_names()
         self.load_iniswaps()
         self.load_music()
         self.load_backgrounds()
@@ -0,0 +1,129 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import heapq
+import asyncio
+
+import logging
+logger = logging.getLogger('debug')
+
+from server import database
+
+
+class UnbanScheduler:
+    """
+    Lifts timed bans when they expire.
+
+    Upcoming unban deadlines are kept in a min-heap, and a single task
+    sleeps until the earliest one. Bans lifted by hand in the meantime
+    are left in the heap and skipped when they come due. Bans that could
+    not be lifted go back into the heap and are retried later.
+    """
+
+    # There is a bug in Python 3.7 and below where the event loop cannot
+    # wait for longer than one day, so wake up at least this often.
+    MAX_SLEEP = 3600 * 12
+    # Seconds to wait before retrying bans that could not be lifted
+    RETRY_DELAY = 60
+
+    def __init__(self, server):
+        self.server = server
+        self.deadlines = []
+        self.wakeup = asyncio.Event()
+
+    def load(self):
+        """Schedule every pending timed ban in the database."""
+        self.deadlines = [(unban_date.timestamp(), ban_id)
+                          for ban_id, unban_date in database.pending_unbans()]
+        heapq.heapify(self.deadlines)
+        self.wakeup.set()
+
+    def schedule(self, ban_id, unban_date):
+        """Schedule a ban to be lifted at `unban_date`."""
+        entry = (unban_date.timestamp(), ban_id)
+        heapq.heappush(self.deadlines, entry)
+        if self.deadlines[0] == entry:
+            self.wakeup.set()
+
+    async def run(self):
+        """Lift bans as they expire."""
+        self.load()
+        while True:
+            now = time.time()
+            if self.expire_due(now):
+                timeout = self.MAX_SLEEP
+                if len(self.deadlines) > 0:
+                    timeout = min(self.deadlines[0][0] - now, timeout)
+            else:
+                timeout = self.RETRY_DELAY
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def expire_due(self, now):
+        """
+        Lift the bans due by `now`, `database.EXPIRE_BATCH_SIZE` at a time.
+        If a batch fails, it is put back into the heap along with the
+        rest of the due bans.
+        :returns: False if some bans could not be lifted
+        """
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            due = []
+            while len(due) < database.EXPIRE_BATCH_SIZE and \
+                    len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                due.append(heapq.heappop(self.deadlines))
+            try:
+                self.expire([ban_id for _, ban_id in due])
+            except Exception:
+                logger.exception('Failed to lift expired bans')
+                for entry in due:
+                    heapq.heappush(self.deadlines, entry)
+                return False
+        return True
+
+    def expire(self, ban_ids):
+        """Lift a batch of expired bans and release cursed players."""
+        bans = database.expire_bans(ban_ids)
+        curses = set()
+        for ban in bans:
+            try:
+                if json.loads(ban.ban_data)['ban_type'] == 'area_curse':
+                    curses.add(ban.ban_id)
+            except (KeyError, ValueError, TypeError):
+                pass
+        if len(curses) == 0:
+            return
+
+        release_curses(self.server, curses)
+        if self.server.shard is not None:
+            self.server.shard.broadcast(release_curses, curses)
+
+
+def release_curses(server, ban_ids):
+    """Release the players bound to their areas by the given bans."""
+    for c in server.client_manager.clients:
+        if c.area_curse_info is not None and \
+                c.area_curse_info.ban_id in ban_ids:
+            database.log_misc('uncurse', c,
+                              data={'id': c.area_curse_info.ban_id})
+            c.area_curse = None
+            c.area_curse_info = None
+            c.send_ooc('You were uncursed from your area. Be free!')
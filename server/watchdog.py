@@ -0,0 +1,141 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import sys
+import threading
+import traceback
+from time import perf_counter
+
+import logging
+logger = logging.getLogger('events')
+
+# Frames of the stack included in a sample
+STACK_DEPTH = 12
+
+
+class Watchdog:
+    """
+    Finds out what blocks the event loop.
+
+    A task on the event loop wakes up every `interval` seconds and
+    reports when it wakes up more than `lag_threshold` seconds late.
+    Packet handlers and OOC commands are timed with `begin` and `end`,
+    and the ones that take longer than `slow_handler_threshold` seconds
+    are reported with the size of their arguments and the population
+    of the area.
+
+    While the loop is blocked it cannot look at itself, so a helper
+    thread watches the heartbeat of the task and the running handler,
+    and takes a sample of the loop's stack once either runs late. The
+    sample goes into the report.
+    """
+
+    def __init__(self, config):
+        self.interval = config.get('interval', 0.1)
+        self.lag_threshold = config.get('lag_threshold', 0.1)
+        self.slow_threshold = config.get('slow_handler_threshold', 0.05)
+        self.poll = min(self.lag_threshold, self.slow_threshold) / 2
+        self.thread_id = None
+        self.beat = perf_counter()
+        self.stall_sample = None
+        # The outermost running handler; OOC commands run inside the
+        # handler of the CT packet.
+        self.depth = 0
+        self.handler_start = None
+        self.handler_sample = None
+        self.reported = False
+        self.stopped = threading.Event()
+
+    async def run(self):
+        """Measure the lag of the event loop until cancelled."""
+        self.thread_id = threading.get_ident()
+        self.beat = perf_counter()
+        thread = threading.Thread(target=self.watch, name='watchdog',
+                                  daemon=True)
+        thread.start()
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                now = perf_counter()
+                lag = now - self.beat - self.interval
+                self.beat = now
+                if lag > self.lag_threshold:
+                    logger.warning('The event loop was blocked for %.0f ms.%s',
+                                   lag * 1000,
+                                   self.format_sample(self.stall_sample))
+                self.stall_sample = None
+        finally:
+            self.stopped.set()
+
+    def watch(self):
+        """Sample the stack of the event loop when it runs late."""
+        while not self.stopped.wait(self.poll):
+            now = perf_counter()
+            start = self.handler_start
+            if start is not None and self.handler_sample is None and \
+                    now - start > self.slow_threshold:
+                self.handler_sample = self.sample()
+            if self.stall_sample is None and \
+                    now - self.beat > self.interval + self.lag_threshold:
+                self.stall_sample = self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return None
+        # The innermost frames are the interesting ones.
+        return ''.join(traceback.format_stack(frame, limit=STACK_DEPTH))
+
+    @staticmethod
+    def format_sample(sample):
+        if sample is None:
+            return ''
+        return '\nStack sample:\n' + sample.rstrip()
+
+    def begin(self):
+        """Start timing a handler."""
+        if self.depth == 0:
+            self.handler_sample = None
+            self.reported = False
+            self.handler_start = perf_counter()
+        self.depth += 1
+
+    def end(self, elapsed, name, args, area):
+        """
+        Stop timing a handler, and report it if it was slow.
+        :param elapsed: seconds the handler took
+        :param name: what ran, e.g. 'packet MS'
+        :param args: the arguments of the packet or command
+        :param area: the area of the client
+        """
+        self.depth -= 1
+        if self.depth == 0:
+            self.handler_start = None
+        if elapsed < self.slow_threshold or self.reported:
+            return
+        # Report a nested command, not the packet it came in again.
+        self.reported = True
+        if isinstance(args, str):
+            size = len(args)
+        else:
+            size = sum(len(str(arg)) for arg in args)
+        logger.warning('Slow handler: %s took %.0f ms (%d characters of '
+                       'arguments, %d clients in [%s]).%s', name,
+                       elapsed * 1000, size, len(area.clients),
+                       area.abbreviation,
+                       self.format_sample(self.handler_sample))
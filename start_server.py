@@ -50,7 +50,11 @@ def check_deps():
 def main():
     from server.tsuserver import TsuServer3
     server = TsuServer3()
-    server.start()
+    if server.config['area_workers'] > 1:
+        from server.sharding import Supervisor
+        Supervisor(server).run()
+    else:
+        server.start()
 
 
 if __name__ == '__main__':